@@ -1,9 +1,9 @@
-# This script runs 3 types of rolling and displays the memory usage of each in the end.
+# This script runs 4 types of rolling and displays the memory usage of each in the end.
 # This should be run from the output directory
 maxmem=40GB
 nthreads=32
 
-declare -a exps=("xclim" "xrdefault" "xrnocounts")
+declare -a exps=("xclim" "xrdefault" "xrnocounts" "overlap")
 
 # Generating test data
 python ../scripts/bench_rolling.py gendata -n 350 200 150 120
@@ -2,5 +2,8 @@
 
 # This scripts launch all benchmark python scripts
 
-rm ../output/bench_txmean_xclim.json
-python2 ../scripts/bench_txmean_xclim.py -o ../output/bench_txmean_xclim.json
\ No newline at end of file
+rm -f ../output/bench_txmean_xclim.json ../output/bench_indicators.json
+python ../scripts/bench_txmean_xclim.py -o ../output/bench_txmean_xclim.json
+# xclim against icclim: check that both agree, then time them
+python ../scripts/bench_indicators.py --check
+python ../scripts/bench_indicators.py -o ../output/bench_indicators.json
@@ -0,0 +1,66 @@
+# Annual aggregation by reshaping time into (year, day of year)
+# With a calendar whose years all have the same number of days (noleap, 360_day, all_leap), a
+# chunk of whole years is a (years, days) array after a reshape, and a yearly reduction is one
+# vectorized NumPy call per chunk instead of one groupby subgraph per year. Other calendars, or
+# series that do not cover whole years, fall back to resample.
+import numpy as np
+import xarray as xr
+
+
+def year_length(time):
+    """Number of days of every year of a daily time coordinate, None if they differ or a year is incomplete."""
+    years, counts = np.unique(time.dt.year.values, return_counts=True)
+    if (counts != counts[0]).any() or (np.diff(years) != 1).any():
+        return None
+    length = int(counts[0])
+    if (time.dt.dayofyear.values != np.tile(np.arange(1, length + 1), years.size)).any():
+        return None
+    return length
+
+
+def whole_years(chunks, length, nyears):
+    """Time chunks of whole years of `length` days, about as long as `chunks`."""
+    per_chunk = max(1, int(round(max(chunks) / length)))
+    return tuple(min(per_chunk, nyears - i) * length for i in range(0, nyears, per_chunk))
+
+
+def _reduce_years(block, kernel, length, **kwargs):
+    years = block.reshape((block.shape[0] // length, length) + block.shape[1:])
+    return kernel(years, axis=1, **kwargs)
+
+
+def _resample(data, kernel, year_kwargs, dtype, kwargs):
+    def reduce_year(year):
+        extra = year_kwargs(year.time) if year_kwargs else {}
+        if year.chunks is not None:
+            year = year.chunk({'time': -1})
+        return xr.apply_ufunc(kernel, year, input_core_dims=[['time']], kwargs=dict(kwargs, axis=-1, **extra),
+                              dask='parallelized', output_dtypes=[dtype])
+
+    return data.resample(time='YS').apply(reduce_year)
+
+
+def aggregate(data, kernel, year_kwargs=None, dtype=None, reshape=True, **kwargs):
+    """Reduce `data` over the days of each year, labelled by the first day of the year as resample(time='YS').
+
+    `kernel(x, axis, **kwargs)` reduces the days along `axis` of a NumPy array, whatever its other
+    dimensions, e.g. np.nanmean. `year_kwargs(time)` gives more keyword arguments from the time
+    coordinate of one year, such as masks of seasons. With years of a fixed length, chunks of whole
+    years are reshaped and reduced in one call, otherwise each year is reduced through resample,
+    as always with `reshape=False`.
+    """
+    dtype = dtype or data.dtype
+    data = data.transpose('time', *[dim for dim in data.dims if dim != 'time'])
+    length = year_length(data.time) if reshape else None
+    if length is None:
+        return _resample(data, kernel, year_kwargs, dtype, kwargs)
+    if data.chunks is None:
+        data = data.chunk()
+    nyears = data.time.size // length
+    sizes = whole_years(data.chunks[0], length, nyears)
+    arr = data.data.rechunk({0: sizes})
+    extra = year_kwargs(data.time[:length]) if year_kwargs else {}
+    out = arr.map_blocks(_reduce_years, kernel=kernel, length=length, dtype=dtype,
+                         chunks=(tuple(s // length for s in sizes),) + arr.chunks[1:], **kwargs, **extra)
+    coords = {dim: data[dim] for dim in data.dims[1:] if dim in data.coords}
+    return xr.DataArray(out, dims=data.dims, coords=dict(coords, time=data.time.values[::length]), name=data.name)
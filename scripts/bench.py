@@ -0,0 +1,932 @@
+# Benchmark harness
+# Finds the experiments of every benchmark family (rolling, gsl, ensemble), runs any
+# subset of them by name and records the results in a shared JSON format.
+# Each experiment is run in its own subprocess so that peak memory numbers are not polluted.
+import os
+import sys
+import json
+import time
+import fnmatch
+import statistics
+import argparse
+import contextlib
+import tempfile
+import importlib
+import subprocess
+import datetime as dt
+from dask.utils import parse_bytes
+import utils
+import store
+import sweep
+import sampler
+import slots
+import graphstats
+import validate
+import nanindex
+import profiler
+import cache
+import synthetic
+import writers
+families = {'rolling': 'bench_rolling', 'gsl': 'bench_gsl', 'ensemble': 'bench_ensemble'}
+results_file = 'bench_results.json'
+
+
+def load_family(family):
+    return importlib.import_module(families[family])
+
+
+def registry(patterns=None):
+    """Map `family.exp` names to (module, exp) for all families matched by the patterns."""
+    fams = [fam for fam in families
+            if patterns is None or any(fnmatch.fnmatchcase(fam, pat.split('.')[0]) for pat in patterns)]
+    reg = {}
+    for fam in fams:
+        module = load_family(fam)
+        for exp in module.all_exps:
+            reg[f'{fam}.{exp}'] = (module, exp)
+    return reg
+
+
+def select(patterns, reg):
+    selected = []
+    for pat in patterns:
+        if '.' not in pat:
+            pat = pat + '.*'
+        matches = [name for name in reg if fnmatch.fnmatchcase(name, pat)]
+        if not matches:
+            raise KeyError(f'No experiment matches {pat}. Available: {", ".join(reg)}')
+        selected.extend(name for name in matches if name not in selected)
+    return selected
+
+
+def ensure_data(module, sizes, args):
+    """Make the working directory hold the test data of a family with these sizes.
+
+    Data already there with the same parameters and generator code is kept, otherwise it is
+    restored from the cache or generated and added to the cache. Returns the data manifest and
+    the cache status: present, hit, miss or off.
+    """
+    params = {'family': module.family, 'sizes': list(sizes), 'seed': args.seed, 'format': args.format,
+              'dtype': args.dtype}
+    key = cache.make_key('data', params, cache.code_version(module.gendata, synthetic))
+    manifest = cache.read_manifest(module.testfile)
+    if manifest is not None and manifest['key'] == key and synthetic.files(module.testfile, module.zarrstore):
+        return manifest, 'present'
+    path = None if args.no_cache else cache.lookup(key, args.cache)
+    if path is not None:
+        print(f'Test data of {module.family} {params["sizes"]} from the cache')
+        synthetic.clear(module.testfile, module.zarrstore)
+        cache.restore(path)
+        status = 'hit'
+    else:
+        module.gendata(sizes, seed=args.seed, fmt=args.format, dtype=args.dtype)
+        if not args.no_cache:
+            cache.add(key, 'data', params, synthetic.files(module.testfile, module.zarrstore),
+                      args.cache, args.cache_size)
+        status = 'off' if args.no_cache else 'miss'
+    manifest = {'key': key, 'params': params}
+    cache.write_manifest(module.testfile, manifest)
+    return manifest, status
+
+
+@contextlib.contextmanager
+def profiling(prof, client, stem):
+    """Sample the stacks of this process and record a dask performance report of the client, if any."""
+    if prof is None:
+        yield
+        return
+    with prof:
+        try:
+            # The report is rendered with bokeh
+            import bokeh
+            from distributed import performance_report
+        except ImportError:
+            client = None
+            print('Warning: no dask performance report without bokeh')
+        if client is None:
+            yield
+        else:
+            with performance_report(filename=stem + '.html'):
+                yield
+
+
+def run_one(name, args):
+    """Run a single experiment in this process and return its result record."""
+    fam, exp = name.split('.', 1)
+    module = load_family(fam)
+    manifest = cache.read_manifest(module.testfile)
+    if manifest is None:
+        print(f'Warning: no record of the parameters of the {fam} test data, regenerate it with gendata')
+    elif args.cache_intermediates and not args.no_cache:
+        cache.active = {'dir': args.cache, 'limit': args.cache_size, 'data_key': manifest['key']}
+    c = utils.make_client(args)
+    smp = sampler.Sampler(args.sample_interval)
+    if c is not None:
+        smp.add_client(c)
+    prof = profiler.StackSampler(args.profile_interval, phase=lambda: smp.current) if args.profile else None
+    stem = profiler.profile_stem(name, args.profile_dir) if args.profile else None
+    # Bytes read by this process and the worker processes, mostly the input
+    read = utils.read_bytes()
+    workers_read = c.run(utils.read_bytes) if c is not None and not args.threads_only else {}
+
+    with smp, profiling(prof, c, stem):
+        with smp.phase('open'):
+            data = module.open_data(args)
+        print(f'Running {fam} with exp: {exp}')
+        with smp.phase('build'):
+            out = module.run_exp(exp, data, args)
+            outname = module.output_name(exp, args)
+            if args.out_tag:
+                # Runs side by side write to their own file
+                outname = f'_{args.out_tag}'.join(os.path.splitext(outname))
+            outname = writers.output_path(outname, args.writer)
+            chunks = writers.chunk_sizes(out)
+            r = writers.write(out, outname, args.writer, chunks, compute=False) if args.fused_write else out
+        # Graph metrics are taken outside of the timed phases, optimizing the graph takes a while
+        graph = None if args.no_graph_stats else graphstats.graph_metrics(r)
+        if args.fused_write:
+            print('Writing to file')
+            # The reduction and the write are computed together, in the same graph
+            with smp.phase('compute'):
+                r.compute()
+        else:
+            with smp.phase('compute'):
+                if c is None:
+                    out = out.compute()
+                else:
+                    # Keep the output on the workers, the writer gathers it chunk by chunk
+                    from distributed import wait
+                    out = out.persist()
+                    wait(out)
+            print('Writing to file')
+            with smp.phase('write'):
+                if c is not None and not args.threads_only and writers.backends[args.writer]['format'] == 'netcdf':
+                    # A netCDF file has a single writer: gather the output from the worker processes
+                    # rather than have each of them append to the file
+                    out = out.compute()
+                writers.write(out, outname, args.writer, chunks)
+    read = utils.read_bytes() - read
+    if workers_read:
+        read += sum(n - workers_read.get(w, 0) for w, n in c.run(utils.read_bytes).items())
+
+    # The data in place, whatever --dtype says
+    shape = utils.data_shape(data)
+    result = {
+        'name': name,
+        'family': fam,
+        'exp': exp,
+        'date': dt.datetime.now().isoformat(),
+        'wall_time': sum(smp.durations.values()),
+        'open_time': smp.durations['open'],
+        'timings': dict(smp.durations),
+        'peak_rss': utils.peak_rss(),
+        'client': utils.client_settings(args),
+        'options': {opt: getattr(args, opt) for opt in getattr(module, 'options', [])},
+        'shape': shape,
+        'format': args.format,
+        'dtype': shape['dtype'],
+        'index': args.index,
+        'data': manifest,
+        'cache': {'data': args.data_cache, 'intermediates': cache.events},
+        'outfile': outname,
+        'writer': args.writer,
+        'fused_write': args.fused_write,
+        'output_bytes': writers.disk_size(outname),
+        'read_bytes': read,
+        'versions': utils.versions(),
+        'machine': utils.machine(),
+        'memory': smp.to_dict(),
+    }
+    if graph is not None:
+        result['graph'] = graph
+    if nanindex.events:
+        result['nan_summary'] = nanindex.events
+    if prof is not None:
+        params = {key: result[key] for key in ['name', 'date', 'client', 'options', 'shape', 'format', 'index',
+                                               'writer', 'versions', 'machine']}
+        result['profile'] = prof.save(stem, dict(params, benchmark=store.bench_id(dict(result, profile=True))))
+        if os.path.exists(stem + '.html'):
+            result['profile']['report'] = stem + '.html'
+        print(f'Profile saved to {stem}.*')
+    out.close()
+    if c is not None:
+        result['workers_peak_rss'] = c.run(utils.peak_rss)
+        result['transfers'] = graphstats.client_io(c)
+    # After all measurements, computing the reference takes time and memory
+    if not args.no_validate:
+        result['validation'] = validate.validate(module, exp, outname, args, manifest)
+    if c is not None:
+        c.close()
+    return result
+
+
+def child_argv(name, args, result):
+    argv = [sys.executable, os.path.abspath(__file__), 'exec', name, '--result', result,
+            '-N', str(args.nthreads), '-m', args.max_mem, '-w', str(args.nworkers), '--format', args.format,
+            '--dtype', args.dtype,
+            '--sample-interval', str(args.sample_interval), '--writer', args.writer]
+    if args.fused_write:
+        argv.append('--fused-write')
+    if args.index:
+        argv.append('--index')
+    argv.extend(['--cache', args.cache, '--cache-size', args.cache_size])
+    if args.data_cache:
+        argv.extend(['--data-cache', args.data_cache])
+    if args.no_cache:
+        argv.append('--no-cache')
+    if args.cache_intermediates:
+        argv.append('--cache-intermediates')
+    if args.with_client:
+        argv.append('-c')
+    if args.threads_only:
+        argv.append('--threads-only')
+    for opt in ['spill_target', 'spill', 'pause', 'terminate']:
+        if getattr(args, opt) is not None:
+            argv.extend(['--' + opt.replace('_', '-'), str(getattr(args, opt)).lower()])
+    if args.local_dir:
+        argv.extend(['--local-dir', args.local_dir])
+    if args.no_graph_stats:
+        argv.append('--no-graph-stats')
+    if args.no_validate:
+        argv.append('--no-validate')
+    argv.extend(['--rtol', str(args.rtol), '--atol', str(args.atol)])
+    if args.profile:
+        argv.extend(['--profile', '--profile-interval', str(args.profile_interval), '--profile-dir', args.profile_dir])
+    for fam in families:
+        module = load_family(fam)
+        for opt in getattr(module, 'options', []):
+            value = getattr(args, opt)
+            flag = '--' + opt.replace('_', '-')
+            if value is True:
+                argv.append(flag)
+            elif value not in (False, None):
+                argv.extend([flag, str(value)])
+    return argv
+
+
+def collect(name, args, tmp, extra=None):
+    """Read the result a child wrote to `tmp` and record it."""
+    with open(tmp) as f:
+        result = json.load(f)
+    result.update(extra or {})
+    utils.append_results(args.output, [result])
+    if args.store:
+        store.add([result], args.store)
+    print(f'{name}: {result["wall_time"]:.2f} s, peak RSS {result["peak_rss"]:.0f} MiB, '
+          f'peak total RSS {result["memory"]["peak_rss_total"]:.0f} MiB')
+    return result
+
+
+def run_child(name, args, extra=None):
+    """Run an experiment in a subprocess and record its result, None if it failed."""
+    print(f'=== {name}')
+    fd, tmp = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        proc = subprocess.run(child_argv(name, args, tmp))
+        if proc.returncode != 0:
+            return None
+        return collect(name, args, tmp, extra)
+    finally:
+        os.remove(tmp)
+
+
+def run(args):
+    names = select(args.exps, registry(args.exps))
+    names = [name for name in names for _ in range(args.repeat)]
+    if args.chunk_size:
+        families_used = {name.split('.')[0] for name in names}
+        if len(families_used) > 1:
+            raise ValueError('-n sets the data sizes of one family, run one family at a time')
+        module = load_family(families_used.pop())
+        _, args.data_cache = ensure_data(module, utils.parse_sizes(args.chunk_size), args)
+    if args.jobs > 1:
+        return run_concurrent(names, args)
+    failed = []
+    for name in names:
+        if run_child(name, args) is None:
+            failed.append(name)
+    if failed:
+        print(f'Failed experiments: {", ".join(failed)}')
+        return 1
+    return 0
+
+
+def run_concurrent(names, args):
+    """Run the experiments side by side, each pinned to the cores of its own slot with a memory cap."""
+    cores = args.slot_cores or (args.nthreads * args.nworkers if args.with_client else 1)
+    mem = parse_bytes(args.slot_mem) if args.slot_mem else None
+    pool = slots.make_slots(cores, mem, args.jobs)
+    batch = dt.datetime.now().strftime('%Y%m%d%H%M%S')
+    print(f'Batch {batch}: {len(names)} runs on {len(pool)} slots of {cores} cores and '
+          f'{pool[0]["mem"] / 2**30:.1f} GiB')
+
+    tmps = {}
+    jobs = []
+    for i, name in enumerate(names):
+        fd, tmps[i] = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        jobs.append((i, child_argv(name, args, tmps[i]) + ['--out-tag', f'j{i}']))
+
+    runs, failed = [], []
+
+    def done(i, status):
+        name = names[i]
+        if status['returncode'] != 0:
+            failed.append(name + (' (memory cap)' if status['capped'] else ''))
+            return
+        slot = {'batch': batch, 'id': status['slot']['id'], 'cpus': status['slot']['cpus'],
+                'mem': status['slot']['mem'], 'concurrent': status['concurrent'],
+                'peak_tree_rss': status['peak_tree_rss']}
+        runs.append(collect(name, args, tmps[i], {'slot': slot}))
+
+    try:
+        slots.run(jobs, pool, done)
+    finally:
+        for tmp in tmps.values():
+            os.remove(tmp)
+
+    flag_contention(runs, args)
+    if failed:
+        print(f'Failed experiments: {", ".join(failed)}')
+        return 1
+    return 0
+
+
+def flag_contention(runs, args):
+    """Mark the runs of a batch whose repeats vary more than --contention-cv, in the output file too."""
+    spread = slots.contention(runs, store.bench_id, args.contention_cv)
+    for bench, stats in spread.items():
+        status = 'CONTENTION' if stats['flag'] else 'ok'
+        print(f'{bench}: wall time spread {stats["cv"]:.1%} over {stats["n"]} runs  {status}')
+    if not spread:
+        return
+    batch = runs[0]['slot']['batch']
+    results = utils.load_results(args.output)
+    for run in results['runs']:
+        if run.get('slot', {}).get('batch') == batch and store.bench_id(run) in spread:
+            run['slot']['contention'] = spread[store.bench_id(run)]
+    utils.save_results(args.output, results)
+
+
+def run_sweep(args):
+    """Run the experiments over a grid of client settings and data sizes, then report the scaling."""
+    names = select(args.exps, registry(args.exps))
+    families_used = {name.split('.')[0] for name in names}
+    if len(families_used) > 1:
+        raise ValueError('A sweep generates the data of one family, run one sweep per family')
+    module = load_family(families_used.pop())
+    sizes = [utils.parse_sizes(size.split()) for size in args.sizes] or [module.default_sizes]
+    if args.mode == 'strong':
+        points = list(sweep.strong_grid(sizes, args.workers, args.threads))
+    else:
+        points = list(sweep.weak_grid(sizes[0], args.workers, args.threads, args.weak_index))
+    sweep_id = dt.datetime.now().strftime('%Y%m%d%H%M%S')
+    print(f'Sweep {sweep_id}: {len(points)} points x {len(names)} experiments x {args.repeat} repeats')
+
+    runs, failed = [], []
+    current = None
+    for point in points:
+        if point['sizes'] != current:
+            _, status = ensure_data(module, point['sizes'], args)
+            current = point['sizes']
+        pargs = argparse.Namespace(**vars(args))
+        pargs.data_cache = status
+        pargs.with_client = True
+        pargs.nworkers = point['nworkers']
+        pargs.nthreads = point['nthreads']
+        for name in [name for name in names for _ in range(args.repeat)]:
+            result = run_child(name, pargs, {'sweep': dict(point, id=sweep_id, mode=args.mode)})
+            if result is None:
+                failed.append(f'{name} {point}')
+            else:
+                runs.append(result)
+
+    scaling(runs, args.mode, f'scaling_{args.mode}_{sweep_id}.png')
+    if failed:
+        print(f'Failed points: {", ".join(failed)}')
+        return 1
+    return 0
+
+
+def precision(args):
+    """Run experiments of one family on float64, then float32 test data, and compare time, memory and outputs."""
+    names = select(args.exps, registry(args.exps))
+    families_used = {name.split('.')[0] for name in names}
+    if len(families_used) > 1:
+        raise ValueError('-n sets the data sizes of one family, run one family at a time')
+    fam = families_used.pop()
+    module = load_family(fam)
+    sizes = utils.parse_sizes(args.chunk_size) if args.chunk_size else module.default_sizes
+    # The test data in place before, put back at the end
+    before = cache.read_manifest(module.testfile)
+    runs, failed = {}, []
+    try:
+        for dtype in ['float64', 'float32']:
+            dargs = argparse.Namespace(**vars(args))
+            dargs.dtype = dtype
+            _, dargs.data_cache = ensure_data(module, sizes, dargs)
+            for name in names:
+                results = [run_child(name, dargs) for _ in range(args.repeat)]
+                if None in results:
+                    failed.append(f'{name} {dtype}')
+                    continue
+                runs.setdefault(name, {})[dtype] = results
+                if dtype == 'float64':
+                    # Keep the float64 output aside, the float32 run writes to the same file
+                    root, ext = os.path.splitext(results[-1]['outfile'])
+                    kept = f'{root}_float64{ext}'
+                    writers.remove(kept)
+                    os.replace(results[-1]['outfile'], kept)
+                    results[-1]['outfile'] = kept
+    finally:
+        params = dict({'dtype': 'float64'}, **before['params']) if before else {'sizes': sizes, 'dtype': 'float64'}
+        dargs = argparse.Namespace(**dict(vars(args), seed=params.get('seed', args.seed),
+                                          format=params.get('format', args.format), dtype=params['dtype']))
+        print(f'Restoring the {params["dtype"]} test data of {fam}')
+        ensure_data(module, params['sizes'], dargs)
+
+    rows = []
+    print(f'{"name":30s} {"wall64 [s]":>10s} {"wall32 [s]":>10s} {"ratio":>6s} {"peak64 [MiB]":>12s} '
+          f'{"peak32 [MiB]":>12s} {"ratio":>6s} {"max abs diff":>12s} {"max rel diff":>12s} {"NaNs":>5s}  ok')
+    for name, by_dtype in runs.items():
+        if len(by_dtype) < 2:
+            continue
+        wall = {dtype: min(r['wall_time'] for r in results) for dtype, results in by_dtype.items()}
+        peak = {dtype: max(r['memory']['peak_rss_total'] for r in results) for dtype, results in by_dtype.items()}
+        with validate.open_output(by_dtype['float32'][-1]['outfile']) as out, \
+                validate.open_output(by_dtype['float64'][-1]['outfile']) as ref:
+            variables = validate.compare(validate.canonical(module, out), validate.canonical(module, ref),
+                                         args.rtol, args.atol)
+        if any('error' in var for var in variables.values()):
+            print(f'{name}: outputs cannot be compared: {variables}')
+        row = {
+            'name': name,
+            'wall_time': wall,
+            'peak_rss_total': peak,
+            'max_abs_diff': max(var.get('max_abs_diff', float('nan')) for var in variables.values()),
+            'max_rel_diff': max(var.get('max_rel_diff', float('nan')) for var in variables.values()),
+            'nan_mismatch': sum(var.get('nan_mismatch', 0) for var in variables.values()),
+            'passed': all(var['passed'] for var in variables.values()),
+            'variables': variables,
+        }
+        rows.append(row)
+        print(f'{name:30s} {wall["float64"]:10.2f} {wall["float32"]:10.2f} {wall["float32"] / wall["float64"]:6.2f} '
+              f'{peak["float64"]:12.0f} {peak["float32"]:12.0f} {peak["float32"] / peak["float64"]:6.2f} '
+              f'{row["max_abs_diff"]:12.3g} {row["max_rel_diff"]:12.3g} {row["nan_mismatch"]:5d}  '
+              f'{"yes" if row["passed"] else "NO"}')
+
+    report = {'family': fam, 'sizes': list(sizes), 'rtol': args.rtol, 'atol': args.atol,
+              'date': dt.datetime.now().isoformat(), 'machine': utils.machine(), 'runs': rows}
+    filename = f'precision_{fam}_{dt.datetime.now().strftime("%Y%m%d%H%M%S")}.json'
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f'Report saved to {filename}')
+    if failed:
+        print(f'Failed experiments: {", ".join(failed)}')
+        return 1
+    return 0
+
+
+def fused(args):
+    """Run the fused experiment of a family with all the indicators, then the existing pipeline of each, and compare.
+
+    The sequential baseline runs the family's `sequential` experiment with one indicator at a time,
+    each in its own process that reads the input, as when indicators are computed one per job.
+    """
+    module = load_family(args.family)
+    sizes = utils.parse_sizes(args.chunk_size) if args.chunk_size else module.default_sizes
+    _, args.data_cache = ensure_data(module, sizes, args)
+    indicators = args.indicators.split(',')
+    runs, failed = {}, []
+    for selected in [args.indicators] + indicators:
+        iargs = argparse.Namespace(**vars(args))
+        iargs.indicators = selected
+        name = f'{args.family}.fused' if selected == args.indicators else f'{args.family}.sequential'
+        results = [run_child(name, iargs) for _ in range(args.repeat)]
+        if None in results:
+            failed.append(f'{name} {selected}')
+            continue
+        runs[selected] = results
+        # The sequential runs write to their own file, compare each with the fused output
+        if selected != args.indicators and args.indicators in runs:
+            with validate.open_output(results[-1]['outfile']) as out, \
+                    validate.open_output(runs[args.indicators][-1]['outfile']) as ref:
+                results[-1]['same'] = validate.compare({selected: out[selected]}, {selected: ref[selected]},
+                                                       args.rtol, args.atol)[selected]
+
+    def metrics(results):
+        return {'wall_time': min(r['wall_time'] for r in results),
+                'read_bytes': min(r['read_bytes'] for r in results),
+                'peak_rss_total': max(r['memory']['peak_rss_total'] for r in results),
+                'tasks': results[-1].get('graph', {}).get('tasks')}
+
+    def line(label, m, same=''):
+        tasks = '-' if m['tasks'] is None else m['tasks']
+        print(f'{label:24s} {m["wall_time"]:10.2f} {m["read_bytes"] / 2**20:10.1f} {m["peak_rss_total"]:12.0f} '
+              f'{tasks:>8}  {same}')
+
+    print(f'{"indicators":24s} {"wall [s]":>10s} {"read [MiB]":>10s} {"peak [MiB]":>12s} {"tasks":>8s}  same')
+    rows = {}
+    for selected, results in runs.items():
+        rows[selected] = dict(metrics(results), same=results[-1].get('same'))
+        same = '' if selected == args.indicators else 'yes' if rows[selected]['same']['passed'] else 'NO'
+        line('fused' if selected == args.indicators else selected, rows[selected], same)
+    singles = [rows[ind] for ind in indicators if ind in rows]
+    report = {'family': args.family, 'indicators': indicators, 'sizes': list(sizes),
+              'date': dt.datetime.now().isoformat(), 'machine': utils.machine(), 'runs': rows}
+    if args.indicators in rows and len(singles) == len(indicators):
+        sequential = {'wall_time': sum(m['wall_time'] for m in singles),
+                      'read_bytes': sum(m['read_bytes'] for m in singles),
+                      'peak_rss_total': max(m['peak_rss_total'] for m in singles),
+                      'tasks': None if None in [m['tasks'] for m in singles] else sum(m['tasks'] for m in singles)}
+        line('sequential', sequential)
+        fused_run = rows[args.indicators]
+        report['sequential'] = sequential
+        report['saved'] = {key: 1 - fused_run[key] / sequential[key] for key in ['wall_time', 'read_bytes']
+                           if sequential[key]}
+        print('Saved by the fused run: ' + ', '.join(f'{key} {value:.0%}' for key, value in report['saved'].items()))
+    filename = f'fused_{args.family}_{dt.datetime.now().strftime("%Y%m%d%H%M%S")}.json'
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f'Report saved to {filename}')
+    if failed:
+        print(f'Failed experiments: {", ".join(failed)}')
+        return 1
+    return 0
+
+
+def write_bench(args):
+    """Compute an experiment once, then time writing its output with each backend."""
+    (name,) = select(args.exps, registry(args.exps))
+    fam, exp = name.split('.', 1)
+    module = load_family(fam)
+    c = utils.make_client(args)
+    data = module.open_data(args)
+    print(f'Computing {name}')
+    out = module.run_exp(exp, data, args)
+    chunks = writers.chunk_sizes(out)
+    out = out.compute()
+    nbytes = out.nbytes
+    root, ext = os.path.splitext(module.output_name(exp, args))
+
+    print(f'{"backend":22s} {"write [s]":>16s} {"size [MiB]":>11s} {"ratio":>6s} {"MiB/s":>8s}')
+    results = []
+    for backend in args.backends:
+        path = writers.output_path(f'{root}_{backend}{ext}', backend)
+        times = []
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            writers.write(out, path, backend, chunks)
+            times.append(time.perf_counter() - t0)
+        size = writers.disk_size(path)
+        if not args.keep:
+            writers.remove(path)
+        mean = statistics.mean(times)
+        spread = f'{mean:.3f} +- {statistics.stdev(times):.3f}' if len(times) > 1 else f'{mean:.3f}'
+        print(f'{backend:22s} {spread:>16s} {size / 2**20:11.1f} {nbytes / size:6.2f} '
+              f'{nbytes / 2**20 / mean:8.1f}')
+        results.append({
+            'name': f'{name}:write',
+            'family': fam,
+            'exp': exp,
+            'date': dt.datetime.now().isoformat(),
+            'writer': backend,
+            'wall_time': mean,
+            'values': {'wall_time': times},
+            'peak_rss': utils.peak_rss(),
+            'client': utils.client_settings(args),
+            'options': {opt: getattr(args, opt) for opt in getattr(module, 'options', [])},
+            'shape': utils.data_shape(data),
+            'format': args.format,
+            'dtype': utils.data_shape(data)['dtype'],
+            'data_bytes': nbytes,
+            'output_bytes': size,
+            'versions': utils.versions(),
+            'machine': utils.machine(),
+        })
+    out.close()
+    if c is not None:
+        c.close()
+    utils.append_results(args.output, results)
+    if args.store:
+        store.add(results, args.store)
+    return 0
+
+
+def scaling(runs, mode, filename):
+    curves = sweep.efficiency(runs, mode)
+    sweep.report(curves, mode)
+    sweep.plot(curves, mode, filename)
+    return curves
+
+
+def filter_runs(args):
+    runs = utils.load_results(args.output)['runs']
+    if args.exps:
+        runs = [run for run in runs if any(fnmatch.fnmatchcase(run['name'], pat) for pat in args.exps)]
+    return runs
+
+
+def show(args):
+    runs = filter_runs(args)
+    print(f'{"name":30s} {"wall [s]":>10s} {"open [s]":>9s} {"peak RSS [MiB]":>15s} {"threads":>8s} {"max mem":>8s} '
+          f'{"tasks":>8s} {"depth":>6s} {"transfer [MiB]":>15s} {"spilled [MiB]":>14s} {"valid":>6s}  date')
+    for run in runs:
+        cl = run['client']
+        graph = run.get('graph', {})
+        moved = run.get('transfers', {}).get('total', {}).get('incoming_bytes')
+        moved = f'{moved / 2**20:.0f}' if moved is not None else '-'
+        spilled = run.get('transfers', {}).get('total', {}).get('spilled_bytes')
+        spilled = f'{spilled / 2**20:.0f}' if spilled is not None else '-'
+        valid = {True: 'ok', False: 'FAIL', None: '-'}[run.get('validation', {}).get('passed')]
+        opened = f'{run["open_time"]:.2f}' if 'open_time' in run else '-'
+        # workers x threads
+        threads = f'{cl.get("nworkers", 1)}x{cl["nthreads"]}' if cl.get('nworkers', 1) != 1 else cl['nthreads']
+        print(f'{run["name"]:30s} {run["wall_time"]:10.2f} {opened:>9s} {run["peak_rss"]:15.0f} '
+              f'{threads if cl["with_client"] else "-":>8} {cl["max_mem"] if cl["with_client"] else "-":>8} '
+              f'{graph.get("tasks", "-"):>8} {graph.get("depth", "-"):>6} '
+              f'{moved:>15} {spilled:>14} {valid:>6}  {run["date"]}')
+    return 0
+
+
+def hotspots(args):
+    """Functions with the most samples in the profiles of recorded runs, with the xclim version of each run."""
+    runs = [run for run in filter_runs(args) if 'profile' in run]
+    if not runs:
+        print('No profiled runs, record some with run --profile')
+        return 1
+    for run in runs:
+        print(f'{store.bench_id(run)}  xclim {run["versions"].get("xclim", "-")}  {run["date"]}  '
+              f'{run["profile"]["samples"]} samples')
+        print(f'  {run["profile"]["stacks"]}')
+        for frame, fraction in run['profile']['top'][:args.top]:
+            print(f'  {100 * fraction:5.1f}%  {frame}')
+    return 0
+
+
+def add_family_arguments(parser):
+    for fam in families:
+        module = load_family(fam)
+        if hasattr(module, 'add_arguments'):
+            module.add_arguments(parser.add_argument_group(f'{fam} options'))
+
+
+def add_output_arguments(parser):
+    parser.add_argument('--writer', default='netcdf', choices=list(writers.backends),
+                        help='Output backend and encoding, see writers.py')
+    parser.add_argument('--fused-write', action='store_true',
+                        help='Compute and write in a single graph, without timing the write on its own')
+
+
+def add_cache_arguments(parser):
+    parser.add_argument('--cache', default=cache.default_dir,
+                        help='Cache directory of generated data and intermediates, $BENCH_CACHE or bench_cache by default')
+    parser.add_argument('--cache-size', default=cache.default_size,
+                        help='Size limit of the cache, least recently used entries are evicted above it')
+    parser.add_argument('--no-cache', action='store_true', help='Do not use the cache')
+
+
+def add_validation_arguments(parser):
+    parser.add_argument('--no-validate', action='store_true',
+                        help='Do not compare the outputs with the reference experiment of their family')
+    parser.add_argument('--rtol', default=validate.default_rtol, type=float, help='Relative tolerance of the validation')
+    parser.add_argument('--atol', default=validate.default_atol, type=float, help='Absolute tolerance of the validation')
+
+
+def add_profile_arguments(parser):
+    parser.add_argument('--profile', action='store_true',
+                        help='Save a sampling CPU profile of the run, and a dask performance report with a client')
+    parser.add_argument('--profile-interval', default=0.01, type=float, help='Interval [s] between stack samples')
+    parser.add_argument('--profile-dir', default=profiler.default_dir, help='Directory of the profiles')
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Run benchmark experiments of all families')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    sub.add_parser('list', help='List available experiments')
+
+    p = sub.add_parser('gendata', help='Generate the test data of a family')
+    p.add_argument('family', choices=list(families))
+    p.add_argument('-n', '--chunk-size', nargs='*', help='Size of the random data to generate, see each family script')
+    utils.add_client_arguments(p)
+    utils.add_data_arguments(p)
+    add_cache_arguments(p)
+
+    p = sub.add_parser('plot', help='Plot mprof memory profiles of a family')
+    p.add_argument('family', choices=list(families))
+    p.add_argument('-i', '--files', default='*.dat', nargs='*', help='Dat files to plot')
+
+    p = sub.add_parser('memplot', help='Plot the sampled memory usage of recorded runs')
+    p.add_argument('exps', nargs='*', help='Only plot these experiments (wildcards allowed)')
+    p.add_argument('-o', '--output', default=results_file, help='JSON results file')
+
+    for cmd, hlp in [('run', 'Run experiments, each in its own process'),
+                     ('exec', 'Run a single experiment in this process'),
+                     ('precision', 'Run experiments on float64, then float32 data and report the memory and accuracy'),
+                     ('fused', 'Run the indicators of a family in one graph, then one by one, and compare')]:
+        p = sub.add_parser(cmd, help=hlp)
+        if cmd == 'fused':
+            p.add_argument('family', choices=[fam for fam in families if hasattr(load_family(fam), 'fused_indicators')])
+        else:
+            p.add_argument('exps', nargs=1 if cmd == 'exec' else '+',
+                           help='Experiments as family.exp, shell-style wildcards or family names')
+        utils.add_client_arguments(p)
+        utils.add_data_arguments(p)
+        p.add_argument('-o', '--output', default=results_file, help='JSON file where results are appended')
+        p.add_argument('--sample-interval', default=0.1, type=float,
+                       help='Interval [s] between memory and CPU samples of the main process and dask workers')
+        p.add_argument('--no-graph-stats', action='store_true',
+                       help='Do not record the size and depth of the task graph')
+        add_output_arguments(p)
+        add_cache_arguments(p)
+        p.add_argument('--cache-intermediates', action='store_true',
+                       help='Cache the intermediate results experiments mark as reusable')
+        add_profile_arguments(p)
+        add_validation_arguments(p)
+        if cmd in ('run', 'precision', 'fused'):
+            p.add_argument('-n', '--chunk-size', nargs='*',
+                           help='Use test data of these sizes, from the cache or generated, see each family script')
+            p.set_defaults(data_cache=None)
+            p.add_argument('-r', '--repeat', default=1, type=int,
+                           help='Number of runs of each experiment, needed for significance tests')
+            p.add_argument('--store', help='Also file the runs in this results store directory')
+        if cmd == 'run':
+            p.add_argument('-j', '--jobs', default=1, type=int,
+                           help='Run up to this many experiments at once, each pinned to its own cores')
+            p.add_argument('--slot-cores', type=int,
+                           help='Physical cores per concurrent run, threads x workers of the client by default')
+            p.add_argument('--slot-mem', help='Memory cap of each concurrent run, shared equally by default')
+            p.add_argument('--contention-cv', default=0.1, type=float,
+                           help='Flag repeated runs whose wall times vary more than this (relative std. dev.)')
+        if cmd == 'exec':
+            p.add_argument('--result', help='Write the result to this file instead of appending to the output')
+            p.add_argument('--out-tag', help=argparse.SUPPRESS)
+            p.add_argument('--data-cache', help=argparse.SUPPRESS)
+        add_family_arguments(p)
+
+    p = sub.add_parser('sweep', help='Run experiments of one family over a grid of threads, workers and data sizes')
+    p.add_argument('exps', nargs='+', help='Experiments as family.exp, shell-style wildcards or family names')
+    p.add_argument('--mode', default='strong', choices=['strong', 'weak'],
+                   help='strong: every size with every setting. weak: the size grows with the cores')
+    p.add_argument('--threads', nargs='+', type=int, default=[1, 2, 4, 8, 16, 32], help='Threads per worker')
+    p.add_argument('--workers', nargs='+', type=int, default=[1], help='Numbers of workers')
+    p.add_argument('--sizes', nargs='*', default=[],
+                   help='Data sizes and chunks, each as the quoted -n values of the family, e.g. "350 200 150 120"')
+    p.add_argument('--weak-index', default=-1, type=int,
+                   help='Weak scaling: which of the -n values grows with the cores, the number of chunks by default')
+    p.add_argument('-m', '--max-mem', default='2GB', help='Memory limit of each worker')
+    utils.add_cluster_arguments(p)
+    p.add_argument('-r', '--repeat', default=1, type=int, help='Number of runs of each point')
+    p.add_argument('-o', '--output', default=results_file, help='JSON file where results are appended')
+    p.add_argument('--store', help='Also file the runs in this results store directory')
+    p.add_argument('--sample-interval', default=0.1, type=float, help='Interval [s] between memory and CPU samples')
+    p.add_argument('--no-graph-stats', action='store_true', help='Do not record the size and depth of the task graph')
+    add_output_arguments(p)
+    add_cache_arguments(p)
+    p.add_argument('--cache-intermediates', action='store_true',
+                   help='Cache the intermediate results experiments mark as reusable')
+    add_profile_arguments(p)
+    add_validation_arguments(p)
+    utils.add_data_arguments(p)
+    add_family_arguments(p)
+
+    p = sub.add_parser('writebench', help='Compute an experiment once and time writing its output with each backend')
+    p.add_argument('exps', nargs=1, help='Experiment as family.exp')
+    p.add_argument('--backends', nargs='+', default=list(writers.backends), choices=list(writers.backends),
+                   help='Output backends to time, all by default')
+    p.add_argument('-r', '--repeat', default=3, type=int, help='Number of writes with each backend')
+    p.add_argument('--keep', action='store_true', help='Keep the written outputs')
+    p.add_argument('-o', '--output', default=results_file, help='JSON file where results are appended')
+    p.add_argument('--store', help='Also file the results in this results store directory')
+    utils.add_client_arguments(p)
+    utils.add_data_arguments(p)
+    add_family_arguments(p)
+
+    p = sub.add_parser('cache', help='List the cache entries, or evict the least recently used ones')
+    p.add_argument('--evict', metavar='SIZE', help='Evict entries until the cache is under this size, e.g. 10GB')
+    p.add_argument('--cache', default=cache.default_dir, help='Cache directory')
+
+    p = sub.add_parser('scaling', help='Scaling curves of a recorded sweep')
+    p.add_argument('sweep', nargs='?', help='Sweep id, the latest one by default')
+    p.add_argument('-o', '--output', default=results_file, help='JSON results file')
+
+    p = sub.add_parser('show', help='Print the recorded results side by side')
+    p.add_argument('exps', nargs='*', help='Only show these experiments (wildcards allowed)')
+    p.add_argument('-o', '--output', default=results_file, help='JSON results file')
+
+    p = sub.add_parser('hotspots', help='Print the top functions of the profiles of recorded runs')
+    p.add_argument('exps', nargs='*', help='Only show these experiments (wildcards allowed)')
+    p.add_argument('-o', '--output', default=results_file, help='JSON results file')
+    p.add_argument('-t', '--top', default=10, type=int, help='Number of functions per run')
+
+    p = sub.add_parser('store', help='File results in the store, keyed by versions and machine, or list its entries')
+    p.add_argument('files', nargs='*', help='Harness results or pyperf JSON files to add')
+    p.add_argument('--set', nargs='*', default=[], metavar='MODULE=VERSION',
+                   help='Versions to record for these files, e.g. for pyperf files without version metadata')
+    p.add_argument('--store', default=store.default_store, help='Results store directory')
+
+    p = sub.add_parser('compare', help='Compare two stored runs, exits with 1 on regressions')
+    p.add_argument('ref', help='Reference: store entry (name, unique part of it or latest~n) or JSON file')
+    p.add_argument('new', nargs='?', default='latest', help='New results, same as ref. Defaults to the latest entry')
+    p.add_argument('--metric', default='wall_time', choices=['wall_time', 'peak_rss', 'open_time'],
+                   help='Metric to compare')
+    p.add_argument('-t', '--threshold', default=0.05, type=float,
+                   help='Relative increase of a significant change above which it is a regression')
+    p.add_argument('--store', default=store.default_store, help='Results store directory')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+
+    if args.command == 'list':
+        for name in registry():
+            print(name)
+
+    elif args.command == 'gendata':
+        module = load_family(args.family)
+        c = utils.make_client(args)
+        manifest, status = ensure_data(module, utils.parse_sizes(args.chunk_size or module.default_sizes), args)
+        print(f'Test data {manifest["key"]}: {status}')
+        if c is not None:
+            c.close()
+
+    elif args.command == 'plot':
+        module = load_family(args.family)
+        utils.plot_mprofiles(args.files, list(module.all_exps.keys()), module.plot_title)
+
+    elif args.command == 'memplot':
+        sampler.plot(filter_runs(args), title='Memory usage of the main process and dask workers')
+
+    elif args.command == 'run':
+        return run(args)
+
+    elif args.command == 'precision':
+        return precision(args)
+
+    elif args.command == 'fused':
+        return fused(args)
+
+    elif args.command == 'exec':
+        result = run_one(args.exps[0], args)
+        if args.result:
+            with open(args.result, 'w') as f:
+                json.dump(result, f)
+        else:
+            utils.append_results(args.output, [result])
+
+    elif args.command == 'show':
+        return show(args)
+
+    elif args.command == 'hotspots':
+        return hotspots(args)
+
+    elif args.command == 'cache':
+        if args.evict:
+            cache.evict(args.cache, args.evict)
+        for meta in cache.entries(args.cache):
+            print(f'{meta["key"]} {meta["kind"]:28s} {meta["size"] / 2**20:10.1f} MiB {meta["hits"]:5d} hits  '
+                  f'{dt.datetime.fromtimestamp(meta["last_used"]).isoformat(timespec="seconds")}  '
+                  f'{json.dumps(meta["params"])}')
+
+    elif args.command == 'writebench':
+        return write_bench(args)
+
+    elif args.command == 'sweep':
+        return run_sweep(args)
+
+    elif args.command == 'scaling':
+        runs = [run for run in utils.load_results(args.output)['runs'] if 'sweep' in run]
+        if not runs:
+            print('No sweep results, record some with sweep first')
+            return 1
+        sweep_id = args.sweep or max(run['sweep']['id'] for run in runs)
+        runs = [run for run in runs if run['sweep']['id'] == sweep_id]
+        if not runs:
+            print(f'No results for sweep {sweep_id}')
+            return 1
+        scaling(runs, runs[0]['sweep']['mode'], f'scaling_{runs[0]["sweep"]["mode"]}_{sweep_id}.png')
+
+    elif args.command == 'store':
+        if not args.files:
+            for name in store.entries(args.store):
+                print(name)
+        versions = dict(item.split('=', 1) for item in args.set)
+        for file in args.files:
+            for name in store.add(store.load_runs(file, versions), args.store):
+                print(f'{file} -> {name}')
+
+    elif args.command == 'compare':
+        ref = store.resolve(args.ref, args.store)
+        new = store.resolve(args.new, args.store)
+        print(f'Comparing {new} to {ref}')
+        rows = store.compare(store.load_runs(ref), store.load_runs(new), args.metric, args.threshold)
+        store.report(rows, args.metric)
+        return 1 if any(row['regression'] for row in rows) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+# Annual aggregation benchmarks, resample against reshape
+# pyperf suite of tx_mean and growing season length over long daily series, 50 and 99 years by
+# default, on the CMIP-like files of bench_indicators.py with a noleap or standard calendar.
+# `xclim` runs the xclim indices, built on resample(time='YS'). `reshape` runs the NumPy kernels of
+# annual.aggregate, which reduces all years of a chunk at once when the years have a fixed length
+# and falls back to resample otherwise. `resample` runs the same kernels, always through resample.
+# `--check` compares the outputs of the engines instead of timing them.
+import os
+import json
+import numpy as np
+import xarray as xr
+import pyperf as perf
+import xclim as xc
+import utils
+import annual
+import bench_gsl
+import bench_indicators as bi
+default_sizes = ['50 16 16', '99 16 16']
+default_chunks = ['365 -1 -1', '3650 -1 -1']
+agreement_file = 'annual_agreement.json'
+# The data of bench_indicators is in K
+gsl_thresh = 273.15 + 5
+# Input variable, xclim index and the index through annual.aggregate
+indicators = {
+    'TX': ('tasmax', lambda da: xc.indices.tx_mean(da, freq='YS'),
+           lambda da, reshape: annual.aggregate(da, np.nanmean, reshape=reshape)),
+    'GSL': ('tas', lambda da: xc.indices.growing_season_length(da, thresh='5.0 degC', window=6, freq='YS'),
+            lambda da, reshape: bench_gsl.gsl_annual(da, window=6, thresh=gsl_thresh, reshape=reshape)),
+}
+engines = ['xclim', 'resample', 'reshape']
+
+
+def annual_index(name, engine, size, chunks, calendar, out_file):
+    var, xclim_func, func = indicators[name]
+    ds = xr.open_mfdataset(bi.files(size, var, calendar), combine='by_coords',
+                           chunks={dim: c for dim, c in zip(('time', 'lat', 'lon'), chunks)})
+    out = xclim_func(ds[var]) if engine == 'xclim' else func(ds[var], reshape=engine == 'reshape')
+    out.rename(name).to_netcdf(out_file)
+
+
+def _compare(out, ref, rtol):
+    both = np.isfinite(out.values) & np.isfinite(ref.values)
+    diff = np.abs(out.values - ref.values)[both]
+    row = {'max_abs_diff': float(diff.max()) if diff.size else 0.,
+           'nan_mismatch': int((np.isfinite(out.values) != np.isfinite(ref.values)).sum()),
+           'same_years': bool((out.time.values == ref.time.values).all())}
+    row['agree'] = bool(row['same_years'] and row['nan_mismatch'] == 0
+                        and np.allclose(out.values[both], ref.values[both], rtol=rtol))
+    return row
+
+
+def check(names, sizes, chunks, calendars, rtol=1e-5):
+    """Compute each indicator with every engine and compare reshape with resample and with xclim."""
+    rows = []
+    for calendar in calendars:
+        for size in sizes:
+            for name in names:
+                with xr.open_mfdataset(bi.files(size, indicators[name][0], calendar), combine='by_coords') as ds:
+                    reshaped = annual.year_length(ds.time) is not None
+                outs = {engine: f'check_{engine}_{name}.nc' for engine in engines}
+                for engine, out in outs.items():
+                    annual_index(name, engine, size, chunks, calendar, out)
+                row = {'indicator': name, 'size': bi.size_name(size), 'calendar': calendar, 'reshaped': reshaped}
+                with xr.open_dataset(outs['reshape']) as dsa:
+                    a = dsa[name].astype('float64')
+                    for ref in ['resample', 'xclim']:
+                        with xr.open_dataset(outs[ref]) as dsr:
+                            row[ref] = _compare(a, dsr[name].astype('float64').transpose(*a.dims), rtol)
+                for out in outs.values():
+                    os.remove(out)
+                print(f'{name:4s} {row["size"]:>10s} {calendar:>9s} {"reshaped" if reshaped else "resampled"}: '
+                      + ', '.join(f'against {ref} max abs diff {row[ref]["max_abs_diff"]:.3g}, NaN mismatches '
+                                  f'{row[ref]["nan_mismatch"]} {"ok" if row[ref]["agree"] else "DIFFER"}'
+                                  for ref in ['resample', 'xclim']))
+                rows.append(row)
+    with open(agreement_file, 'w') as f:
+        json.dump({'versions': utils.versions(), 'rtol': rtol, 'results': rows}, f, indent=1)
+    print(f'Saved {agreement_file}')
+    return rows
+
+
+def add_arguments(parser):
+    parser.add_argument('--indicators', nargs='+', default=list(indicators), choices=list(indicators),
+                        help='Indicators to benchmark')
+    parser.add_argument('--engines', nargs='+', default=engines, choices=engines)
+    parser.add_argument('--sizes', nargs='+', default=default_sizes,
+                        help='Data sizes, each as quoted "years lat lon"')
+    parser.add_argument('--chunks', nargs='+', default=default_chunks,
+                        help='dask chunkings, each as quoted "time lat lon" chunk sizes, -1 for no chunking')
+    parser.add_argument('--calendars', nargs='+', default=['noleap', 'standard'],
+                        choices=['standard', 'noleap', 'all_leap', '360_day'],
+                        help='Calendars of the test data, reshape falls back to resample for the standard one')
+    parser.add_argument('--seed', default=0, type=int, help='Seed of the generated test data')
+    parser.add_argument('--check', action='store_true',
+                        help='Compare the outputs of both engines instead of benchmarking, with the first chunking')
+
+
+def add_cmdline_args(cmd, args):
+    # pyperf workers only get pyperf's own options, forward ours
+    cmd.extend(['--indicators', *args.indicators, '--engines', *args.engines, '--sizes', *args.sizes,
+                '--chunks', *args.chunks, '--calendars', *args.calendars, '--seed', str(args.seed)])
+
+
+if __name__ == '__main__':
+    runner = perf.Runner(add_cmdline_args=add_cmdline_args)
+    add_arguments(runner.argparser)
+    args = runner.parse_args()
+    sizes = [utils.parse_sizes(size.split()) for size in args.sizes]
+    chunks = [utils.parse_sizes(c.split()) for c in args.chunks]
+    for mod, version in utils.versions().items():
+        runner.metadata[f'{mod}_version'] = str(version)
+
+    if not args.worker:
+        for calendar in args.calendars:
+            for size in sizes:
+                if not all(bi.files(size, var, calendar) for var in bi.variables):
+                    print(f'Generating {bi.size_name(size)} data with the {calendar} calendar')
+                    bi.gendata(size, args.seed, calendar)
+
+    if args.check:
+        check(args.indicators, sizes, chunks[0], args.calendars)
+    else:
+        for calendar in args.calendars:
+            for size in sizes:
+                for name in args.indicators:
+                    for engine in args.engines:
+                        for chunk in chunks:
+                            runner.bench_func(f'{engine}_{name}_{bi.size_name(size)}_{calendar}_chunks{bi.size_name(chunk)}',
+                                              annual_index, name, engine, size, chunk, calendar, f'{engine}_{name}.nc')
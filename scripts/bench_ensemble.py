@@ -1,30 +1,36 @@
 # Ensemble percentile benchmarks
 # Comparing different implementation
+import re
+import sys
 import glob
-import argparse
+import json
+import time
+import inspect
 from xclim import ensembles as xcens
 import numpy as np
 import xarray as xr
-import datetime as dt
-from distributed import Client
+import dask.array as da
+from dask.utils import parse_bytes
+import utils
+import sketch
+import quantiles
+import cache
+import synthetic
+import mfindex
+import tiles
+import nanindex
+family = 'ensemble'
 testfile = 'testdata_r{r}_i{i}.nc'
+zarrstore = 'testdata_r.zarr'
 outfile = 'testout_{}.nc'
-
-
-def read_mprofile(filename):
-    times = []
-    mem = []
-    name = filename.split('.')[0]
-    with open(filename, 'r') as f:
-        for line in f:
-            if line.startswith('CMDLINE'):
-                name = line.strip().split()[-1]
-            elif line.startswith('MEM'):
-                _, m, t = line.strip().split()
-                times.append(dt.datetime.fromtimestamp(float(t)))
-                mem.append(float(m))
-    times = [(t - times[0]).total_seconds() for t in times]
-    return name, times, mem
+default_sizes = [300, 100, 100, 10, 10]
+plot_title = 'Memory usage of different percentile calculations'
+percentiles = [10, 50, 90]
+options = ['sketch_error', 'tile_mem']
+# Outputs are validated against this experiment
+reference = 'xcdef'
+# Approximate experiments, validated by the rank error of their percentiles instead, see check_approximate
+approximate = ['sketch']
 
 
 def exp_xcdef(ds, percentiles):
@@ -51,6 +57,43 @@ def _calc_nanperc(arr, p=50):
     return np.nanpercentile(arr, p, axis=-1)
 
 
+def _calc_percs(arr, ps=(50,)):
+    # Sort once for all percentiles, NaNs go to the end. Returns the percentiles along a new last axis.
+    nan_count = np.isnan(arr).sum(axis=-1)
+    arr = np.sort(arr, axis=-1)
+    n = arr.shape[-1]
+    out = np.empty(arr.shape[:-1] + (len(ps),), dtype=arr.dtype)
+    for k, p in enumerate(ps):
+        # Same linear interpolation as np.percentile, the positions are the same for all cells
+        pos = (n - 1) * p / 100
+        lo = int(np.floor(pos))
+        hi = min(lo + 1, n - 1)
+        out[..., k] = arr[..., lo] + (arr[..., hi] - arr[..., lo]) * (pos - lo)
+
+    nans = nan_count > 0
+    if np.any(nans):
+        # only compute per-cell positions where we need it, on the valid values at the start of each vector
+        nan_index = np.where(nans)
+        sub = arr[nan_index]
+        valid = n - nan_count[nan_index]
+        for k, p in enumerate(ps):
+            pos = (valid - 1) * p / 100
+            lo = np.floor(pos).astype(int).clip(0)
+            hi = np.minimum(lo + 1, valid - 1).clip(0)
+            vlo = np.take_along_axis(sub, lo[:, np.newaxis], axis=-1)[:, 0]
+            vhi = np.take_along_axis(sub, hi[:, np.newaxis], axis=-1)[:, 0]
+            res = vlo + (vhi - vlo) * (pos - lo)
+            res[valid == 0] = np.nan
+            out[nan_index + (k,)] = res
+
+    return out
+
+
+def _select_percs(arr, ps=(50,)):
+    # Partition based selection of the needed order statistics instead of a full sort
+    return quantiles.nanquantiles(arr, [p / 100 for p in ps])
+
+
 def ensemble_percs(ds, ps):
     ds_out = ds.drop_vars(ds.data_vars)
     for v in ds.data_vars:
@@ -101,14 +144,19 @@ def ensemble_nanpercs(ds, ps):
     return ds_out
 
 
+def _rechunk_realizations(arr):
+    chunks = dict(zip(arr.dims, arr.chunks))
+    return arr.chunk({'realization': -1, 'time': len(chunks['time']) * len(chunks['realization'])})
+
+
 def ensemble_percs_rechunk(ds, ps):
     ds_out = ds.drop_vars(ds.data_vars)
     for v in ds.data_vars:
+        if len(ds.chunks.get('realization', [])) > 1:
+            var = cache.intermediate(f'ensemble_rechunked_{v}', {'var': v}, _rechunk_realizations, ds[v])
+        else:
+            var = ds[v]
         for p in ps:
-            if len(ds.chunks.get('realization', [])) > 1:
-                var = ds[v].chunk({'realization': -1, 'time': len(ds.chunks['time']) * len(ds.chunks['realization'])})
-            else:
-                var = ds[v]
             perc = xr.apply_ufunc(
                 _calc_perc,
                 var,
@@ -161,6 +209,157 @@ def ensemble_percs_smartrechunk(ds, ps):
     return ds_out
 
 
+def _block_candidates(size, chunk):
+    """Block sizes along a dimension: whole multiples of the chunks, or a chunk split into k blocks."""
+    splits = {-(-chunk // k) for k in range(1, chunk + 1)}
+    nchunks = -(-size // chunk)
+    multiples = {min(size, -(-nchunks // n) * chunk) for n in range(1, nchunks + 1)}
+    return np.array(sorted(splits | multiples))
+
+
+def plan_rechunk(chunks, itemsize, nthreads, max_mem, nworkers=1, overhead=3):
+    """Target chunks for a reduction over the whole realization axis, under a memory budget.
+
+    `max_mem` is the memory limit of each worker, as `-m`, and the budget of each task is that
+    limit shared by the `nthreads` threads of a worker. A task holds the full realization axis of
+    its block, times `overhead` for the copies made by the kernel (sort, NaN mask). Blocks are
+    whole multiples of the current chunks or splits of them. Of all the combinations under the
+    budget, the plan has the fewest tasks, but not fewer than the threads of all `nworkers`
+    workers, or as many as possible when the data is too small for them, and then the smallest blocks.
+    """
+    budget = parse_bytes(max_mem) / nthreads if isinstance(max_mem, str) else max_mem / nthreads
+    nreal = sum(chunks['realization'])
+    dims = [dim for dim in chunks if dim != 'realization']
+    sizes = {dim: sum(chunks[dim]) for dim in dims}
+    max_cells = max(int(budget // (nreal * itemsize * overhead)), 1)
+    min_tasks = nworkers * nthreads
+
+    grids = np.meshgrid(*[_block_candidates(sizes[dim], max(chunks[dim])) for dim in dims], indexing='ij')
+    cells = np.prod(grids, axis=0)
+    ntasks = np.prod([-(-sizes[dim] // grid) for dim, grid in zip(dims, grids)], axis=0)
+    ok = cells <= max_cells
+    if not ok.any():
+        # Too large even with the smallest blocks
+        ok = cells == cells.min()
+    # Fewest tasks that keep every thread busy, then the smallest blocks
+    short = np.maximum(min_tasks - ntasks[ok], 0)
+    best = np.lexsort((cells[ok], ntasks[ok], short))[0]
+    target = {dim: int(grid[ok][best]) for dim, grid in zip(dims, grids)}
+
+    plan = {'chunks': dict(target, realization=-1), 'ntasks': int(ntasks[ok][best]),
+            'task_bytes': int(cells[ok][best]) * nreal * itemsize * overhead, 'budget': budget}
+    return plan
+
+
+def ensemble_percs_planned(ds, ps, max_mem='2GB', nthreads=10, nworkers=1):
+    ds_out = ds.drop_vars(ds.data_vars)
+    for v in ds.data_vars:
+        if len(ds.chunks.get('realization', [])) > 1:
+            plan = plan_rechunk(dict(zip(ds[v].dims, ds[v].chunks)),
+                                ds[v].dtype.itemsize, nthreads, max_mem, nworkers)
+            print(f"Rechunking {v} from {dict(ds.chunks)} to {plan['chunks']}: {plan['ntasks']} tasks of "
+                  f"{plan['task_bytes'] / 2**20:.0f} MiB for a budget of {plan['budget'] / 2**20:.0f} MiB per task")
+            var = ds[v].chunk(plan['chunks'])
+        else:
+            var = ds[v]
+        for p in ps:
+            perc = xr.apply_ufunc(
+                _calc_perc,
+                var,
+                input_core_dims=[['realization']],
+                output_core_dims=[[]],
+                keep_attrs=True,
+                kwargs=dict(p=p),
+                dask='parallelized',
+                output_dtypes=[ds[v].dtype]
+            )
+
+            perc.name = v + f'_{p:02d}'
+            perc.attrs.update(description=f'{p:02d}th percentile of ensemble')
+            ds_out[perc.name] = perc
+    return ds_out
+
+
+def ensemble_percs_multi(ds, ps, kernel=_calc_percs):
+    ds_out = ds.drop_vars(ds.data_vars)
+    for v in ds.data_vars:
+        if len(ds.chunks.get('realization', [])) > 1:
+            var = ds[v].chunk({'realization': -1})
+        else:
+            var = ds[v]
+        perc = xr.apply_ufunc(
+            kernel,
+            var,
+            input_core_dims=[['realization']],
+            output_core_dims=[['percentiles']],
+            keep_attrs=True,
+            kwargs=dict(ps=tuple(ps)),
+            dask='parallelized',
+            output_dtypes=[ds[v].dtype],
+            output_sizes={'percentiles': len(ps)}
+        )
+
+        perc.attrs.update(description='Percentiles of ensemble')
+        ds_out[v] = perc.assign_coords(percentiles=list(ps))
+    return ds_out
+
+
+def _fill_percs(arr, ps=(50,)):
+    return np.full(arr.shape[:-1] + (len(ps),), np.nan, dtype=arr.dtype)
+
+
+def ensemble_percs_nansummary(ds, ps):
+    # Blocks without NaNs skip the NaN check and grouping of the selection kernel, see nanindex.py
+    qs = [p / 100 for p in ps]
+    kernels = {'none': lambda arr: quantiles.quantiles(arr, qs, nan_check=False),
+               'some': lambda arr: quantiles.nanquantiles(arr, qs),
+               'all': lambda arr: _fill_percs(arr, ps)}
+    ds_out = ds.drop_vars(ds.data_vars)
+    for v in ds.data_vars:
+        var = ds[v].chunk({'realization': -1}) if len(ds.chunks.get('realization', [])) > 1 else ds[v]
+        var = var.transpose(..., 'realization')
+        arr = var.data
+        perc = da.map_blocks(nanindex.dispatch, arr, kernels=kernels, states=nanindex.get(arr, testfile),
+                             dtype=arr.dtype, chunks=arr.chunks[:-1] + ((len(ps),),))
+        ds_out[v] = xr.DataArray(perc, dims=var.dims[:-1] + ('percentiles',), attrs=var.attrs)
+        ds_out[v].attrs.update(description='Percentiles of ensemble')
+    return ds_out.assign_coords(percentiles=list(ps))
+
+
+def ensemble_percs_sketch(ds, ps, error=0.01):
+    ds_out = ds.drop_vars(ds.data_vars)
+    for v in ds.data_vars:
+        # No rechunk: each realization chunk is sketched on its own and the sketches are merged
+        perc = xr.apply_ufunc(
+            lambda arr: sketch.sketch_percentiles(da.asarray(arr), ps, error=error),
+            ds[v],
+            input_core_dims=[['realization']],
+            output_core_dims=[['percentiles']],
+            keep_attrs=True,
+            dask='allowed'
+        )
+
+        perc.attrs.update(description=f'Approximate percentiles of ensemble, rank error {error}')
+        ds_out[v] = perc.assign_coords(percentiles=list(ps))
+    return ds_out
+
+
+def ensemble_percs_tiles(ds, ps, tile_mem='256MB'):
+    # Straight from the netCDF files, the dask arrays of ds are only used for the coordinates
+    groups = file_groups()
+    if not groups:
+        raise FileNotFoundError(f'exp tiles reads the netCDF test data {testfile}, generate it with --format netcdf')
+    index = mfindex.get(groups, mfindex.index_path(testfile))
+    ds_out = ds.drop_vars(ds.data_vars)
+    for v in ds.data_vars:
+        out, tile = tiles.reduce(index, v, lambda block: _select_percs(block, ps), len(ps), parse_bytes(tile_mem))
+        print(f'Streamed {v} in tiles of {tile}, output of {out.nbytes / 2**20:.0f} MiB')
+        dims = [dim for dim in ds[v].dims if dim != 'realization']
+        ds_out[v] = xr.DataArray(out, dims=dims + ['percentiles'], attrs=ds[v].attrs)
+        ds_out[v].attrs.update(description='Percentiles of ensemble')
+    return ds_out.assign_coords(percentiles=list(ps))
+
+
 def exp_xrapply(ds, percentiles):
     return ensemble_percs(ds, percentiles)
 
@@ -177,6 +376,30 @@ def exp_xrapplyrechunksmart(ds, percentiles):
     return ensemble_percs_smartrechunk(ds, percentiles)
 
 
+def exp_xrapplyplanned(ds, percentiles, max_mem='2GB', nthreads=10, nworkers=1):
+    return ensemble_percs_planned(ds, percentiles, max_mem=max_mem, nthreads=nthreads, nworkers=nworkers)
+
+
+def exp_xrapplymulti(ds, percentiles):
+    return ensemble_percs_multi(ds, percentiles)
+
+
+def exp_xrapplyselect(ds, percentiles):
+    return ensemble_percs_multi(ds, percentiles, kernel=_select_percs)
+
+
+def exp_xrapplynan(ds, percentiles):
+    return ensemble_percs_nansummary(ds, percentiles)
+
+
+def exp_tiles(ds, percentiles, tile_mem='256MB'):
+    return ensemble_percs_tiles(ds, percentiles, tile_mem=tile_mem)
+
+
+def exp_sketch(ds, percentiles, sketch_error=0.01):
+    return ensemble_percs_sketch(ds, percentiles, error=sketch_error)
+
+
 def exp_xrrednan(ds, percentiles):
     ds_out = ds.drop_vars(ds.data_vars)
     for v in ds.data_vars:
@@ -194,93 +417,158 @@ def exp_xrquantile(ds, percentiles):
     return ds.quantile([p / 100 for p in percentiles], dim='realization', keep_attrs=True)
 
 
-all_exps = {name.split('_')[1]: func for name, func in globals().items() if name.startswith('exp')}
-
-
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Profile memory for rolling functions')
-    parser.add_argument('-c', '--with-client', action='store_true', help='whether to use a dask client')
-    parser.add_argument('-N', '--nthreads', default=10, type=int, help='When using a dask client, number of threads per worker')
-    parser.add_argument('-m', '--max-mem', default='2GB', help='When using a dask client, memory limit')
-    parser.add_argument('exp', type=str, help='which exp to run')
-    parser.add_argument('-i', '--files', default='*.dat', nargs='*', help='Dat files to plot')
-    parser.add_argument('-n', '--chunk-size', default=[300, 100, 100, 10, 10], nargs='*', help='Size of the random data to generate. 1, 2, 3, 4 or 5 values for t, x, y, nchunks and nensemble.')
-    args = parser.parse_args()
+all_exps = utils.find_exps(globals())
+
+
+def gendata(sizes, seed=0, fmt='netcdf', dtype='float64'):
+    if len(sizes) == 1:
+        Nt = Nx = Ny = sizes[0]
+        Nc = 20
+        Nr = 10
+    elif len(sizes) == 2:
+        Nt, Nc = sizes
+        Ny = Nx = Nt
+        Nr = 10
+    elif len(sizes) == 3:
+        Nt, Nc, Nr = sizes
+        Ny = Nx = Nt
+    elif len(sizes) == 4:
+        Nt, Nx, Nc, Nr = sizes
+        Ny = Nx
+    else:
+        Nt, Nx, Ny, Nc, Nr = sizes
+
+    print(f'Generating data: {Nr} realizations of {Nc} chunks of {Nt}x{Nx}x{Ny}')
+    data = synthetic.random_field(((1,) * Nr, (Nt,) * Nc, (Nx,), (Ny,)), seed=seed, nan_at=(0, 0, 0, 0), dtype=dtype)
+    ds = xr.Dataset({'data': (('realization', 'time', 'x', 'y'), data)},
+                    coords={'time': np.arange(Nc * Nt), 'x': np.arange(Nx), 'y': np.arange(Ny)})
+    ds.time.attrs.update(axis='T', units='days since 2000-01-01 00:00:00',
+                         long_name='time', calendar='noleap')
+    if fmt == 'zarr':
+        ds = ds.assign_coords(realization=np.arange(Nr))
+    synthetic.write(ds, fmt, testfile.format(r='{realization}', i='{time}'), zarrstore,
+                    dims=('realization', 'time'))
+
+
+def file_groups():
+    num_real = len(glob.glob(testfile.format(r='*', i=0)))
+    return [glob.glob(testfile.format(r=r, i='*')) for r in range(num_real)]
+
+
+def open_data(args):
+    if args.format == 'zarr':
+        return xr.open_zarr(zarrstore)
+    if args.index:
+        return mfindex.open_dataset(file_groups(), mfindex.index_path(testfile))
+    return xcens.create_ensemble(file_groups(),
+                                 mf_flag=True,
+                                 combine='by_coords')
+
+
+def add_arguments(parser):
+    parser.add_argument('--sketch-error', default=0.01, type=float,
+                        help='Target rank error of the approximate percentiles of exp sketch, see sketch.py')
+    parser.add_argument('--tile-mem', default='256MB',
+                        help='Memory budget of each tile of exp tiles, all realizations and times included')
+
+
+def sketch_accuracy(ds, ps, errors=(0.1, 0.05, 0.01, 0.005)):
+    """Compare the approximate percentiles of exp_sketch with exp_xrquantile for several target errors.
+
+    The rank error of the approximate percentiles is measured against the values of the
+    realizations, and errors above the target are flagged.
+    """
+    ref = exp_xrquantile(ds, ps).compute()
+    report = []
+    for error in errors:
+        t0 = time.perf_counter()
+        approx = exp_sketch(ds, ps, sketch_error=error).compute()
+        elapsed = time.perf_counter() - t0
+        for v in ds.data_vars:
+            r = ref[v].rename(quantile='percentiles').assign_coords(percentiles=list(ps))
+            a = approx[v].transpose(*r.dims)
+            spread = ds[v].max('realization') - ds[v].min('realization')
+            diff = abs(a - r)
+            others = [dim for dim in r.dims if dim != 'percentiles']
+            rank = sketch.rank_error(ds[v].transpose(*others, 'realization').values,
+                                     a.transpose(*others, 'percentiles').values, ps)
+            report.append({'variable': v, 'error': error, 'time': elapsed,
+                           'max_abs': float(diff.max()), 'mean_abs': float(diff.mean()),
+                           'max_rel_spread': float((diff / spread).max()),
+                           'max_rank_error': rank, 'exceeded': rank > error,
+                           'nan_mask_equal': bool((a.isnull() == r.isnull()).all())})
+            print(f"{v} error={error}: max |diff| {report[-1]['max_abs']:.4g}, mean |diff| {report[-1]['mean_abs']:.4g}, "
+                  f"max |diff| / spread {report[-1]['max_rel_spread']:.4g}, max rank error {rank:.4g}"
+                  f"{' EXCEEDS THE TARGET' if rank > error else ''}, same NaNs: {report[-1]['nan_mask_equal']}, "
+                  f"{elapsed:.2f} s")
+    return report
+
+
+def run_exp(name, data, args):
+    func = all_exps[name]
+    # Experiments get the client settings and options they ask for
+    params = inspect.signature(func).parameters
+    kwargs = {k: v for k, v in [('max_mem', args.max_mem), ('nthreads', args.nthreads), ('nworkers', args.nworkers),
+                                ('sketch_error', args.sketch_error), ('tile_mem', args.tile_mem)] if k in params}
+    return func(data, percentiles, **kwargs)
+
+
+def canonical(ds):
+    """Percentiles of each variable along a `percentiles` dimension, whatever the layout of the output.
+
+    Outputs have a percentiles or quantile dimension, or one variable per percentile named as
+    `data_10` or, as xclim does, `data_p10`.
+    """
+    out, parts = {}, {}
+    for name, var in ds.data_vars.items():
+        if 'quantile' in var.dims:
+            ps = np.round(var['quantile'].values * 100).astype(int)
+            var = var.rename(quantile='percentiles').assign_coords(percentiles=ps)
+        if 'percentiles' in var.dims:
+            out[name] = var
+            continue
+        match = re.fullmatch(r'(.+)_p?(\d+)', name)
+        if match:
+            parts.setdefault(match[1], []).append(var.expand_dims(percentiles=[int(match[2])]))
+    for name, pieces in parts.items():
+        out[name] = xr.concat(pieces, 'percentiles').sortby('percentiles')
+    return out
 
-    if args.exp == 'gendata':
-        if isinstance(args.chunk_size, list):
-            if len(args.chunk_size) == 2:
-                Nt, Nc = map(int, args.chunk_size)
-                Ny = Nx = Nt
-                Nr = 10
-            elif len(args.chunk_size) == 3:
-                Nt, Nc = map(int, args.chunk_size)
-                Ny = Nx = Nt
-            elif len(args.chunk_size) == 4:
-                Nt, Nx, Nc, Nr = map(int, args.chunk_size)
-                Ny = Nx
-            else:
-                Nt, Nx, Ny, Nc, Nr = map(int, args.chunk_size)
-        else:
-            Nt = Nx = Ny = int(args.chunk_size)
-            Nc = 20
-
-        times = np.arange(Nc * Nt)
-        for r in range(Nr):
-            for i in range(Nc):
-                print(f'Generating data {r * Nc + i + 1:02d}/{Nc * Nr}')
-                data = xr.DataArray(data=np.random.random((Nt, Nx, Ny)),
-                                    dims=('time', 'x', 'y'),
-                                    coords={'time': times[Nt * i:Nt * (i + 1)],
-                                            'x': np.arange(Nx), 'y': np.arange(Ny)},
-                                    name='data')
-                data[0, 0, 0] = np.nan
-                data.time.attrs.update(axis='T', units='days since 2000-01-01 00:00:00',
-                                       long_name='time', calendar='noleap')
-                data.to_netcdf(testfile.format(r=r, i=i))
-
-    elif args.exp == 'plot':
-        import matplotlib.pyplot as plt
-        try:
-            plt.style.use('dark_background')
-        except OSError:
-            pass
-        if not isinstance(args.files, list):
-            if '*' in args.files:
-                files = glob.glob(args.files)
-            else:
-                files = [args.files]
-        else:
-            files = args.files
-        colors = {exp: col for exp, col in zip(all_exps.keys(),
-                                               plt.matplotlib.rcParams['axes.prop_cycle'].by_key()['color'])}
-        fig, ax = plt.subplots(figsize=(10, 5))
-        for file in files:
-            name, times, mem = read_mprofile(file)
-            ax.plot(times, mem, label=name, color=colors[name])
-        ax.legend()
-        ax.set_xlabel('Computation time [s]')
-        ax.set_ylabel('Memory usage [MiB]')
-        ax.set_title('Memory usage of different percentile calculations')
-        plt.show()
 
-    else:
-        if args.with_client:
-            c = Client(n_workers=1, threads_per_worker=args.nthreads, memory_limit=args.max_mem)
+def check_approximate(exp, out, ds, args):
+    """Rank errors of the approximate percentiles of an output, per variable, see validate.py.
 
-        num_real = len(glob.glob(testfile.format(r='*', i=0)))
-        ds = xcens.create_ensemble([glob.glob(testfile.format(r=r, i='*')) for r in range(num_real)],
-                                   mf_flag=True,
-                                   combine='by_coords')
+    Each compression of the sketches adds up to about `--sketch-error` to the rank error, so a
+    variable passes when its rank error is within that times the compressions of the merge tree.
+    """
+    rows = {}
+    for name, var in canonical(out).items():
+        data = ds[name]
+        others = [dim for dim in var.dims if dim != 'percentiles']
+        nchunks = len(data.chunks[data.get_axis_num('realization')]) if data.chunks else 1
+        tolerance = args.sketch_error * sketch.merge_depth(nchunks)
+        rank = sketch.rank_error(data.transpose(*others, 'realization').values,
+                                 var.transpose(*others, 'percentiles').values, list(var['percentiles'].values))
+        rows[name] = {'max_rank_error': rank, 'rank_tolerance': tolerance, 'passed': rank <= tolerance}
+    return rows
 
-        print(f'Running rolling with exp: {args.exp}')
-        ds_out = all_exps[args.exp](ds, [10, 50, 90])
 
-        print('Writing to file')
+def output_name(name, args):
+    return outfile.format(name)
 
-        r = ds_out.to_netcdf(outfile.format(args.exp), compute=False)
-        r.compute()
-        ds_out.close()
 
-        if args.with_client:
+if __name__ == '__main__':
+    parser = utils.base_parser('Profile memory for ensemble percentile functions', default_sizes,
+                               'Size of the random data to generate. 1, 2, 3, 4 or 5 values for t, x, y, nchunks and nensemble.')
+    add_arguments(parser)
+    args = parser.parse_args()
+    if args.exp == 'accuracy':
+        # Accuracy of the approximate percentiles against exact ones, on the generated data
+        c = utils.make_client(args)
+        report = sketch_accuracy(open_data(args), percentiles, errors=sorted({0.1, 0.05, 0.01, 0.005, args.sketch_error}, reverse=True))
+        with open('sketch_accuracy.json', 'w') as f:
+            json.dump(report, f, indent=1)
+        if c is not None:
             c.close()
+    else:
+        utils.main(sys.modules[__name__], args)
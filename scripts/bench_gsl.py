@@ -1,38 +1,38 @@
 # Growing season length benchmarks
 # Comparing different implementations
+import sys
 import glob
-import argparse
 import numpy as np
 import xclim as xc
-import pandas as pd
 import xarray as xr
-import datetime as dt
+import dask.array as da
 from xclim import run_length as rl
-from distributed import Client
+import utils
+import synthetic
+import mfindex
+import cache
+import nanindex
+import annual
+import bench_rolling
+family = 'gsl'
 testfile = 'testdata_i{i}.nc'
+zarrstore = 'testdata_i.zarr'
 outfile = 'testout_{}.nc'
+default_sizes = [3, 100, 100, 1]
+plot_title = 'Memory usage of different growing season length calculations'
 window = 6
 thresh = 5
+# Outputs are validated against this experiment
+reference = 'xcdef'
+options = ['indicators']
 
 
-def read_mprofile(filename):
-    times = []
-    mem = []
-    name = filename.split('.')[0]
-    with open(filename, 'r') as f:
-        for line in f:
-            if line.startswith('CMDLINE'):
-                name = line.strip().split()[-1]
-            elif line.startswith('MEM'):
-                _, m, t = line.strip().split()
-                times.append(dt.datetime.fromtimestamp(float(t)))
-                mem.append(float(m))
-    times = [(t - times[0]).total_seconds() for t in times]
-    return name, times, mem
+def _rolled_count(tas):
+    return ((tas > thresh) * 1).rolling(time=window).sum(allow_lazy=True, skipna=False)
 
 
 def exp_smallchange(tas):
-    c = ((tas > thresh) * 1).rolling(time=window).sum(allow_lazy=True, skipna=False)
+    c = cache.intermediate('gsl_rolled_count', {'window': window, 'thresh': thresh}, _rolled_count, tas)
 
     def compute_gsl(c):
         nt = c.time.size
@@ -82,93 +82,252 @@ def exp_firstrunisel(tas):
     return tas.resample(time='YS').apply(func)
 
 
+def _gsl_year(tas, second_half, window, thresh):
+    # One year of data with time first. Length of the current run above (below) the threshold,
+    # from a forward max-scan of the index of the last day that broke it.
+    nt = tas.shape[0]
+    t = np.arange(nt).reshape((nt,) + (1,) * (tas.ndim - 1))
+    # Fused indicators pass the mask of days above the threshold they share instead
+    above = tas if tas.dtype == bool else tas > thresh
+    run_above = t - np.maximum.accumulate(np.where(above, -1, t), axis=0)
+    run_below = t - np.maximum.accumulate(np.where(above, t, -1), axis=0)
+    del above
+
+    # Same as xclim: the season starts with the first run above the threshold if it begins in the 1st half
+    # of the year, and ends with the first run below it beginning in the 2nd half, after the start.
+    # A season that does not end lasts until the end of the year, counted from the first day of its run, and
+    # a year without a season start has a length of 0, all-NaN years included.
+    mid = second_half.argmax() if second_half.any() else nt
+    start_ok = (run_above >= window) & (t - window + 1 < mid)
+    start = start_ok.argmax(axis=0)
+    has_start = start_ok.any(axis=0)
+    end_ok = (run_below >= window) & (t - window + 1 >= mid) & (t > start)
+    end = np.where(end_ok.any(axis=0), end_ok.argmax(axis=0), nt + window - 1)
+    return np.where(has_start, end - start, 0)
+
+
+def _out_dtype(tas):
+    return tas.dtype if tas.dtype.kind == 'f' else np.dtype('float64')
+
+
+def _gsl_block(tas, years, months, window=6, thresh=5):
+    # A block of whole years, `years` and `months` are broadcastable along time
+    years = years.ravel()
+    second_half = months.ravel() >= 7
+    # Lengths in days are exact in float32
+    return np.stack([_gsl_year(tas[years == y], second_half[years == y], window, thresh)
+                     for y in np.unique(years)]).astype(_out_dtype(tas), copy=False)
+
+
+def _gsl_fill(tas, years, months, window=6, thresh=5):
+    # No day is above the threshold in an all-NaN block, so no season starts
+    return np.zeros((np.unique(years).size,) + tas.shape[1:], dtype=_out_dtype(tas))
+
+
+def year_chunks(time, chunks):
+    """Time chunks made of whole years, about as long as the current ones, and the number of years in each."""
+    _, ndays = np.unique(time.dt.year.values, return_counts=True)
+    per_chunk = max(1, int(round(max(chunks) / ndays.mean())))
+    sizes = tuple(int(ndays[i:i + per_chunk].sum()) for i in range(0, ndays.size, per_chunk))
+    nyears = tuple(len(ndays[i:i + per_chunk]) for i in range(0, ndays.size, per_chunk))
+    return sizes, nyears
+
+
+def gsl_scan(tas, window=6, thresh=5, nan_summary=False):
+    """Growing season length from a single forward scan along time per year, vectorized over the grid.
+
+    Runs through map_blocks on year-aligned chunks, without groupby. Runs are measured by their last
+    day, as in xclim, but do not carry over from the previous year. As in xclim, a season that does
+    not end lasts until the end of the year and a year without a season start has a length of 0. With `nan_summary`, blocks with
+    only NaNs are filled without scanning them, see nanindex.py.
+    """
+    tas = tas.transpose('time', *[dim for dim in tas.dims if dim != 'time'])
+    if tas.chunks is None:
+        tas = tas.chunk()
+    sizes, nyears = year_chunks(tas.time, tas.chunks[0])
+    tas = tas.chunk({'time': sizes})
+    years = da.from_array(tas.time.dt.year.values, chunks=(sizes,))
+    months = da.from_array(tas.time.dt.month.values, chunks=(sizes,))
+    extra = (np.newaxis,) * (tas.ndim - 1)
+    kwargs = dict(window=window, thresh=thresh)
+    if nan_summary:
+        # The scan treats NaNs as below the threshold without masking them, there is no faster
+        # kernel for blocks without NaNs
+        kwargs.update(kernels={'none': _gsl_block, 'some': _gsl_block, 'all': _gsl_fill},
+                      states=nanindex.get(tas.data, testfile))
+    out = da.map_blocks(nanindex.dispatch if nan_summary else _gsl_block,
+                        tas.data, years[(slice(None),) + extra], months[(slice(None),) + extra],
+                        dtype=_out_dtype(tas), chunks=(nyears,) + tas.data.chunks[1:], **kwargs)
+
+    _, first = np.unique(tas.time.dt.year.values, return_index=True)
+    coords = {dim: tas[dim] for dim in tas.dims[1:] if dim in tas.coords}
+    return xr.DataArray(out, dims=tas.dims, coords=dict(coords, time=tas.time.values[first]), name=tas.name)
+
+
+def exp_scan(tas):
+    return gsl_scan(tas, window=window, thresh=thresh)
+
+
+def exp_scannan(tas):
+    return gsl_scan(tas, window=window, thresh=thresh, nan_summary=True)
+
+
+def _gsl_days(tas, axis, second_half, window=6, thresh=5):
+    # Days of a year along `axis`, any other dimensions, several years included
+    return _gsl_year(np.moveaxis(tas, axis, 0), second_half, window, thresh).astype(_out_dtype(tas), copy=False)
+
+
+def _second_half(time):
+    return {'second_half': time.dt.month.values >= 7}
+
+
+def gsl_annual(tas, window=6, thresh=5, reshape=True):
+    """Growing season length of each year through annual.aggregate, the same scan as gsl_scan.
+
+    With years of a fixed length, as with the noleap calendar of the generated data, all years of
+    a chunk are scanned at once. Otherwise each year goes through resample.
+    """
+    return annual.aggregate(tas, _gsl_days, year_kwargs=_second_half, dtype=_out_dtype(tas),
+                            reshape=reshape, window=window, thresh=thresh)
+
+
+def exp_annual(tas):
+    return gsl_annual(tas, window=window, thresh=thresh)
+
+
 def exp_xcdef(tas, window=6, thresh=5):
     return xc.indices.growing_season_length(tas)
 
 
-all_exps = {name.split('_')[1]: func for name, func in globals().items() if name.startswith('exp')}
+def _above(tas, shared):
+    # Days above the threshold, built once for all the indicators that need them
+    if 'above' not in shared:
+        shared['above'] = tas > thresh
+    return shared['above']
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Profile memory for rolling functions')
-    parser.add_argument('-c', '--with-client', action='store_true', help='whether to use a dask client')
-    parser.add_argument('-N', '--nthreads', default=10, type=int, help='When using a dask client, number of threads per worker')
-    parser.add_argument('-m', '--max-mem', default='2GB', help='When using a dask client, memory limit')
-    parser.add_argument('exp', type=str, help='which exp to run')
-    parser.add_argument('-i', '--files', default='*.dat', nargs='*', help='Dat files to plot')
-    parser.add_argument('-n', '--chunk-size', default=[3, 100, 100, 1], nargs='*', help='Size of the random data to generate. 1, 2, 3 or 4 values for t (n years), x, y and nchunks/yr. Data is daily.')
-    args = parser.parse_args()
-
-    if args.exp == 'gendata':
-        if isinstance(args.chunk_size, list):
-            if len(args.chunk_size) == 2:
-                Nt, Nc = map(int, args.chunk_size)
-                Ny = Nx = Nt
-            elif len(args.chunk_size) == 3:
-                Nt, Nx, Nc = map(int, args.chunk_size)
-                Ny = Nt
-            else:
-                Nt, Nx, Ny, Nc = map(int, args.chunk_size)
-        else:
-            Nt = Nx = Ny = int(args.chunk_size)
-            Nc = 10
-        times = pd.date_range('2000-01-01', f'20{Nt:02d}-12-31', freq='D')
-        times = xr.DataArray(times, coords={'time': times}, dims=('time',), name='time')
-        chunkSize = 365 // Nc
-        for i in range(Nt):
-            data = np.random.random((times.sel(time=f'20{i:02d}').size, Nx, Ny)) - 20 * np.cos(2 * np.pi * times.sel(time=f'20{i:02d}').dt.dayofyear.values / 366)[:, np.newaxis, np.newaxis]
-            for c in range(Nc):
-                print(f'Generating data {i * Nc + c + 1:02d}/{Nc * Nt}')
-                data = xr.DataArray(data=data[slice(c * chunkSize, (c + 1) * chunkSize if c + 1 < Nc else None)],
-                                    dims=('time', 'x', 'y'),
-                                    coords={'time': times.sel(time=f'20{i:02d}').isel(time=slice(c * chunkSize, (c + 1) * chunkSize if c + 1 < Nc else None)),
-                                            'x': np.arange(Nx), 'y': np.arange(Ny)},
-                                    name='data',
-                                    attrs={'units': 'degC'})
-                data[chunkSize // 2, 0, 0] = np.nan
-                data.to_netcdf(testfile.format(i=f'{i:02d}'))
-
-    elif args.exp == 'plot':
-        import matplotlib.pyplot as plt
-        try:
-            plt.style.use('dark_background')
-        except OSError:
-            pass
-        if not isinstance(args.files, list):
-            if '*' in args.files:
-                files = glob.glob(args.files)
-            else:
-                files = [args.files]
-        else:
-            files = args.files
-        colors = {exp: col for exp, col in zip(all_exps.keys(),
-                                               plt.matplotlib.rcParams['axes.prop_cycle'].by_key()['color'])}
-        fig, ax = plt.subplots(figsize=(10, 5))
-        for file in files:
-            name, times, mem = read_mprofile(file)
-            ax.plot(times, mem, label=name, color=colors[name])
-        ax.legend()
-        ax.set_xlabel('Computation time [s]')
-        ax.set_ylabel('Memory usage [MiB]')
-        ax.set_title('Memory usage of different percentile calculations')
-        plt.show()
+def _rolling(tas, shared, func):
+    # The rolling reductions requested, built in one pass that shares the NaN mask and counts of the windows
+    if 'rolling' not in shared:
+        funcs = [f for f in ['mean', 'max'] if f'rolling_{f}' in shared['indicators']]
+        shared['rolling'] = bench_rolling.overlap_rolling_many(tas, 'time', bench_rolling.window, funcs)
+    return shared['rolling'][func]
 
-    else:
-        if args.with_client:
-            c = Client(n_workers=1, threads_per_worker=args.nthreads, memory_limit=args.max_mem)
 
-        # num_real = len(glob.glob(testfile.format(r='*', i=0)))
+# Indicators of exp_fused, from the data and the intermediates already built
+fused_indicators = {
+    'tx_mean': lambda tas, shared: annual.aggregate(tas, np.nanmean),
+    'days_above': lambda tas, shared: annual.aggregate(_above(tas, shared), np.sum, dtype=np.dtype('int64')),
+    'gsl': lambda tas, shared: gsl_scan(_above(tas, shared), window=window, thresh=thresh),
+    'rolling_mean': lambda tas, shared: _rolling(tas, shared, 'mean'),
+    'rolling_max': lambda tas, shared: _rolling(tas, shared, 'max'),
+}
+
+
+# The same indicators from the existing pipelines, one at a time: xclim's indices and the exp_*
+# functions of this family and of bench_rolling. The sequential baseline of `bench.py fused`.
+single_indicators = {
+    'tx_mean': lambda tas: xc.indices.tx_mean(tas, freq='YS'),
+    'days_above': lambda tas: xc.indices.tx_days_above(tas, thresh=f'{thresh} degC', freq='YS'),
+    'gsl': lambda tas: exp_scan(tas),
+    'rolling_mean': lambda tas: bench_rolling.exp_overlap(tas, func='mean'),
+    'rolling_max': lambda tas: bench_rolling.exp_overlap(tas, func='max'),
+}
+
+
+def _indicators_dataset(tas, out):
+    # Annual indicators are along `time`, daily ones along `day`
+    return xr.Dataset({name: ind.rename(time='day') if ind.sizes['time'] == tas.sizes['time'] else ind
+                       for name, ind in out.items()})
+
+
+def gsl_fused(tas, indicators):
+    """Indicators of `fused_indicators` in one dataset, so that they are computed in one graph.
+
+    The data is read once for all of them and the intermediates they share are built once.
+    Annual indicators are along `time`, daily ones along `day`.
+    """
+    shared = {'indicators': indicators}
+    return _indicators_dataset(tas, {name: fused_indicators[name](tas, shared) for name in indicators})
+
+
+def exp_fused(tas, indicators=tuple(fused_indicators)):
+    return gsl_fused(tas, indicators)
+
+
+def exp_sequential(tas, indicators=tuple(fused_indicators)):
+    # Nothing shared, as with one job per indicator when run with a single one
+    return _indicators_dataset(tas, {name: single_indicators[name](tas) for name in indicators})
+
 
+all_exps = utils.find_exps(globals())
+
+
+def canonical(ds):
+    """The growing season length of an output, fused ones included, see validate.py."""
+    if 'gsl' in ds:
+        return {'out': ds['gsl']}
+    if set(ds.data_vars) & set(fused_indicators):
+        # Other fused indicators, which have no reference
+        return {}
+    return {'out': next(iter(ds.data_vars.values()))}
+
+
+def add_arguments(parser):
+    parser.add_argument('--indicators', default=','.join(fused_indicators),
+                        help=f'Comma separated indicators of gsl.fused and gsl.sequential, among {", ".join(fused_indicators)}')
+
+
+def gendata(sizes, seed=0, fmt='netcdf', dtype='float64'):
+    if len(sizes) == 1:
+        Nt = Nx = Ny = sizes[0]
+        Nc = 10
+    elif len(sizes) == 2:
+        Nt, Nc = sizes
+        Ny = Nx = Nt
+    elif len(sizes) == 3:
+        Nt, Nx, Nc = sizes
+        Ny = Nx
+    else:
+        Nt, Nx, Ny, Nc = sizes
+
+    print(f'Generating data: {Nt} years of {Nx}x{Ny}, {Nc} chunks per year')
+    # Daily noleap calendar, as model output
+    if hasattr(xr, 'date_range'):
+        times = xr.date_range('2000-01-01', f'{2000 + Nt - 1}-12-31', freq='D', calendar='noleap', use_cftime=True)
+    else:
+        times = xr.cftime_range('2000-01-01', f'{2000 + Nt - 1}-12-31', freq='D', calendar='noleap')
+    tchunks = synthetic.year_chunks(range(2000, 2000 + Nt), Nc, calendar='noleap')
+    seasonal = da.from_array((20 * np.cos(2 * np.pi * np.asarray(times.dayofyear) / 366)).astype(dtype), chunks=(tchunks,))
+    data = synthetic.random_field((tchunks, (Nx,), (Ny,)), seed=seed, nan_at=(365 // Nc // 2, 0, 0), dtype=dtype)
+    ds = xr.Dataset({'data': (('time', 'x', 'y'), data - seasonal[:, np.newaxis, np.newaxis], {'units': 'degC'})},
+                    coords={'time': times, 'x': np.arange(Nx), 'y': np.arange(Ny)})
+    synthetic.write(ds, fmt, testfile.format(i='{time:03d}'), zarrstore)
+
+
+def open_data(args):
+    if args.format == 'zarr':
+        ds = xr.open_zarr(zarrstore)
+    elif args.index:
+        ds = mfindex.open_dataset([glob.glob(testfile.format(i='*'))], mfindex.index_path(testfile))
+    else:
         ds = xr.open_mfdataset(testfile.format(i='*'))
-        ds.data.attrs.update(units='degC')
-        print(f'Running rolling with exp: {args.exp}')
-        ds_out = all_exps[args.exp](ds.data)
+    ds.data.attrs.update(units='degC')
+    return ds.data
+
 
-        print('Writing to file')
+def run_exp(name, data, args):
+    if name in ['fused', 'sequential']:
+        return all_exps[name](data, args.indicators.split(','))
+    return all_exps[name](data)
 
-        r = ds_out.to_netcdf(outfile.format(args.exp), compute=False)
-        r.compute()
-        ds_out.close()
 
-        if args.with_client:
-            c.close()
+def output_name(name, args):
+    return outfile.format(name)
+
+
+if __name__ == '__main__':
+    parser = utils.base_parser('Profile memory for growing season length functions', default_sizes,
+                               'Size of the random data to generate. 1, 2, 3 or 4 values for t (n years), x, y and nchunks/yr. Data is daily.')
+    add_arguments(parser)
+    utils.main(sys.modules[__name__], parser.parse_args())
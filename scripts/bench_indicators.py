@@ -0,0 +1,194 @@
+# Indicator benchmarks, xclim against icclim
+# pyperf suite on CMIP-like daily files generated locally (tas, tasmax, tasmin and pr, one file
+# per variable and year), over several data sizes and dask chunkings. `--check` runs every
+# indicator once with both libraries and compares their outputs instead of timing them.
+import os
+import re
+import glob
+import json
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pyperf as perf
+import xclim as xc
+import utils
+import synthetic
+datadir = 'indicators_{}'
+filename = '{var}_day_SYNTH_historical_r1i1p1_{{time:03d}}.nc'
+default_sizes = ['10 32 32', '30 64 64']
+default_chunks = ['365 -1 -1', '-1 16 16']
+agreement_file = 'indicators_agreement.json'
+variables = {
+    'tas': {'standard_name': 'air_temperature', 'units': 'K', 'cell_methods': 'time: mean'},
+    'tasmax': {'standard_name': 'air_temperature', 'units': 'K', 'cell_methods': 'time: maximum'},
+    'tasmin': {'standard_name': 'air_temperature', 'units': 'K', 'cell_methods': 'time: minimum'},
+    'pr': {'standard_name': 'precipitation_flux', 'units': 'kg m-2 s-1', 'cell_methods': 'time: mean'},
+}
+# ECA&D name: input variable, xclim index and units both outputs are converted to before comparing
+indicators = {
+    'TG': ('tas', lambda da: xc.indices.tg_mean(da, freq='YS'), 'K'),
+    'TX': ('tasmax', lambda da: xc.indices.tx_mean(da, freq='YS'), 'K'),
+    'TN': ('tasmin', lambda da: xc.indices.tn_mean(da, freq='YS'), 'K'),
+    'PRCPTOT': ('pr', lambda da: xc.indices.precip_accumulation(da, freq='YS'), 'mm'),
+    'SU': ('tasmax', lambda da: xc.indices.tx_days_above(da, thresh='25.0 degC', freq='YS'), None),
+    'FD': ('tasmin', lambda da: xc.indices.frost_days(da, freq='YS'), None),
+    'GSL': ('tas', lambda da: xc.indices.growing_season_length(da, thresh='5.0 degC', window=6, freq='YS'), None),
+}
+
+
+def size_name(size):
+    return 'x'.join(str(s) for s in size)
+
+
+def data_dir(size, calendar='standard'):
+    return datadir.format(size_name(size) + ('' if calendar == 'standard' else f'_{calendar}'))
+
+
+def gendata(size, seed=0, calendar='standard'):
+    """Daily tas, tasmax, tasmin and pr with a seasonal cycle over `years` from 1950, one file per year."""
+    years, nlat, nlon = size
+    if calendar == 'standard':
+        time = pd.date_range('1950-01-01', f'{1949 + years}-12-31', freq='D')
+    elif hasattr(xr, 'date_range'):
+        time = xr.date_range('1950-01-01', f'{1949 + years}-12-31', freq='D', calendar=calendar, use_cftime=True)
+    else:
+        time = xr.cftime_range('1950-01-01', f'{1949 + years}-12-31', freq='D', calendar=calendar)
+    chunks = (tuple(np.unique(time.year, return_counts=True)[1]), (nlat,), (nlon,))
+    coords = {'time': time,
+              'lat': ('lat', np.linspace(-80, 80, nlat), {'units': 'degrees_north', 'standard_name': 'latitude'}),
+              'lon': ('lon', np.linspace(0, 360, nlon, endpoint=False),
+                      {'units': 'degrees_east', 'standard_name': 'longitude'})}
+    dims = ('time', 'lat', 'lon')
+    noise = [xr.DataArray(synthetic.random_field(chunks, seed=seed + i, dtype='float32'), dims=dims, coords=coords)
+             for i in range(4)]
+    # Colder and with a stronger seasonal cycle toward the poles, so that every indicator is non trivial
+    lat = np.abs(noise[0].lat) / 90
+    season = -np.cos(2 * np.pi * (noise[0].time.dt.dayofyear - 15) / 365)
+    tas = 288.15 - 30 * lat + (5 + 15 * lat) * season + 8 * (noise[0] - 0.5)
+    data = {'tas': tas,
+            'tasmax': tas + 3 + 5 * noise[1],
+            'tasmin': tas - 3 - 5 * noise[2],
+            # Dry 60% of the days, exponential rain rates otherwise
+            'pr': xr.where(noise[3] > 0.6, -np.log((1 - noise[3]) / 0.4) * 5 / 86400, 0)}
+
+    directory = data_dir(size, calendar)
+    os.makedirs(directory, exist_ok=True)
+    for var, da in data.items():
+        ds = da.astype('float32').rename(var).assign_attrs(variables[var]).to_dataset()
+        synthetic.write(ds, 'netcdf', os.path.join(directory, filename.format(var=var)),
+                        os.path.join(directory, f'{var}.zarr'))
+
+
+def files(size, var, calendar='standard'):
+    pattern = re.sub(r'\{[^}]*\}', '*', filename.format(var=var))
+    return sorted(glob.glob(os.path.join(data_dir(size, calendar), pattern)))
+
+
+def xclim_index(name, size, chunks, out_file):
+    var, func, _ = indicators[name]
+    ds = xr.open_mfdataset(files(size, var), combine='by_coords',
+                           chunks={dim: c for dim, c in zip(('time', 'lat', 'lon'), chunks)})
+    func(ds[var]).rename(name).to_netcdf(out_file)
+
+
+def icclim_index(name, size, out_file):
+    import icclim
+    var = indicators[name][0]
+    if hasattr(icclim, 'index'):
+        # icclim >= 5
+        icclim.index(index_name=name, in_files=files(size, var), var_name=var, slice_mode='year', out_file=out_file)
+    else:
+        icclim.indice(indice_name=name, in_files=files(size, var), var_name=var, slice_mode='year', out_file=out_file)
+
+
+def _convert(da, units):
+    try:
+        from xclim.core.units import convert_units_to
+    except ImportError:
+        from xclim.units import convert_units_to
+    return convert_units_to(da, units) if units else da
+
+
+def _by_year(da):
+    # icclim stamps each year at its middle and xclim at its start
+    return da.assign_coords(time=da.time.dt.year).rename(time='year')
+
+
+def check(names, sizes, chunks, rtol=1e-4):
+    """Compute each indicator with both libraries and compare the outputs year by year."""
+    rows = []
+    for size in sizes:
+        for name in names:
+            out_x, out_i = f'check_xclim_{name}.nc', f'check_icclim_{name}.nc'
+            xclim_index(name, size, chunks, out_x)
+            icclim_index(name, size, out_i)
+            units = indicators[name][2]
+            with xr.open_dataset(out_x) as dsx, xr.open_dataset(out_i) as dsi:
+                x = _by_year(_convert(dsx[name], units)).astype('float64')
+                i = _by_year(_convert(dsi[name], units)).astype('float64')
+                x, i = xr.align(x, i.transpose(*x.dims))
+                diff = abs(x - i)
+                both = np.isfinite(x) & np.isfinite(i)
+                row = {'indicator': name, 'size': size_name(size), 'years': int(x.year.size),
+                       'max_abs_diff': float(diff.max()),
+                       'max_rel_diff': float((diff / abs(i).where(i != 0)).max()),
+                       'nan_mismatch': int((np.isfinite(x) != np.isfinite(i)).sum()),
+                       'agree': bool(np.allclose(x.values[both.values], i.values[both.values], rtol=rtol)
+                                     and int((np.isfinite(x) != np.isfinite(i)).sum()) == 0)}
+            os.remove(out_x)
+            os.remove(out_i)
+            print(f'{name:8s} {row["size"]:>10s} max abs diff {row["max_abs_diff"]:.3g}, '
+                  f'max rel diff {row["max_rel_diff"]:.3g}, NaN mismatches {row["nan_mismatch"]}  '
+                  f'{"ok" if row["agree"] else "DIFFER"}')
+            rows.append(row)
+    with open(agreement_file, 'w') as f:
+        json.dump({'versions': utils.versions(), 'rtol': rtol, 'results': rows}, f, indent=1)
+    print(f'Saved {agreement_file}')
+    return rows
+
+
+def add_arguments(parser):
+    parser.add_argument('--indicators', nargs='+', default=list(indicators), choices=list(indicators),
+                        help='Indicators to benchmark')
+    parser.add_argument('--libraries', nargs='+', default=['xclim', 'icclim'], choices=['xclim', 'icclim'])
+    parser.add_argument('--sizes', nargs='+', default=default_sizes,
+                        help='Data sizes, each as quoted "years lat lon"')
+    parser.add_argument('--chunks', nargs='+', default=default_chunks,
+                        help='dask chunkings of xclim runs, each as quoted "time lat lon" chunk sizes, -1 for no chunking')
+    parser.add_argument('--seed', default=0, type=int, help='Seed of the generated test data')
+    parser.add_argument('--check', action='store_true',
+                        help='Compare the outputs of both libraries instead of benchmarking, with the first chunking')
+
+
+def add_cmdline_args(cmd, args):
+    # pyperf workers only get pyperf's own options, forward ours
+    cmd.extend(['--indicators', *args.indicators, '--libraries', *args.libraries,
+                '--sizes', *args.sizes, '--chunks', *args.chunks, '--seed', str(args.seed)])
+
+
+if __name__ == '__main__':
+    runner = perf.Runner(add_cmdline_args=add_cmdline_args)
+    add_arguments(runner.argparser)
+    args = runner.parse_args()
+    sizes = [utils.parse_sizes(size.split()) for size in args.sizes]
+    chunks = [utils.parse_sizes(c.split()) for c in args.chunks]
+    for mod, version in utils.versions().items():
+        runner.metadata[f'{mod}_version'] = str(version)
+
+    if not args.worker:
+        for size in sizes:
+            if not all(files(size, var) for var in variables):
+                print(f'Generating {size_name(size)} data')
+                gendata(size, args.seed)
+
+    if args.check:
+        check(args.indicators, sizes, chunks[0])
+    else:
+        for size in sizes:
+            for name in args.indicators:
+                if 'xclim' in args.libraries:
+                    for chunk in chunks:
+                        runner.bench_func(f'xclim_{name}_{size_name(size)}_chunks{size_name(chunk)}', xclim_index,
+                                          name, size, chunk, f'xclim_{name}.nc')
+                if 'icclim' in args.libraries:
+                    runner.bench_func(f'icclim_{name}_{size_name(size)}', icclim_index, name, size, f'icclim_{name}.nc')
@@ -1,31 +1,26 @@
 # Rolling benchmarks
 # Comparing xarray's defaults with custom implmentations
 # Also comparing different usages of dask.
+import sys
 import glob
-import argparse
 import xclim as xc
 import numpy as np
 import xarray as xr
-import datetime as dt
-from distributed import Client
+import dask.array as da
+import utils
+import synthetic
+import mfindex
+import nanindex
+family = 'rolling'
 testfile = 'testdata_t{}.nc'
+zarrstore = 'testdata_t.zarr'
 outfile = 'testout_{}{}{}.nc'
-
-
-def read_mprofile(filename):
-    times = []
-    mem = []
-    name = filename.split('.')[0]
-    with open(filename, 'r') as f:
-        for line in f:
-            if line.startswith('CMDLINE'):
-                name = line.strip().split()[-1]
-            elif line.startswith('MEM'):
-                _, m, t = line.strip().split()
-                times.append(dt.datetime.fromtimestamp(float(t)))
-                mem.append(float(m))
-    times = [(t - times[0]).total_seconds() for t in times]
-    return name, times, mem
+default_sizes = [500, 100, 100, 20]
+plot_title = 'Memory usage of different rolling methods'
+options = ['func', 'lazy', 'skipna']
+# Outputs are validated against this experiment
+reference = 'xclim'
+window = 5
 
 
 def xclim_custom(data, dim, window, func):
@@ -40,91 +35,223 @@ def xr_nocounts(data, dim, window, func, lazy=False, skipna=None):
     return data.rolling(dim={dim: window}).construct('window_dim').reduce(func, dim='window_dim', allow_lazy=lazy, skipna=skipna)
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Profile memory for rolling functions')
+def _window_count(mask, window):
+    # Number of True values in each trailing window, from a cumulative sum along the first axis
+    c = np.cumsum(mask, axis=0, dtype=np.int64)
+    c[window:] = c[window:] - c[:-window].copy()
+    return c
+
+
+def _rolling_sum(x, window, skipna=False, mean=False, nans=True, mask=None, valid=None):
+    # Running sums from a cumulative sum in float64, O(n) whatever the window. The differences of
+    # the cumulative sum lose too much precision in float32, only the result is cast back.
+    # `mask` and `valid`, the NaN mask and the valid values per window, can be given when already built.
+    if not nans:
+        # No NaN in the block and its halo, every window that is kept is complete
+        s = np.cumsum(x, axis=0, dtype=np.float64)
+        s[window:] = s[window:] - s[:-window].copy()
+        return (s / window if mean else s).astype(x.dtype, copy=False)
+    if mask is None:
+        mask = np.isnan(x)
+        valid = window - _window_count(mask, window)
+    s = np.cumsum(np.where(mask, 0, x), axis=0, dtype=np.float64)
+    s[window:] = s[window:] - s[:-window].copy()
+    if not mean:
+        # Like nansum, an all-NaN window sums to 0 with skipna
+        return (s if skipna else np.where(valid == window, s, np.nan)).astype(x.dtype, copy=False)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        s = s / valid
+    return np.where(valid > 0 if skipna else valid == window, s, np.nan).astype(x.dtype, copy=False)
+
+
+def _rolling_extreme(x, window, skipna=False, func=np.maximum, nans=True, mask=None, valid=None):
+    # van Herk/Gil-Werman: prefix and suffix extremes within segments of `window` values,
+    # each trailing window spans at most two segments. About 3 comparisons per value.
+    fill = -np.inf if func is np.maximum else np.inf
+    n = x.shape[0]
+    nseg = -(-n // window)
+    y = np.full((nseg * window,) + x.shape[1:], fill, dtype=x.dtype)
+    if nans:
+        if mask is None:
+            mask = np.isnan(x)
+            valid = window - _window_count(mask, window)
+        y[:n] = np.where(mask, fill, x)
+    else:
+        y[:n] = x
+    y = y.reshape((nseg, window) + x.shape[1:])
+    prefix = func.accumulate(y, axis=1).reshape((nseg * window,) + x.shape[1:])[:n]
+    suffix = func.accumulate(y[:, ::-1], axis=1)[:, ::-1].reshape((nseg * window,) + x.shape[1:])[:n]
+    out = np.full(x.shape, np.nan, dtype=x.dtype)
+    out[window - 1:] = func(suffix[:n - window + 1], prefix[window - 1:])
+    if not nans:
+        return out
+    return np.where(valid > 0 if skipna else valid == window, out, np.nan)
+
+
+_overlap_kernels = {
+    'sum': lambda x, window, skipna, **kws: _rolling_sum(x, window, skipna, **kws),
+    'mean': lambda x, window, skipna, **kws: _rolling_sum(x, window, skipna, mean=True, **kws),
+    'max': lambda x, window, skipna, **kws: _rolling_extreme(x, window, skipna, np.maximum, **kws),
+    'min': lambda x, window, skipna, **kws: _rolling_extreme(x, window, skipna, np.minimum, **kws),
+}
+
+
+def _shared_kernels(x, window, skipna, funcs):
+    # All the reductions of a block, stacked, from one NaN mask and one count of valid values per window
+    mask = np.isnan(x)
+    valid = window - _window_count(mask, window)
+    return np.stack([_overlap_kernels[func](x, window, skipna, mask=mask, valid=valid) for func in funcs])
+
+
+def _all_nan_kernel(func):
+    # Every window of an all-NaN block and halo is empty: nansum gives 0, the others NaN
+    def kernel(x, window, skipna):
+        return np.full(x.shape, 0. if func == 'sum' and skipna else np.nan, dtype=x.dtype)
+    return kernel
+
+
+def overlap_rolling(data, dim, window, func, skipna=False, nan_summary=False):
+    """Trailing rolling reduction in O(n) per chunk, with dask's map_overlap and a halo of window - 1.
+
+    As with `construct('window_dim').reduce`, the series is padded with NaNs on the left. With
+    skipna, NaNs are ignored as in nanmean, nanmax, etc., otherwise any NaN in the window gives NaN.
+    Either way the first window - 1 values are NaN, as with min_periods=window.
+    With `nan_summary`, blocks whose halo has no NaN skip the NaN handling and blocks with only
+    NaNs are filled, see nanindex.py.
+    """
+    if func not in _overlap_kernels:
+        raise ValueError(f'Rolling {func} is not implemented, use one of {list(_overlap_kernels)}')
+    kernel = _overlap_kernels[func]
+    axis = data.get_axis_num(dim)
+    arr = data.data if data.chunks is not None else data.chunk().data
+    arr = da.moveaxis(arr, axis, 0)
+    # Blocks at least as long as the halo, which map_overlap would otherwise rechunk itself
+    arr = arr.rechunk({0: nanindex.min_chunks(arr.chunks[0], window - 1)})
+    depth = {i: 0 for i in range(arr.ndim)}
+    depth[0] = window - 1
+    if nan_summary:
+        states = nanindex.with_halo(nanindex.get(arr, testfile), 0)
+        kernels = {'none': lambda x, **kws: kernel(x, nans=False, **kws), 'some': kernel,
+                   'all': _all_nan_kernel(func)}
+        out = arr.map_overlap(nanindex.dispatch, depth=depth, boundary={0: np.nan}, dtype=arr.dtype,
+                              kernels=kernels, states=states, window=window, skipna=bool(skipna))
+    else:
+        out = arr.map_overlap(kernel, depth=depth, boundary={0: np.nan}, dtype=arr.dtype,
+                              window=window, skipna=bool(skipna))
+    if skipna:
+        out = _complete_windows(out, window)
+    return data.copy(data=da.moveaxis(out, 0, axis))
+
+
+def _complete_windows(out, window):
+    # The padding would give partial windows at the start, keep complete ones as min_periods=window
+    t = da.arange(out.shape[0], chunks=out.chunks[0]).reshape((-1,) + (1,) * (out.ndim - 1))
+    return da.where(t >= window - 1, out, np.nan).astype(out.dtype)
+
+
+def overlap_rolling_many(data, dim, window, funcs, skipna=False):
+    """Several reductions of `overlap_rolling` at once, as a dict of outputs by reduction.
+
+    They share the halo of each block, and its NaN mask and counts of valid values per window are
+    built once for all of them.
+    """
+    for func in funcs:
+        if func not in _overlap_kernels:
+            raise ValueError(f'Rolling {func} is not implemented, use one of {list(_overlap_kernels)}')
+    axis = data.get_axis_num(dim)
+    arr = data.data if data.chunks is not None else data.chunk().data
+    arr = da.moveaxis(arr, axis, 0)
+    # Blocks at least as long as the halo, which map_overlap would otherwise rechunk itself
+    arr = arr.rechunk({0: nanindex.min_chunks(arr.chunks[0], window - 1)})
+    depth = {i: 0 for i in range(arr.ndim)}
+    depth[0] = window - 1
+    # map_overlap with the reductions stacked along a new first axis, trimmed separately
+    boundary = {i: np.nan if i == 0 else 'none' for i in range(arr.ndim)}
+    halo = da.overlap.overlap(arr, depth=depth, boundary=boundary)
+    stacked = halo.map_blocks(_shared_kernels, window=window, skipna=bool(skipna), funcs=list(funcs),
+                              new_axis=0, chunks=((len(funcs),),) + halo.chunks, dtype=arr.dtype)
+    outs = {}
+    for i, func in enumerate(funcs):
+        out = da.overlap.trim_internal(stacked[i], depth, boundary=boundary)
+        if skipna:
+            out = _complete_windows(out, window)
+        outs[func] = data.copy(data=da.moveaxis(out, 0, axis))
+    return outs
+
+
+def exp_overlap(data, func='mean', lazy=False, skipna=None):
+    return overlap_rolling(data, 'time', window, func, skipna=skipna)
+
+
+def exp_overlapnan(data, func='mean', lazy=False, skipna=None):
+    return overlap_rolling(data, 'time', window, func, skipna=skipna, nan_summary=True)
+
+
+def exp_xclim(data, func='mean', lazy=False, skipna=None):
+    return xclim_custom(data, 'time', window, func)
+
+
+def exp_xrpure(data, func='mean', lazy=False, skipna=None):
+    return xr_default(data, 'time', window, func)
+
+
+def exp_xrdefault(data, func='mean', lazy=False, skipna=None):
+    return xr_default(data, 'time', window, func, lazy=lazy, skipna=skipna)
+
+
+def exp_xrnocounts(data, func='mean', lazy=False, skipna=None):
+    return xr_nocounts(data, 'time', window, getattr(xr.core.duck_array_ops, func), lazy=lazy, skipna=skipna)
+
+
+all_exps = utils.find_exps(globals())
+
+
+def add_arguments(parser):
     parser.add_argument('-f', '--func', type=str, default='mean', help='which function to run')
     parser.add_argument('-l', '--lazy', action='store_true', help='whether to allow lazy (xr)')
-    parser.add_argument('-c', '--with-client', action='store_true', help='whether to use a dask client')
-    parser.add_argument('-N', '--nthreads', default=10, type=int, help='When using a dask client, number of threads per worker')
-    parser.add_argument('-m', '--max-mem', default='2GB', help='When using a dask client, memory limit')
     parser.add_argument('-s', '--skipna', action='store_true', help='If specified, passes skipna=True')
-    parser.add_argument('exp', type=str, help='which exp to run')
-    parser.add_argument('-i', '--files', default='*.dat', nargs='*', help='Dat files to plot')
-    parser.add_argument('-n', '--chunk-size', default=[500, 100, 100, 20], nargs='*', help='Size of the random data to generate. 1, 2, 3 or 4 values for t, x, y and nchunks.')
-    args = parser.parse_args()
-
-    if args.exp == 'gendata':
-        if isinstance(args.chunk_size, list):
-            if len(args.chunk_size) == 2:
-                Nt, Nc = map(int, args.chunk_size)
-                Ny = Nx = Nt
-            elif len(args.chunk_size) == 3:
-                Nt, Nx, Nc = map(int, args.chunk_size)
-                Ny = Nx
-            else:
-                Nt, Nx, Ny, Nc = map(int, args.chunk_size)
-        else:
-            Nt = Nx = Ny = int(args.chunk_size)
-            Nc = 20
-
-        for i in range(Nc):
-            print(f'Generating data {i+1:02d}/{Nc}')
-            data = xr.DataArray(data=np.random.random((Nt, Nx, Ny)),
-                                dims=('time', 'x', 'y'),
-                                coords={'time': np.arange(Nt * i, Nt * (i + 1)),
-                                        'x': np.arange(Nx), 'y': np.arange(Ny)},
-                                name='data')
-            data.to_netcdf(testfile.format(f'{i:02d}'))
-
-    elif args.exp == 'plot':
-        import matplotlib.pyplot as plt
-        try:
-            plt.style.use('dark_background')
-        except OSError:
-            pass
-        if not isinstance(args.files, list):
-            if '*' in args.files:
-                files = glob.glob(args.files)
-            else:
-                files = [args.files]
-        else:
-            files = args.files
-        colors = {exp: col for exp, col in zip(['xclim', 'xrpure', 'xrdefault', 'xrnocounts'],
-                                               plt.matplotlib.rcParams['axes.prop_cycle'].by_key()['color'])}
-        fig, ax = plt.subplots(figsize=(10, 5))
-        for file in files:
-            name, times, mem = read_mprofile(file)
-            ax.plot(times, mem, label=name, color=colors[name])
-        ax.legend()
-        ax.set_xlabel('Computation time [s]')
-        ax.set_ylabel('Memory usage [MiB]')
-        ax.set_title('Memory usage of different rolling methods')
-        plt.show()
 
+
+def gendata(sizes, seed=0, fmt='netcdf', dtype='float64'):
+    if len(sizes) == 1:
+        Nt = Nx = Ny = sizes[0]
+        Nc = 20
+    elif len(sizes) == 2:
+        Nt, Nc = sizes
+        Ny = Nx = Nt
+    elif len(sizes) == 3:
+        Nt, Nx, Nc = sizes
+        Ny = Nx
     else:
-        if args.with_client:
-            c = Client(n_workers=1, threads_per_worker=args.nthreads, memory_limit=args.max_mem)
-
-        data = xr.open_mfdataset(testfile.format('*'), combine='by_coords', chunks={})
-
-        func = getattr(xr.core.duck_array_ops, args.func)
-        print(f'Running rolling with exp: {args.exp}')
-        if args.exp == 'xclim':
-            out = xclim_custom(data.data, 'time', 5, args.func)
-        elif args.exp == 'xrpure':
-            out = xr_default(data.data, 'time', 5, args.func)
-        elif args.exp == 'xrdefault':
-            out = xr_default(data.data, 'time', 5, args.func, lazy=args.lazy, skipna=args.skipna)
-        elif args.exp == 'xrnocounts':
-            out = xr_nocounts(data.data, 'time', 5, func, lazy=args.lazy, skipna=args.skipna)
-
-        print('Writing to file')
-        r = out.to_netcdf(outfile.format(args.exp,
-                                         '_lazy' if args.lazy else '',
-                                         f'_dskcli_{args.nthreads:02d}_{args.max_mem}' if args.with_client else ''),
-                          compute=False)
-        r.compute()
-        out.close()
-
-        if args.with_client:
-            c.close()
+        Nt, Nx, Ny, Nc = sizes
+
+    print(f'Generating data: {Nc} chunks of {Nt}x{Nx}x{Ny}')
+    data = synthetic.random_field(((Nt,) * Nc, (Nx,), (Ny,)), seed=seed, dtype=dtype)
+    ds = xr.Dataset({'data': (('time', 'x', 'y'), data)},
+                    coords={'time': np.arange(Nt * Nc), 'x': np.arange(Nx), 'y': np.arange(Ny)})
+    synthetic.write(ds, fmt, testfile.format('{time:02d}'), zarrstore)
+
+
+def open_data(args):
+    if args.format == 'zarr':
+        return xr.open_zarr(zarrstore).data
+    if args.index:
+        return mfindex.open_dataset([glob.glob(testfile.format('*'))], mfindex.index_path(testfile)).data
+    return xr.open_mfdataset(testfile.format('*'), combine='by_coords', chunks={}).data
+
+
+def run_exp(name, data, args):
+    return all_exps[name](data, func=args.func, lazy=args.lazy, skipna=args.skipna)
+
+
+def output_name(name, args):
+    return outfile.format(name,
+                          '_lazy' if args.lazy else '',
+                          f'_dskcli_{args.nthreads:02d}_{args.max_mem}' if args.with_client else '')
+
+
+if __name__ == '__main__':
+    parser = utils.base_parser('Profile memory for rolling functions', default_sizes,
+                               'Size of the random data to generate. 1, 2, 3 or 4 values for t, x, y and nchunks.')
+    add_arguments(parser)
+    utils.main(sys.modules[__name__], parser.parse_args())
@@ -1,16 +1,14 @@
-# Imports
+# icclim TX (mean of tasmax) benchmark on locally generated CMIP-like data
+# A single point of bench_indicators.py, which also compares with xclim over several sizes and chunkings.
 import pyperf as perf
-import icclim
-
-def func():
-    files = []
-    files.append('/media/proy/HDD500GB/DATA/CMIP5/tasmax_day_MIROC5_historical_r1i1p1_19500101-19591231.nc')
-    # files.append('/media/proy/HDD500GB/DATA/CMIP5/tasmax_day_MIROC5_historical_r1i1p1_19600101-19691231.nc')
-
-    icclim.indice(files, 'tasmax', indice_name='TG', out_file='temp.nc')
+import utils
+import bench_indicators as bi
 
+size = utils.parse_sizes(bi.default_sizes[0].split())
 
 runner = perf.Runner()
-runner.bench_func('ICCLIM_TG', func)
-
-
+if not runner.parse_args().worker and not bi.files(size, 'tasmax'):
+    bi.gendata(size)
+# The benchmark keeps its first name, under which its history in output/bench_icclim.json is filed:
+# icclim's TG on tasmax files, i.e. the mean of tasmax
+runner.bench_func('ICCLIM_TG', bi.icclim_index, 'TX', size, 'temp.nc')
@@ -0,0 +1,184 @@
+# Content-addressed cache of generated test data and intermediate results
+# Entries are keyed by a hash of the parameters that produced them and of the source code of the
+# generator, so changing either gives a new entry instead of silently reusing stale files. Least
+# recently used entries are evicted when the cache grows over its size limit.
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import inspect
+import xarray as xr
+from dask.utils import parse_bytes
+default_dir = os.environ.get('BENCH_CACHE', 'bench_cache')
+default_size = '20GB'
+# Set by the harness when intermediates of the experiments are cached, see `intermediate`
+active = None
+events = []
+
+
+def code_version(*objs):
+    """Hash of the source code of functions or modules."""
+    h = hashlib.sha1()
+    for obj in objs:
+        h.update(inspect.getsource(obj).encode())
+    return h.hexdigest()[:12]
+
+
+def make_key(kind, params, code):
+    text = json.dumps({'kind': kind, 'params': params, 'code': code}, sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def _meta_file(path):
+    return os.path.join(path, 'meta.json')
+
+
+def _read_meta(path):
+    with open(_meta_file(path)) as f:
+        return json.load(f)
+
+
+def _write_meta(path, meta):
+    tmp = _meta_file(path) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(tmp, _meta_file(path))
+
+
+def entries(cache_dir=default_dir):
+    """Metadata of all complete entries, least recently used first."""
+    out = []
+    if not os.path.isdir(cache_dir):
+        return out
+    for key in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, key)
+        if os.path.exists(_meta_file(path)):
+            out.append(dict(_read_meta(path), path=path))
+    return sorted(out, key=lambda meta: meta['last_used'])
+
+
+def lookup(key, cache_dir=default_dir):
+    """Path of the entry of `key`, None on a miss. Marks the entry as used."""
+    path = os.path.join(cache_dir, key)
+    if not os.path.exists(_meta_file(path)):
+        return None
+    meta = _read_meta(path)
+    meta['last_used'] = time.time()
+    meta['hits'] = meta.get('hits', 0) + 1
+    _write_meta(path, meta)
+    return path
+
+
+def _link_or_copy(src, dst):
+    # Hard links are free and safe as long as files are replaced rather than modified in place,
+    # which is how the test data is (re)generated
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _put(src, dst):
+    if os.path.isdir(src):
+        shutil.copytree(src, dst, copy_function=_link_or_copy)
+    else:
+        _link_or_copy(src, dst)
+
+
+def _size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def add(key, kind, params, paths, cache_dir=default_dir, limit=default_size):
+    """Store files and directories under `key` and evict old entries over the size limit."""
+    path = os.path.join(cache_dir, key)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(os.path.join(path, 'data'))
+    for src in paths:
+        _put(src, os.path.join(path, 'data', os.path.basename(src.rstrip('/'))))
+    now = time.time()
+    _write_meta(path, {'key': key, 'kind': kind, 'params': params, 'files': [os.path.basename(p) for p in paths],
+                       'size': _size(os.path.join(path, 'data')), 'created': now, 'last_used': now, 'hits': 0})
+    evict(cache_dir, limit, keep=key)
+    return path
+
+
+def restore(path, dest='.'):
+    """Put the files of an entry in `dest`, replacing files of the same names."""
+    meta = _read_meta(path)
+    for name in meta['files']:
+        target = os.path.join(dest, name)
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        elif os.path.exists(target):
+            os.remove(target)
+        _put(os.path.join(path, 'data', name), target)
+    return meta
+
+
+def evict(cache_dir=default_dir, limit=default_size, keep=None):
+    """Remove least recently used entries until the cache is under `limit` (bytes or a string like 20GB)."""
+    limit = parse_bytes(limit) if isinstance(limit, str) else limit
+    metas = entries(cache_dir)
+    total = sum(meta['size'] for meta in metas)
+    removed = []
+    for meta in metas:
+        if total <= limit:
+            break
+        if meta['key'] == keep:
+            continue
+        shutil.rmtree(meta['path'])
+        total -= meta['size']
+        removed.append(meta['key'])
+    if removed:
+        print(f'Evicted {len(removed)} cache entries, {total / 2**30:.1f} GiB left')
+    return removed
+
+
+def manifest_path(pattern):
+    """Sidecar recording the parameters of the test data matching a pattern."""
+    return os.path.splitext(re.sub(r'\{[^}]*\}|\*', '', pattern))[0] + '.data.json'
+
+
+def read_manifest(pattern):
+    try:
+        with open(manifest_path(pattern)) as f:
+            return json.load(f)
+    except OSError:
+        return None
+
+
+def write_manifest(pattern, manifest):
+    with open(manifest_path(pattern), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def intermediate(name, params, build, *args):
+    """An intermediate result of an experiment, read back from the cache when possible.
+
+    `build(*args)` returns a lazy xarray object. While caching is active, it is computed to a zarr
+    store in the cache on a miss, keyed by the input data, `params` and the source of `build`, and
+    opened from there. Without active caching, this is just `build(*args)`.
+    """
+    if active is None:
+        return build(*args)
+    params = dict(params, data=active['data_key'])
+    key = make_key('intermediate:' + name, params, code_version(build))
+    path = lookup(key, active['dir'])
+    status = 'hit' if path is not None else 'miss'
+    if path is None:
+        obj = build(*args)
+        is_array = isinstance(obj, xr.DataArray)
+        tmp = os.path.join(active['dir'], 'tmp', key, f'{name}.zarr')
+        (obj.to_dataset(name=name) if is_array else obj).to_zarr(tmp, mode='w')
+        path = add(key, 'intermediate:' + name, dict(params, is_array=is_array), [tmp], active['dir'], active['limit'])
+        shutil.rmtree(os.path.dirname(tmp))
+    meta = _read_meta(path)
+    events.append({'name': name, 'key': key, 'status': status})
+    ds = xr.open_zarr(os.path.join(path, 'data', meta['files'][0]))
+    return ds[name] if meta['params']['is_array'] else ds
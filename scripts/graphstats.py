@@ -0,0 +1,72 @@
+# Dask task graph and scheduler instrumentation
+# Graph size metrics taken before compute, and the bytes transferred between workers and
+# spilled to disk by a distributed client, taken after.
+import time
+import dask
+from dask.core import get_dependencies, toposort
+
+
+def graph_metrics(collection):
+    """Number of tasks, layers and depth of the graph of a dask collection, before and after optimization."""
+    graph = collection.__dask_graph__()
+    if graph is None:
+        return None
+    layers = len(graph.layers) if hasattr(graph, 'layers') else 1
+    dsk = dict(graph)
+
+    t0 = time.perf_counter()
+    (optimized,) = dask.optimize(collection)
+    optimize_time = time.perf_counter() - t0
+    opt = dict(optimized.__dask_graph__())
+
+    return {'tasks': len(dsk), 'layers': layers, 'depth': depth(dsk),
+            'tasks_optimized': len(opt), 'depth_optimized': depth(opt),
+            'optimize_time': optimize_time}
+
+
+def depth(dsk):
+    """Length of the longest chain of dependent tasks."""
+    levels = {}
+    for key in toposort(dsk):
+        deps = get_dependencies(dsk, key)
+        levels[key] = 1 + max((levels[d] for d in deps), default=0)
+    return max(levels.values(), default=0)
+
+
+def _log_bytes(log):
+    return sum(entry.get('total', 0) for entry in log) if log is not None else None
+
+
+def _worker_io(dask_worker):
+    # Attribute names changed across distributed versions, take the first that exists
+    w = dask_worker
+    incoming = getattr(w, 'transfer_incoming_bytes_total', None)
+    if incoming is None:
+        incoming = _log_bytes(getattr(w, 'transfer_incoming_log', getattr(w, 'incoming_transfer_log', None)))
+    outgoing = getattr(w, 'transfer_outgoing_bytes_total', None)
+    if outgoing is None:
+        outgoing = _log_bytes(getattr(w, 'transfer_outgoing_log', getattr(w, 'outgoing_transfer_log', None)))
+
+    spilled_bytes = spilled_keys = None
+    data = w.data
+    if hasattr(data, 'cumulative_metrics'):
+        spilled_bytes = sum(v for (label, unit), v in data.cumulative_metrics.items()
+                            if label == 'disk-write' and unit == 'bytes')
+    slow = getattr(data, 'slow', None)
+    if slow is not None:
+        spilled_keys = len(slow)
+        if spilled_bytes is None:
+            spilled_bytes = getattr(slow, 'total_weight', None)
+    return {'incoming_bytes': incoming, 'outgoing_bytes': outgoing,
+            'spilled_bytes': spilled_bytes, 'spilled_keys': spilled_keys}
+
+
+def client_io(client):
+    """Bytes transferred between workers and spilled to disk, per worker and in total, since they started."""
+    workers = client.run(_worker_io)
+    total = {}
+    for metrics in workers.values():
+        for k, v in metrics.items():
+            if v is not None:
+                total[k] = total.get(k, 0) + v
+    return {'workers': workers, 'total': total}
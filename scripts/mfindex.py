@@ -0,0 +1,202 @@
+# Cached metadata index of multi-file netCDF corpora
+# open_mfdataset and create_ensemble open every file and decode and compare its coordinates on
+# each run. The index records the coordinates, chunk layout and variable metadata of every file
+# once, in a JSON sidecar, and the corpus is then opened lazily from it: no file is opened
+# until the data is computed, and the coordinates are decoded once for the whole corpus.
+import os
+import re
+import json
+import numpy as np
+import xarray as xr
+import dask
+import dask.array as da
+version = 1
+
+
+def index_path(pattern):
+    """Sidecar index of the files matching a pattern, with `{...}` fields or `*` wildcards."""
+    stem = os.path.splitext(re.sub(r'\{[^}]*\}|\*', '', pattern))[0]
+    return stem + '.index.json'
+
+
+def _stat(filename):
+    st = os.stat(filename)
+    return [st.st_size, st.st_mtime]
+
+
+def _scan(filename):
+    """Raw (not decoded) metadata of a netCDF file and the values of its coordinates."""
+    import netCDF4
+    with netCDF4.Dataset(filename) as nc:
+        nc.set_auto_maskandscale(False)
+        variables = {}
+        for name, v in nc.variables.items():
+            info = {'dims': list(v.dimensions), 'shape': list(v.shape), 'dtype': v.dtype.str,
+                    'attrs': {k: _jsonable(v.getncattr(k)) for k in v.ncattrs()}}
+            chunking = v.chunking()
+            if chunking != 'contiguous':
+                info['chunking'] = [int(c) for c in chunking]
+            if v.ndim == 1 and v.dimensions[0] == name:
+                info['values'] = v[:].tolist()
+            variables[name] = info
+        return {'dims': {dim: len(d) for dim, d in nc.dimensions.items()},
+                'attrs': {k: _jsonable(nc.getncattr(k)) for k in nc.ncattrs()},
+                'variables': variables, 'stat': _stat(filename)}
+
+
+def _jsonable(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _concat_dim(files):
+    """The dimension whose coordinate differs between the files, None for a single file."""
+    first = files[0]['variables']
+    for name, info in first.items():
+        if 'values' in info and any(f['variables'][name].get('values') != info['values'] for f in files[1:]):
+            return name
+    return None
+
+
+def _normalized(scans, dim):
+    """Values of the coordinate along `dim` of each file, times in the units of the first file.
+
+    Files written separately usually encode times relative to their own first date.
+    """
+    from xarray.coding.times import decode_cf_datetime, encode_cf_datetime
+    attrs = scans[0]['variables'][dim]['attrs']
+    units, calendar = attrs.get('units', ''), attrs.get('calendar', 'standard')
+    out = []
+    for scan in scans:
+        info = scan['variables'][dim]
+        values = info['values']
+        if ' since ' in units and info['attrs'].get('units') != units:
+            dates = decode_cf_datetime(np.array(values), info['attrs']['units'], calendar)
+            values = encode_cf_datetime(dates, units, calendar)[0].tolist()
+        out.append(values)
+    return out
+
+
+def build(groups):
+    """Index of groups of files, each group a corpus split along one dimension (e.g. time).
+
+    Files of a group are sorted along that dimension by their first coordinate value, as
+    `combine='by_coords'` would. Several groups are stacked along a new dimension when opened.
+    """
+    out = []
+    for files in groups:
+        scans = [_scan(filename) for filename in files]
+        dim = _concat_dim(scans)
+        if dim is None:
+            out.append({'concat_dim': None, 'files': list(files), 'scans': scans})
+            continue
+        values = _normalized(scans, dim)
+        order = sorted(range(len(files)), key=lambda i: values[i][0])
+        out.append({'concat_dim': dim, 'files': [files[i] for i in order], 'scans': [scans[i] for i in order],
+                    'values': [v for i in order for v in values[i]]})
+    return {'version': version, 'groups': out}
+
+
+def is_valid(index, groups):
+    """Whether the index covers exactly these files, unchanged since it was built."""
+    if index.get('version') != version or len(index['groups']) != len(groups):
+        return False
+    for entry, files in zip(index['groups'], groups):
+        if sorted(entry['files']) != sorted(files):
+            return False
+        for filename, scan in zip(entry['files'], entry['scans']):
+            if not os.path.exists(filename) or _stat(filename) != scan['stat']:
+                return False
+    return True
+
+
+def load(filename, groups):
+    """The index stored in `filename` if it is still valid for the groups of files, else None."""
+    try:
+        with open(filename) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return index if is_valid(index, groups) else None
+
+
+def save(filename, index):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp, filename)
+
+
+def _read(filename, name):
+    import netCDF4
+    from xarray.backends.locks import HDF5_LOCK
+    # The HDF5 library is not thread safe, reads go through the same lock as xarray's
+    with HDF5_LOCK:
+        with netCDF4.Dataset(filename) as nc:
+            v = nc.variables[name]
+            v.set_auto_maskandscale(False)
+            return v[...]
+
+
+def _variable_data(entry, name):
+    """Lazy raw data of a variable of a group, one chunk per file along the concatenated dimension."""
+    info = entry['scans'][0]['variables'][name]
+    dim = entry['concat_dim']
+    dtype = np.dtype(info['dtype'])
+    if dim not in info['dims']:
+        return da.from_delayed(dask.delayed(_read)(entry['files'][0], name), tuple(info['shape']), dtype)
+    blocks = [da.from_delayed(dask.delayed(_read)(filename, name), tuple(scan['variables'][name]['shape']), dtype)
+              for filename, scan in zip(entry['files'], entry['scans'])]
+    return da.concatenate(blocks, axis=info['dims'].index(dim))
+
+
+def _coordinate(entry, name):
+    info = entry['scans'][0]['variables'][name]
+    if name == entry['concat_dim']:
+        values = entry['values']
+    else:
+        values = info['values']
+    return np.array(values, dtype=np.dtype(info['dtype']))
+
+
+def from_index(index, stack_dim='realization'):
+    """Lazy dataset of an index, decoded once. Groups are stacked along `stack_dim`."""
+    groups = index['groups']
+    first = groups[0]['scans'][0]
+    variables = {}
+    for name, info in first['variables'].items():
+        if 'values' in info:
+            variables[name] = xr.Variable(info['dims'], _coordinate(groups[0], name), info['attrs'])
+            continue
+        data = [_variable_data(entry, name) for entry in groups]
+        dims = info['dims']
+        if len(groups) > 1:
+            data = [da.stack(data, axis=0)]
+            dims = [stack_dim] + dims
+        variables[name] = xr.Variable(dims, data[0], info['attrs'])
+    coords = [name for name, info in first['variables'].items() if 'values' in info]
+    if len(groups) > 1:
+        # As create_ensemble does
+        variables[stack_dim] = xr.Variable(stack_dim, np.arange(len(groups)), {'axis': 'E'})
+        coords.append(stack_dim)
+    ds = xr.Dataset(variables, attrs=first['attrs']).set_coords(coords)
+    return xr.decode_cf(ds)
+
+
+def get(groups, filename):
+    """Index of groups of files stored in `filename`, (re)built when needed."""
+    groups = [sorted(files) for files in groups]
+    index = load(filename, groups)
+    if index is None:
+        print(f'Indexing {sum(len(files) for files in groups)} files to {filename}')
+        index = build(groups)
+        save(filename, index)
+    return index
+
+
+def open_dataset(groups, filename):
+    """Open groups of files from their index in `filename`, (re)building the index when needed."""
+    return from_index(get(groups, filename))
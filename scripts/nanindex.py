@@ -0,0 +1,111 @@
+# Per-chunk NaN summary and kernel dispatch
+# A pre-pass records for every block of a dask array whether it has no NaN, some NaNs or only
+# NaNs. Experiments then run each block through the matching kernel: a fast one that does not
+# check for NaNs, the NaN-aware one, or a constant fill. The generated corpora only have a NaN at
+# one point per file, so most blocks take the fast path. Summaries are kept in a sidecar next to
+# the test data, keyed by the data (see cache.py) and the chunks, so the pre-pass runs once.
+import os
+import re
+import json
+import numpy as np
+import dask.array as da
+import cache
+NONE, SOME, ALL = 0, 1, 2
+names = {NONE: 'none', SOME: 'some', ALL: 'all'}
+# Summaries computed or read by `get` in this process, recorded with the run
+events = []
+
+
+def index_path(pattern):
+    """Sidecar of the NaN summaries of the test data matching a pattern."""
+    return os.path.splitext(re.sub(r'\{[^}]*\}|\*', '', pattern))[0] + '.nans.json'
+
+
+def _block_state(block):
+    nans = np.isnan(block)
+    state = ALL if nans.all() else SOME if nans.any() else NONE
+    return np.full((1,) * block.ndim, state, dtype=np.int8)
+
+
+def summary(arr):
+    """State of each block of a dask array, as an array of the shape of its block grid."""
+    return da.map_blocks(_block_state, arr, chunks=tuple((1,) * len(c) for c in arr.chunks),
+                         dtype=np.int8).compute()
+
+
+def combine(a, b):
+    """State of the union of blocks: none or all if both are, some otherwise."""
+    return np.where(a == b, a, SOME).astype(np.int8)
+
+
+def min_chunks(chunks, size):
+    """Chunks merged with their neighbours until each is at least `size` long, as long as the whole is.
+
+    map_overlap rechunks the blocks that are shorter than its halo, after which the states summarised
+    before would no longer describe the blocks `dispatch` receives: rechunk with these first.
+    """
+    out = []
+    for c in chunks:
+        if out and out[-1] < size:
+            out[-1] += c
+        else:
+            out.append(c)
+    if len(out) > 1 and out[-1] < size:
+        out[-2] += out.pop()
+    return tuple(out)
+
+
+def with_halo(states, axis):
+    """States of the blocks extended with their neighbours along `axis`, as with map_overlap.
+
+    Both ends are padded with NaNs, as with `boundary=np.nan`. The halo must not be longer than
+    any block along `axis`, see `min_chunks`.
+    """
+    pad = [(0, 0)] * states.ndim
+    pad[axis] = (1, 1)
+    padded = np.pad(states, pad, constant_values=ALL)
+    n = states.shape[axis]
+    out = states
+    for shift in (0, 2):
+        out = combine(out, np.take(padded, range(shift, shift + n), axis=axis))
+    return out
+
+
+def counts(states):
+    return {name: int((states == state).sum()) for state, name in names.items()}
+
+
+def get(arr, pattern):
+    """Summary of a dask array of the test data matching `pattern`, from its sidecar when known.
+
+    Summaries are only kept for data with a manifest, whose key identifies its content.
+    """
+    manifest = cache.read_manifest(pattern)
+    key = None if manifest is None else f'{manifest["key"]} {arr.chunks}'
+    path = index_path(pattern)
+    stored = {}
+    if key is not None and os.path.exists(path):
+        with open(path) as f:
+            stored = json.load(f)
+    if key in stored:
+        states = np.array(stored[key], dtype=np.int8)
+        status = 'hit'
+    else:
+        states = summary(arr)
+        status = 'computed'
+        if key is not None:
+            stored[key] = states.tolist()
+            with open(path, 'w') as f:
+                json.dump(stored, f)
+    events.append(dict(status=status, **counts(states)))
+    print(f'NaN summary ({status}): ' + ', '.join(f'{n} {name}' for name, n in counts(states).items()) + ' blocks')
+    return states
+
+
+def dispatch(*blocks, kernels=None, states=None, block_info=None, **kwargs):
+    """Function for map_blocks or map_overlap running `kernels[state]` on the blocks.
+
+    The state is that of the block of the first input in `states`. Kernels are keyed by state name.
+    """
+    state = states[tuple(block_info[0]['chunk-location'])]
+    return kernels[names[state]](*blocks, **kwargs)
@@ -0,0 +1,116 @@
+# Sampling CPU profiler of the benchmark process
+# A background thread records the Python stack of every thread of the process at a fixed
+# interval, each tagged with the current pipeline phase. With the threaded dask scheduler the
+# work runs in the threads of this process, so their stacks show where the time goes. Stacks
+# are saved in the collapsed format of flamegraph.pl, which inferno and speedscope also read.
+import os
+import sys
+import json
+import shutil
+import threading
+import subprocess
+import datetime as dt
+from collections import Counter
+default_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'output', 'profiles')
+# Leaf frames of threads waiting for work, not using the CPU
+idle = {('threading.py', 'wait'), ('threading.py', '_wait_for_tstate_lock'), ('queue.py', 'get'),
+        ('selectors.py', 'select'), ('selectors.py', 'poll'), ('base_events.py', '_run_once'),
+        ('thread.py', '_worker'), ('popen_fork.py', 'poll')}
+
+
+def _where(filename):
+    """File of a frame, relative to site-packages or as a base name."""
+    parts = filename.replace(os.sep, '/').rsplit('-packages/', 1)
+    return parts[1] if len(parts) == 2 else os.path.basename(filename)
+
+
+def _stack(frame):
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append((_where(code.co_filename), code.co_name, code.co_firstlineno))
+        frame = frame.f_back
+    return frames[::-1]
+
+
+class StackSampler:
+    """Sample the stacks of all threads in a background thread.
+
+    Use as a context manager. `phase` is called at each sample and its result is the root frame
+    of the stacks, e.g. the current phase of a `sampler.Sampler`.
+    """
+
+    def __init__(self, interval=0.01, phase=None):
+        self.interval = interval
+        self.phase = phase or (lambda: 'all')
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='bench-profiler', daemon=True)
+
+    def _sample(self):
+        phase = self.phase()
+        for ident, frame in sys._current_frames().items():
+            if ident == self._thread.ident:
+                continue
+            stack = _stack(frame)
+            if (os.path.basename(stack[-1][0]), stack[-1][1]) in idle:
+                continue
+            self.stacks[(phase,) + tuple(stack)] += 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def collapsed(self):
+        """Lines of the collapsed stack format: frames from the root separated by ; and the count."""
+        lines = []
+        for (phase, *stack), count in self.stacks.items():
+            frames = [phase] + [f'{func} ({where}:{line})' for where, func, line in stack]
+            lines.append(';'.join(frames) + f' {count}')
+        return sorted(lines)
+
+    def top(self, n=20):
+        """Functions with the most samples on top of the stack, as [frame, fraction of the samples]."""
+        own = Counter()
+        for (phase, *stack), count in self.stacks.items():
+            where, func, line = stack[-1]
+            own[f'{func} ({where}:{line})'] += count
+        total = sum(own.values()) or 1
+        return [[frame, round(count / total, 4)] for frame, count in own.most_common(n)]
+
+    def save(self, stem, params):
+        """Write `stem`.folded, `stem`.svg if flamegraph.pl is installed and `stem`.json with the run parameters."""
+        os.makedirs(os.path.dirname(stem) or '.', exist_ok=True)
+        files = {'stacks': stem + '.folded'}
+        with open(files['stacks'], 'w') as f:
+            f.write('\n'.join(self.collapsed()) + '\n')
+        flamegraph = shutil.which('flamegraph.pl') or shutil.which('inferno-flamegraph')
+        if flamegraph:
+            with open(files['stacks']) as f, open(stem + '.svg', 'w') as svg:
+                if subprocess.run([flamegraph], stdin=f, stdout=svg).returncode == 0:
+                    files['flamegraph'] = stem + '.svg'
+        info = {'interval': self.interval, 'samples': self.samples, **files, 'top': self.top()}
+        with open(stem + '.json', 'w') as f:
+            json.dump(dict(info, params=params), f, indent=1)
+        return info
+
+
+def profile_stem(name, directory=default_dir):
+    """Path without extension of the profile files of a run, unique per experiment and time."""
+    return os.path.join(directory, f'{name}_{dt.datetime.now().strftime("%Y%m%d-%H%M%S")}_{os.getpid()}')
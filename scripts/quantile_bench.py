@@ -1,22 +1,106 @@
-# Imports
-import pyperf as perf
-# import icclim
+# Quantile and rank microbenchmarks
+# Batched kernels of quantiles.py against np.quantile, np.nanquantile and a double argsort, over
+# vector lengths, numbers of vectors (batch) and fractions of NaNs. Quantiles and ranks are taken
+# along the last axis of a (batch, length) array.
+import itertools
 import numpy as np
+import pyperf as perf
+import quantiles
 
-x = np.array(np.random.rand(1000))
 P = np.linspace(0.01, 0.99, 50)
 
 
-def bench_argsort():
-    # np.quantile(x, P)
-    x.argsort().argsort() / len(x)
+def make_data(length, batch, nan_fraction, seed=0):
+    rng = np.random.default_rng([seed, length, batch])
+    x = rng.random((batch, length))
+    if nan_fraction:
+        x[rng.random(x.shape) < nan_fraction] = np.nan
+    return x
+
+
+def bench_argsort(x):
+    x.argsort(axis=-1).argsort(axis=-1) / x.shape[-1]
+
+
+def bench_ranks(x):
+    quantiles.ranks(x)
+
+
+def bench_quantile(x):
+    np.quantile(x, P, axis=-1)
+
+
+def bench_nanquantile(x):
+    np.nanquantile(x, P, axis=-1)
+
+
+def bench_select(x):
+    quantiles.quantiles(x, P)
+
+
+def bench_nanselect(x):
+    quantiles.nanquantiles(x, P)
+
+
+# NaN-propagating quantiles are only meaningful without NaNs
+benches = {
+    'rank-argsort2': (bench_argsort, True),
+    'rank-single': (bench_ranks, True),
+    'quantile-np': (bench_quantile, False),
+    'quantile-select': (bench_select, False),
+    'nanquantile-np': (bench_nanquantile, True),
+    'nanquantile-select': (bench_nanselect, True),
+}
+
+
+def check(lengths, batches, nan_fractions):
+    """Compare the kernels with numpy on every configuration."""
+    ok = True
+    for length, batch, frac in itertools.product(lengths, batches, nan_fractions):
+        x = make_data(length, batch, frac)
+        with np.errstate(invalid='ignore'):
+            ref = np.moveaxis(np.nanquantile(x, P, axis=-1), 0, -1)
+        good = np.allclose(quantiles.nanquantiles(x, P), ref, equal_nan=True)
+        if not frac:
+            good &= np.allclose(quantiles.quantiles(x, P), ref)
+            good &= np.array_equal(quantiles.ranks(x), x.argsort(axis=-1).argsort(axis=-1) / length)
+        print(f'n={length} batch={batch} nan={frac}: {"ok" if good else "DIFFER"}')
+        ok &= good
+    return ok
+
+
+def add_arguments(parser):
+    parser.add_argument('--lengths', nargs='+', type=int, default=[10, 100, 1000, 10000], help='Vector lengths')
+    parser.add_argument('--batches', nargs='+', type=int, default=[1, 100, 10000], help='Numbers of vectors')
+    parser.add_argument('--nan-fractions', nargs='+', type=float, default=[0, 0.01, 0.1],
+                        help='Fractions of NaN values')
+    parser.add_argument('--max-size', type=int, default=10**7,
+                        help='Skip configurations with more values than this')
+    parser.add_argument('--benches', nargs='+', default=list(benches), choices=list(benches))
+    parser.add_argument('--check', action='store_true', help='Compare the kernels with numpy instead of benchmarking')
+
+
+def add_cmdline_args(cmd, args):
+    cmd.extend(['--lengths', *map(str, args.lengths), '--batches', *map(str, args.batches),
+                '--nan-fractions', *map(str, args.nan_fractions), '--max-size', str(args.max_size),
+                '--benches', *args.benches])
 
 
-def bench_quantile():
-    np.quantile(x, P)
-    # x.argsort.argsort()
+if __name__ == '__main__':
+    runner = perf.Runner(add_cmdline_args=add_cmdline_args)
+    add_arguments(runner.argparser)
+    args = runner.parse_args()
+    runner.metadata['numpy_version'] = np.__version__
 
+    if args.check:
+        raise SystemExit(0 if check(args.lengths, args.batches, args.nan_fractions) else 1)
 
-runner = perf.Runner()
-runner.bench_func('Quantile - argsort', bench_argsort)
-runner.bench_func('Quantile - func', bench_quantile)
+    for length, batch, frac in itertools.product(args.lengths, args.batches, args.nan_fractions):
+        if length * batch > args.max_size:
+            continue
+        x = make_data(length, batch, frac)
+        for name in args.benches:
+            func, with_nans = benches[name]
+            if frac and not with_nans:
+                continue
+            runner.bench_func(f'{name} n={length} batch={batch} nan={frac}', func, x)
@@ -0,0 +1,88 @@
+# Batched quantile and rank kernels
+# Quantiles and ranks along one axis of an N-D array, for all vectors at once. Quantiles only need
+# a few order statistics of each vector, which np.partition selects in linear time instead of
+# sorting. Vectors with NaNs are grouped by their number of valid values, so that each group is
+# selected with the same positions. Ranks need a single argsort instead of two.
+import numpy as np
+
+
+def _positions(n, qs):
+    """Indices of the order statistics below and above each quantile, and the interpolation weights.
+
+    Linear interpolation, as np.quantile's default method.
+    """
+    pos = (n - 1) * np.asarray(qs, dtype=np.float64)
+    lo = np.floor(pos).astype(np.intp)
+    hi = np.minimum(lo + 1, n - 1)
+    return lo, hi, pos - lo
+
+
+def _select(arr, qs, n):
+    # arr has the vectors along the last axis and at least n valid values first after partitioning
+    lo, hi, frac = _positions(n, qs)
+    part = np.partition(arr, np.unique(np.concatenate([lo, hi])), axis=-1)
+    vlo = part[..., lo]
+    vhi = part[..., hi]
+    return vlo + (vhi - vlo) * frac.astype(arr.dtype, copy=False)
+
+
+def quantiles(arr, qs, axis=-1, nan_check=True):
+    """Quantiles (0-1) along `axis`, returned along a new last axis. NaNs propagate as with np.quantile.
+
+    Without `nan_check`, the caller knows there are no NaNs and the check is skipped.
+    """
+    arr = np.moveaxis(np.asarray(arr), axis, -1)
+    n = arr.shape[-1]
+    if n == 0:
+        return np.full(arr.shape[:-1] + (len(qs),), np.nan)
+    out = _select(arr, qs, n)
+    if nan_check and arr.dtype.kind == 'f':
+        out[np.isnan(arr).any(axis=-1)] = np.nan
+    return out
+
+
+def nanquantiles(arr, qs, axis=-1):
+    """Quantiles (0-1) along `axis` ignoring NaNs, returned along a new last axis, as np.nanquantile."""
+    arr = np.moveaxis(np.asarray(arr), axis, -1)
+    n = arr.shape[-1]
+    shape = arr.shape[:-1]
+    out = np.full(shape + (len(qs),), np.nan, dtype=arr.dtype if arr.dtype.kind == 'f' else np.float64)
+    if n == 0:
+        return out
+    flat = arr.reshape(-1, n)
+    res = out.reshape(-1, len(qs))
+    valid = n - np.isnan(flat).sum(axis=-1)
+    full = valid == n
+    if full.all():
+        return _select(arr, qs, n)
+    if full.any():
+        res[full] = _select(flat[full], qs, n)
+    # np.partition sorts NaNs to the end, so the first `count` values are the valid ones
+    for count in np.unique(valid[(valid > 0) & ~full]):
+        rows = valid == count
+        res[rows] = _select(flat[rows], qs, count)
+    return out
+
+
+def ranks(arr, axis=-1, pct=True):
+    """Rank of each value along `axis`, from 0, with a single argsort.
+
+    With `pct`, ranks are divided by the number of valid values. NaNs get a NaN rank. Ties get
+    distinct ranks in no particular order, as with `arr.argsort().argsort()`.
+    """
+    arr = np.moveaxis(np.asarray(arr), axis, -1)
+    n = arr.shape[-1]
+    # The default introsort, a stable sort is twice as slow
+    order = np.argsort(arr, axis=-1)
+    out = np.empty(arr.shape, dtype=np.float64)
+    np.put_along_axis(out, order, np.broadcast_to(np.arange(n, dtype=np.float64), arr.shape), axis=-1)
+    if arr.dtype.kind == 'f':
+        nans = np.isnan(arr)
+        if nans.any():
+            out[nans] = np.nan
+            if pct:
+                out /= (n - nans.sum(axis=-1, keepdims=True))
+                return np.moveaxis(out, -1, axis)
+    if pct:
+        out /= n
+    return np.moveaxis(out, -1, axis)
@@ -0,0 +1,132 @@
+# In-process memory and CPU sampler
+# Replaces the external `mprof run` + read_mprofile round trip. A background thread records
+# the RSS and CPU usage of the main process and of every dask worker at a fixed interval,
+# each sample tagged with the current pipeline phase.
+import os
+import time
+import threading
+from contextlib import contextmanager
+import psutil
+
+
+class Sampler:
+    """Sample RSS [MiB] and CPU [%] of a set of processes in a background thread.
+
+    Use as a context manager and switch phases with `phase(name)`. Worker processes of a
+    dask client can be added with `add_client(client)`.
+    """
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.processes = {'main': psutil.Process(os.getpid())}
+        self.current = 'setup'
+        self.samples = []
+        self.durations = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='bench-sampler', daemon=True)
+        self._t0 = None
+
+    def add_client(self, client):
+        for addr, pid in client.run(os.getpid).items():
+            # Workers run in this process with --threads-only
+            if pid != os.getpid():
+                self.processes[addr] = psutil.Process(pid)
+
+    def set_phase(self, name):
+        self.current = name
+
+    @contextmanager
+    def phase(self, name):
+        previous = self.current
+        self.set_phase(name)
+        self._sample()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name] = self.durations.get(name, 0) + time.perf_counter() - start
+            self._sample()
+            self.set_phase(previous)
+
+    def _sample(self):
+        t = time.perf_counter() - self._t0
+        for label, proc in list(self.processes.items()):
+            try:
+                with proc.oneshot():
+                    rss = proc.memory_info().rss / 2**20
+                    cpu = proc.cpu_percent()
+            except psutil.NoSuchProcess:
+                continue
+            self.samples.append([round(t, 4), self.current, label, rss, cpu])
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._t0 = time.perf_counter()
+        for proc in self.processes.values():
+            proc.cpu_percent()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def summary(self):
+        """Peak total RSS over all processes, overall and per phase."""
+        totals = {}
+        for t, phase, label, rss, cpu in self.samples:
+            totals.setdefault((t, phase), 0)
+            totals[(t, phase)] += rss
+        peaks = {}
+        for (t, phase), rss in totals.items():
+            peaks[phase] = max(peaks.get(phase, 0), rss)
+        return {'peak_rss_total': max(peaks.values(), default=0), 'peak_rss_by_phase': peaks}
+
+    def to_dict(self):
+        return {'interval': self.interval,
+                'durations': self.durations,
+                'processes': {label: proc.pid for label, proc in self.processes.items()},
+                'columns': ['time', 'phase', 'process', 'rss', 'cpu'],
+                'samples': self.samples,
+                **self.summary()}
+
+
+def total_rss(memory):
+    """Time series of the RSS summed over all processes of a recorded run, with the phase."""
+    totals = {}
+    for t, phase, label, rss, cpu in memory['samples']:
+        totals.setdefault(t, [phase, 0])[1] += rss
+    times = sorted(totals)
+    return times, [totals[t][0] for t in times], [totals[t][1] for t in times]
+
+
+def plot(runs, title='Memory usage'):
+    import matplotlib.pyplot as plt
+    try:
+        plt.style.use('dark_background')
+    except OSError:
+        pass
+    fig, ax = plt.subplots(figsize=(10, 5))
+    for run in runs:
+        times, phases, rss = total_rss(run['memory'])
+        line, = ax.plot(times, rss, label=run['name'])
+        # Mark phase changes along the curve
+        for i in range(1, len(times)):
+            if phases[i] != phases[i - 1]:
+                ax.axvline(times[i], color=line.get_color(), alpha=0.3, linestyle=':')
+                ax.annotate(phases[i], (times[i], rss[i]), color=line.get_color(), fontsize=8)
+    ax.legend()
+    ax.set_xlabel('Computation time [s]')
+    ax.set_ylabel('Memory usage [MiB]')
+    ax.set_title(title)
+    plt.show()
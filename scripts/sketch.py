@@ -0,0 +1,172 @@
+# Mergeable quantile sketch held in arrays, one sketch per grid cell
+# A simplified t-digest with a uniform scale function: each sketch is `k` centroids (value, weight)
+# and merging two sketches sorts their centroids and compresses them back into `k` bins of equal
+# weight. The rank error is about 1 / (2k) per compression, so `k = ceil(1 / error)`. Errors of the
+# successive compressions of a tree reduction add up, so `error` is a target, not a bound: the
+# actual rank error can be larger (see `rank_error` and the accuracy report of bench_ensemble.py).
+# Sketches are stored along the reduced axis as [m, values(m), weights(m)] with m <= k centroids,
+# which lets dask concatenate and merge them in a tree reduction. While there are fewer than `k`
+# values, the sketch holds them all and is exact.
+import math
+from functools import partial
+import numpy as np
+import dask
+import dask.array as da
+
+
+def size_for(error):
+    """Number of centroids of sketches aiming at a rank error of `error`."""
+    return max(int(math.ceil(1 / error)), 2)
+
+
+def merge_depth(nchunks, split_every=None):
+    """Compressions a value goes through in `sketch_percentiles` over `nchunks` chunks: its chunk, then each level of the tree."""
+    split_every = split_every or dask.config.get('split_every', 4)
+    depth = 1
+    while nchunks > 1:
+        nchunks = -(-nchunks // split_every)
+        depth += 1
+    return depth
+
+
+def rank_error(x, q, ps):
+    """Largest rank error of the percentiles `q` (along the last axis) of the values along the last axis of `x`.
+
+    The rank of a value is interpolated between the sorted values, as np.percentile interpolates
+    percentiles, and scaled to [0, 1]. Cells with NaNs are skipped.
+    """
+    s = np.sort(x, axis=-1)
+    n = s.shape[-1]
+    valid = ~np.isnan(s).any(axis=-1)
+    worst = 0.
+    for i, p in enumerate(ps):
+        a = q[..., i][valid][:, np.newaxis]
+        sv = s[valid]
+        lo = ((sv <= a).sum(axis=-1, keepdims=True) - 1).clip(0, n - 2)
+        slo = np.take_along_axis(sv, lo, axis=-1)
+        shi = np.take_along_axis(sv, lo + 1, axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = np.where(shi > slo, (a - slo) / (shi - slo), 0).clip(0, 1)
+        rank = (lo + frac)[:, 0] / (n - 1)
+        if rank.size:
+            worst = max(worst, float(np.abs(rank - p / 100).max()))
+    return worst
+
+
+def _unpack(x):
+    """Values and weights of the sketches concatenated along the last axis."""
+    if x.size == 0:
+        return x[..., :0], x[..., :0]
+    vs, ws = [], []
+    pos = 0
+    while pos < x.shape[-1]:
+        # The number of centroids is the same for all cells of a block
+        m = int(x[..., pos].flat[0])
+        vs.append(x[..., pos + 1:pos + 1 + m])
+        ws.append(x[..., pos + 1 + m:pos + 1 + 2 * m])
+        pos += 1 + 2 * m
+    return np.concatenate(vs, axis=-1), np.concatenate(ws, axis=-1)
+
+
+def _pack(v, w):
+    header = np.full(v.shape[:-1] + (1,), v.shape[-1], dtype=v.dtype)
+    return np.concatenate([header, v, w], axis=-1)
+
+
+def compress(v, w, k):
+    """Compress centroids along the last axis into at most `k` centroids of about equal weight.
+
+    Empty centroids have a weight of 0 and a NaN value. Returns the packed sketch.
+    """
+    order = np.argsort(v, axis=-1)
+    v = np.take_along_axis(v, order, axis=-1)
+    w = np.take_along_axis(w, order, axis=-1)
+    shape = v.shape[:-1]
+    m = v.shape[-1]
+    if m <= k:
+        return _pack(v, w)
+
+    cw = np.cumsum(w, axis=-1)
+    total = cw[..., -1:]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        bins = np.floor((cw - w / 2) / total * k)
+    bins = np.nan_to_num(bins).clip(0, k - 1).astype(np.intp)
+
+    ncell = int(np.prod(shape))
+    idx = (bins.reshape(ncell, m) + np.arange(ncell)[:, np.newaxis] * k).ravel()
+    weights = np.bincount(idx, weights=w.ravel(), minlength=ncell * k)
+    sums = np.bincount(idx, weights=np.where(w > 0, v * w, 0).ravel(), minlength=ncell * k)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        values = np.where(weights > 0, sums / weights, np.nan)
+    return _pack(values.reshape(shape + (k,)), weights.reshape(shape + (k,)))
+
+
+def from_values(x, k):
+    """Sketch of the values along the last axis, NaNs are skipped."""
+    w = (~np.isnan(x)).astype(np.float64)
+    return compress(x.astype(np.float64), w, k)
+
+
+def merge(x, k):
+    """Merge the sketches concatenated along the last axis."""
+    v, w = _unpack(x)
+    return compress(v, w, k)
+
+
+def percentiles(x, ps):
+    """Percentiles (0-100) from a sketch along the last axis, returned along the last axis.
+
+    Centroids are placed at the middle of their cumulative weight and values are interpolated
+    between them, which gives the same result as np.percentile when all weights are 1.
+    """
+    v, w = _unpack(x)
+    if v.shape[-1] == 0:
+        return np.full(v.shape[:-1] + (len(ps),), np.nan)
+    order = np.argsort(v, axis=-1)
+    v = np.take_along_axis(v, order, axis=-1)
+    w = np.take_along_axis(w, order, axis=-1)
+    cw = np.cumsum(w, axis=-1)
+    total = cw[..., -1]
+    mid = np.where(w > 0, cw - w / 2, np.inf)
+    nvalid = (w > 0).sum(axis=-1)
+
+    out = np.empty(v.shape[:-1] + (len(ps),))
+    for i, p in enumerate(ps):
+        rank = (p / 100 * (total - 1) + 0.5)[..., np.newaxis]
+        hi = (mid < rank).sum(axis=-1, keepdims=True).clip(0, np.maximum(nvalid - 1, 0)[..., np.newaxis])
+        lo = (hi - 1).clip(0)
+        mlo = np.take_along_axis(mid, lo, axis=-1)
+        mhi = np.take_along_axis(mid, hi, axis=-1)
+        vlo = np.take_along_axis(v, lo, axis=-1)
+        vhi = np.take_along_axis(v, hi, axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = np.where(mhi > mlo, (rank - mlo) / (mhi - mlo), 0).clip(0, 1)
+        out[..., i] = (vlo + (vhi - vlo) * frac)[..., 0]
+    out[nvalid == 0] = np.nan
+    return out
+
+
+def _chunk(x, axis=None, keepdims=None, k=100):
+    return np.moveaxis(from_values(np.moveaxis(x, axis[0], -1), k), -1, axis[0])
+
+
+def _combine(x, axis=None, keepdims=None, k=100):
+    return np.moveaxis(merge(np.moveaxis(x, axis[0], -1), k), -1, axis[0])
+
+
+def _aggregate(x, axis=None, keepdims=None, k=100, ps=(50,), dtype=np.float64):
+    out = percentiles(merge(np.moveaxis(x, axis[0], -1), k), ps)
+    return np.moveaxis(out, -1, axis[0]).astype(dtype, copy=False)
+
+
+def sketch_percentiles(arr, ps, error=0.01, axis=-1, split_every=None):
+    """Approximate percentiles along `axis` of a dask array, computed without rechunking the axis.
+
+    Each chunk is reduced to sketches independently and sketches are merged in a tree reduction.
+    The percentiles replace `axis` in the output.
+    """
+    k = size_for(error)
+    axis = axis % arr.ndim
+    return da.reduction(arr, partial(_chunk, k=k), partial(_aggregate, k=k, ps=tuple(ps), dtype=arr.dtype),
+                        combine=partial(_combine, k=k), axis=axis, keepdims=True, dtype=arr.dtype,
+                        split_every=split_every, concatenate=True, output_size=len(ps))
@@ -0,0 +1,144 @@
+# Isolated slots for concurrent benchmark runs
+# Splits the cores and memory of the machine into slots. Each benchmark subprocess is pinned to
+# the cores of its slot and killed when its process tree uses more than the slot's memory, so
+# that independent experiments can run side by side without sharing cores.
+import os
+import time
+import statistics
+import subprocess
+import psutil
+# Thread pools that would otherwise size themselves on the whole machine
+thread_vars = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def physical_cores(cpus):
+    """Group logical CPUs by physical core, so that hyperthreads of a core go to the same slot."""
+    groups = {}
+    for cpu in cpus:
+        try:
+            with open(f'/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list') as f:
+                siblings = f.read().strip()
+        except OSError:
+            siblings = str(cpu)
+        groups.setdefault(siblings, []).append(cpu)
+    return list(groups.values())
+
+
+def make_slots(cores_per_slot, mem_per_slot=None, nslots=None, reserve=1):
+    """Split the available physical cores into slots of `cores_per_slot` cores.
+
+    `reserve` cores are left to the scheduler and the OS. Without `mem_per_slot` [bytes], the
+    available memory is shared equally between the slots.
+    """
+    cores = physical_cores(available_cpus())
+    usable = cores[reserve:] if len(cores) > reserve else cores
+    nmax = max(len(usable) // cores_per_slot, 1)
+    nslots = min(nslots or nmax, nmax)
+    if mem_per_slot is None:
+        mem_per_slot = int(psutil.virtual_memory().available * 0.9 / nslots)
+    slots = []
+    for i in range(nslots):
+        group = usable[i * cores_per_slot:(i + 1) * cores_per_slot]
+        slots.append({'id': i, 'cpus': sorted(cpu for core in group for cpu in core), 'mem': mem_per_slot})
+    return slots
+
+
+def _pin(cpus):
+    def preexec():
+        os.sched_setaffinity(0, cpus)
+    return preexec
+
+
+def launch(argv, slot):
+    """Start a subprocess pinned to the CPUs of the slot, dask workers it spawns inherit the affinity."""
+    env = dict(os.environ, **{var: str(len(slot['cpus'])) for var in thread_vars})
+    preexec = _pin(slot['cpus']) if hasattr(os, 'sched_setaffinity') else None
+    return subprocess.Popen(argv, env=env, preexec_fn=preexec)
+
+
+def tree_rss(proc):
+    """RSS [bytes] of a process and all of its children."""
+    try:
+        procs = [proc] + proc.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return 0
+    total = 0
+    for p in procs:
+        try:
+            total += p.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return total
+
+
+def kill_tree(proc):
+    try:
+        procs = proc.children(recursive=True) + [proc]
+    except psutil.NoSuchProcess:
+        return
+    for p in procs:
+        try:
+            p.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+
+def run(jobs, slots, on_done, interval=0.2):
+    """Run the jobs, each a (tag, argv) pair, on free slots until all are done.
+
+    `on_done(tag, status)` is called as each job finishes, with `status` holding the slot, the
+    return code, whether the memory cap was hit and the number of jobs that ran alongside it.
+    """
+    pending = list(jobs)
+    free = list(slots)
+    running = {}
+    while pending or running:
+        while pending and free:
+            tag, argv = pending.pop(0)
+            slot = free.pop(0)
+            popen = launch(argv, slot)
+            running[tag] = {'popen': popen, 'proc': psutil.Process(popen.pid), 'slot': slot,
+                            'capped': False, 'peak_rss': 0, 'concurrent': len(running)}
+        for job in running.values():
+            job['concurrent'] = max(job['concurrent'], len(running) - 1)
+
+        time.sleep(interval)
+        for tag in list(running):
+            job = running[tag]
+            rss = tree_rss(job['proc'])
+            job['peak_rss'] = max(job['peak_rss'], rss)
+            if rss > job['slot']['mem'] and job['popen'].poll() is None:
+                print(f'{tag}: {rss / 2**20:.0f} MiB over the memory cap of slot {job["slot"]["id"]}, killed')
+                job['capped'] = True
+                kill_tree(job['proc'])
+            returncode = job['popen'].poll()
+            if returncode is None:
+                continue
+            del running[tag]
+            free.append(job['slot'])
+            on_done(tag, {'slot': job['slot'], 'returncode': returncode, 'capped': job['capped'],
+                          'peak_tree_rss': job['peak_rss'] / 2**20, 'concurrent': job['concurrent']})
+
+
+def contention(runs, key, threshold=0.1):
+    """Relative standard deviation of the wall time per benchmark and whether it exceeds `threshold`.
+
+    Runs of the same benchmark in isolated slots should take the same time, a large spread
+    suggests they competed for a shared resource (memory bandwidth, caches, disk).
+    """
+    times = {}
+    for run in runs:
+        times.setdefault(key(run), []).append(run['wall_time'])
+    out = {}
+    for bench, values in times.items():
+        if len(values) < 2:
+            continue
+        cv = statistics.stdev(values) / statistics.mean(values)
+        out[bench] = {'cv': cv, 'n': len(values), 'flag': cv > threshold}
+    return out
@@ -0,0 +1,227 @@
+# Results store and cross-version comparison
+# Runs are filed by xclim, xarray and dask versions plus a machine fingerprint, so that
+# results of different versions can be compared with pyperf-style significance tests.
+import os
+import glob
+import math
+import json
+import hashlib
+import statistics
+import utils
+default_store = 'results'
+tracked = ['xclim', 'xarray', 'dask']
+
+# Two-sided 95% critical values of Student's t distribution, by degrees of freedom (as in pyperf)
+_tdist95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+            2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+            2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+
+def fingerprint(machine):
+    """Short hash identifying a machine, from the fields that affect performance."""
+    keys = ['hostname', 'cpu_model', 'cpu_count', 'platform']
+    text = json.dumps({k: machine.get(k) for k in keys}, sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()[:8]
+
+
+def run_key(run):
+    return {'machine': fingerprint(run['machine']),
+            **{mod: run['versions'].get(mod) for mod in tracked}}
+
+
+def key_name(key):
+    return '_'.join([key['machine']] + [f'{mod}-{key[mod]}' for mod in tracked])
+
+
+def bench_id(run):
+    """Identify a benchmark configuration: only runs with the same id are compared."""
+    if 'benchmark' in run:
+        return run['benchmark']
+    parts = [run['name']]
+    parts += [f'{k}={v}' for k, v in sorted(run.get('options', {}).items())]
+    if run.get('index'):
+        parts.append('index')
+    if run.get('format', 'netcdf') != 'netcdf':
+        parts.append(f'format={run["format"]}')
+    if run.get('writer', 'netcdf') != 'netcdf':
+        parts.append(f'writer={run["writer"]}')
+    if run.get('fused_write'):
+        parts.append('fused-write')
+    if run.get('dtype', 'float64') != 'float64':
+        parts.append(f'dtype={run["dtype"]}')
+    if run.get('profile'):
+        # Sampling slows runs down, they are not comparable with runs without it
+        parts.append('profiled')
+    cl = run['client']
+    if cl['with_client']:
+        parts.append(f'N={cl["nthreads"]} m={cl["max_mem"]}')
+        if cl.get('nworkers', 1) != 1:
+            parts.append(f'w={cl["nworkers"]}')
+        if not cl.get('processes', True):
+            parts.append('threads-only')
+        parts += [f'{k}={v}' for k, v in sorted(cl.get('memory', {}).items())]
+    parts.append('x'.join(str(s) for s in run['shape']['sizes'].values()))
+    return ' '.join(parts)
+
+
+def from_pyperf(filename, versions=None):
+    """Convert a pyperf JSON file to runs of the results format, one per benchmark.
+
+    Versions are read from `<module>_version` metadata when present, or given explicitly.
+    """
+    with open(filename) as f:
+        suite = json.load(f)
+    meta = suite['metadata']
+    runs = []
+    for bench in suite['benchmarks']:
+        bmeta = dict(meta, **bench.get('metadata', {}))
+        values = [v for run in bench['runs'] for v in run.get('values', [])]
+        runs.append({
+            'benchmark': bmeta['name'],
+            'name': bmeta['name'],
+            'values': {'wall_time': values},
+            'versions': {mod: (versions or {}).get(mod, bmeta.get(f'{mod}_version')) for mod in tracked},
+            'machine': {'hostname': bmeta.get('hostname'), 'cpu_model': bmeta.get('cpu_model_name'),
+                        'cpu_count': bmeta.get('cpu_count'), 'platform': bmeta.get('platform')},
+            'date': bmeta.get('date', min((r['metadata']['date'] for r in bench['runs']
+                                           if 'date' in r.get('metadata', {})), default=None)),
+        })
+    return runs
+
+
+def load_runs(filename, versions=None):
+    """Runs from a harness results file or a pyperf JSON file."""
+    with open(filename) as f:
+        content = json.load(f)
+    if 'benchmarks' in content:
+        return from_pyperf(filename, versions)
+    runs = content['runs']
+    if versions:
+        for run in runs:
+            run['versions'] = dict(run['versions'], **versions)
+    return runs
+
+
+def add(runs, store=default_store):
+    """File runs in the store, grouped by their key. Returns the names of the updated entries."""
+    groups = {}
+    for run in runs:
+        groups.setdefault(key_name(run_key(run)), []).append(run)
+    os.makedirs(store, exist_ok=True)
+    for name, group in groups.items():
+        filename = os.path.join(store, name + '.json')
+        results = utils.load_results(filename)
+        results['key'] = run_key(group[0])
+        results['runs'].extend(group)
+        utils.save_results(filename, results)
+    return list(groups)
+
+
+def entries(store=default_store):
+    files = sorted(glob.glob(os.path.join(store, '*.json')), key=os.path.getmtime)
+    return [os.path.splitext(os.path.basename(f))[0] for f in files]
+
+
+def resolve(ref, store=default_store):
+    """A store entry from a file path, an entry name, a unique substring of one or `latest[~n]`."""
+    if os.path.isfile(ref):
+        return ref
+    names = entries(store)
+    if ref.startswith('latest'):
+        back = int(ref.split('~')[1]) if '~' in ref else 0
+        if back >= len(names):
+            raise KeyError(f'Store {store} has only {len(names)} entries')
+        return os.path.join(store, names[-1 - back] + '.json')
+    matches = [name for name in names if name == ref] or [name for name in names if ref in name]
+    if len(matches) != 1:
+        raise KeyError(f'{ref} matches {len(matches)} entries of {store}: {", ".join(matches)}')
+    return os.path.join(store, matches[0] + '.json')
+
+
+def invalid(runs):
+    """Benchmark ids with a run whose output failed validation."""
+    return {bench_id(run) for run in runs if run.get('validation', {}).get('passed') is False}
+
+
+def samples(runs, metric='wall_time'):
+    """Values of the metric per benchmark id."""
+    out = {}
+    for run in runs:
+        if 'values' in run:
+            values = run['values'].get(metric, [])
+        elif metric in run:
+            values = [run[metric]]
+        else:
+            values = []
+        out.setdefault(bench_id(run), []).extend(values)
+    return out
+
+
+def tscore(sample1, sample2):
+    """Student's two-sample t score with pooled variance."""
+    n1, n2 = len(sample1), len(sample2)
+    mean1, mean2 = statistics.mean(sample1), statistics.mean(sample2)
+    squares = math.fsum((x - mean1) ** 2 for x in sample1) + math.fsum((x - mean2) ** 2 for x in sample2)
+    error = squares / (n1 + n2 - 2) * (1 / n1 + 1 / n2)
+    if error == 0:
+        return math.inf if mean1 != mean2 else 0.0
+    return (mean1 - mean2) / math.sqrt(error)
+
+
+def is_significant(sample1, sample2):
+    """Whether the means differ at the 95% level, and the t score. Needs 2 values per sample."""
+    if len(sample1) < 2 or len(sample2) < 2:
+        return False, None
+    deg_freedom = len(sample1) + len(sample2) - 2
+    critical = _tdist95[deg_freedom - 1] if deg_freedom <= len(_tdist95) else 1.960
+    t = tscore(sample1, sample2)
+    return abs(t) >= critical, t
+
+
+def compare(runs1, runs2, metric='wall_time', threshold=0.05):
+    """Compare each benchmark present in both sets of runs.
+
+    Returns one row per benchmark with the ratio `new / ref`, whether the change is significant
+    and whether it is a regression, i.e. a significant increase larger than `threshold`.
+    """
+    ref, new = samples(runs1, metric), samples(runs2, metric)
+    ref_invalid, new_invalid = invalid(runs1), invalid(runs2)
+    rows = []
+    for bench in ref:
+        if bench not in new or not ref[bench] or not new[bench]:
+            continue
+        m1, m2 = statistics.mean(ref[bench]), statistics.mean(new[bench])
+        significant, t = is_significant(ref[bench], new[bench])
+        ratio = m2 / m1 if m1 else math.inf
+        # A wrong output is never a win, and a regression when the reference output was right
+        wrong = bench in new_invalid
+        rows.append({'benchmark': bench, 'ref': ref[bench], 'new': new[bench], 'ratio': ratio,
+                     'significant': significant, 't': t, 'invalid': wrong,
+                     'regression': (significant and ratio > 1 + threshold) or (wrong and bench not in ref_invalid)})
+    return rows
+
+
+def _fmt(values):
+    if len(values) > 1:
+        return f'{statistics.mean(values):.3f} +- {statistics.stdev(values):.3f}'
+    return f'{values[0]:.3f}'
+
+
+def report(rows, metric='wall_time'):
+    for row in rows:
+        if row['ratio'] == 1:
+            change = 'no change'
+        elif row['ratio'] < 1:
+            change = f'{1 / row["ratio"]:.2f}x faster' if metric.endswith('_time') else f'{1 / row["ratio"]:.2f}x smaller'
+        else:
+            change = f'{row["ratio"]:.2f}x slower' if metric.endswith('_time') else f'{row["ratio"]:.2f}x larger'
+        if row['t'] is None:
+            sig = 'not enough values to test'
+        else:
+            sig = 'significant' if row['significant'] else 'not significant'
+        if row.get('invalid'):
+            change = 'output differs from the reference'
+        flag = '  REGRESSION' if row['regression'] else ''
+        print(f'{row["benchmark"]}: {_fmt(row["ref"])} -> {_fmt(row["new"])}: {change} ({sig}){flag}')
+    if not rows:
+        print('No benchmark in common')
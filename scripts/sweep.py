@@ -0,0 +1,90 @@
+# Scaling sweeps
+# Grid of dask client settings (threads per worker, workers) and data sizes, and the strong
+# scaling (fixed size, more cores) and weak scaling (size grows with the cores) efficiencies.
+import itertools
+import statistics
+
+
+def strong_grid(sizes, workers, threads):
+    """Points of a strong scaling sweep: every client setting for each data size."""
+    for size in sizes:
+        for nworkers, nthreads in itertools.product(workers, threads):
+            yield {'sizes': list(size), 'nworkers': nworkers, 'nthreads': nthreads}
+
+
+def weak_grid(size, workers, threads, index):
+    """Points of a weak scaling sweep: `size[index]` grows with the number of cores."""
+    points = sorted(itertools.product(workers, threads), key=lambda p: p[0] * p[1])
+    base = points[0][0] * points[0][1]
+    for nworkers, nthreads in points:
+        scaled = list(size)
+        scaled[index] = size[index] * nworkers * nthreads // base
+        yield {'sizes': scaled, 'nworkers': nworkers, 'nthreads': nthreads}
+
+
+def cores(run):
+    cl = run['client']
+    return cl.get('nworkers', 1) * cl['nthreads']
+
+
+def efficiency(runs, mode='strong'):
+    """Scaling curves from the runs of a sweep, one per experiment and number of workers (and data
+    size for strong scaling), along the number of cores.
+
+    Times of repeated points are averaged. Speedup and efficiency are relative to the point with the
+    fewest cores: T0 / T and T0 * p0 / (T * p) for strong scaling, T0 / T for both with weak scaling.
+    """
+    groups = {}
+    for run in runs:
+        key = f"{run['name']} w={run['client'].get('nworkers', 1)}"
+        if mode == 'strong':
+            key += ' ' + 'x'.join(str(s) for s in run['sweep']['sizes'])
+        groups.setdefault(key, {}).setdefault(cores(run), []).append(run['wall_time'])
+
+    curves = {}
+    for key, points in groups.items():
+        ps = sorted(points)
+        times = [statistics.mean(points[p]) for p in ps]
+        p0, t0 = ps[0], times[0]
+        speedup = [t0 / t for t in times]
+        if mode == 'strong':
+            eff = [t0 * p0 / (t * p) for p, t in zip(ps, times)]
+        else:
+            eff = speedup
+        curves[key] = {'cores': ps, 'wall_time': times, 'speedup': speedup, 'efficiency': eff}
+    return curves
+
+
+def report(curves, mode='strong'):
+    for key, curve in curves.items():
+        print(f'{key} ({mode} scaling)')
+        print(f'{"cores":>8s} {"wall [s]":>10s} {"speedup":>8s} {"eff.":>6s}')
+        for p, t, s, e in zip(curve['cores'], curve['wall_time'], curve['speedup'], curve['efficiency']):
+            print(f'{p:8d} {t:10.2f} {s:8.2f} {e:6.2f}')
+
+
+def plot(curves, mode, filename):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    try:
+        plt.style.use('dark_background')
+    except OSError:
+        pass
+    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(12, 5))
+    for key, curve in curves.items():
+        ax1.plot(curve['cores'], curve['wall_time'], marker='o', label=key)
+        ax2.plot(curve['cores'], curve['efficiency'], marker='o', label=key)
+    ax1.set_xscale('log')
+    ax2.set_xscale('log')
+    ax1.set_xlabel('Cores (workers x threads)')
+    ax1.set_ylabel('Wall time [s]')
+    ax2.set_xlabel('Cores (workers x threads)')
+    ax2.set_ylabel('Parallel efficiency')
+    ax2.axhline(1, color='gray', linestyle=':')
+    ax2.set_ylim(0, 1.2)
+    ax1.legend(fontsize=8)
+    ax1.set_title(f'{mode.capitalize()} scaling')
+    fig.tight_layout()
+    fig.savefig(filename)
+    print(f'Saved {filename}')
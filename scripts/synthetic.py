@@ -0,0 +1,105 @@
+# Synthetic test data
+# Lazy, seeded random fields built with dask and written in parallel,
+# either as one netCDF file per chunk or as a single chunked zarr store.
+import os
+import re
+import glob
+import shutil
+import numpy as np
+import dask
+import dask.array as da
+import xarray as xr
+import mfindex
+import cache
+formats = ['netcdf', 'zarr']
+
+
+def _random_block(seed, nan_at, block_dtype, block_info=None):
+    info = block_info[None]
+    # Each block gets its own stream, so the data only depends on the seed and the chunking
+    rng = np.random.default_rng([seed, *info['chunk-location']])
+    block = rng.random(info['chunk-shape']).astype(block_dtype, copy=False)
+    if nan_at is not None:
+        block[nan_at] = np.nan
+    return block
+
+
+def random_field(chunks, seed=0, nan_at=None, dtype='float64'):
+    """Lazy uniform random field in [0, 1).
+
+    `chunks` is a tuple of explicit chunk sizes per dimension. If `nan_at` is given, that index
+    (relative to each chunk) is set to NaN in every chunk.
+    """
+    # `dtype` is taken by map_blocks itself, the block function gets its own copy
+    return da.map_blocks(_random_block, seed=seed, nan_at=nan_at, block_dtype=dtype, dtype=dtype,
+                         chunks=chunks, meta=np.array((), dtype=dtype))
+
+
+def year_chunks(years, nchunks, calendar='standard'):
+    """Split daily time steps of a standard or noleap calendar into `nchunks` chunks per year."""
+    chunks = []
+    for year in years:
+        leap = calendar != 'noleap' and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+        ndays = 366 if leap else 365
+        size = 365 // nchunks
+        chunks.extend([size] * (nchunks - 1) + [ndays - size * (nchunks - 1)])
+    return tuple(chunks)
+
+
+def to_netcdf_per_chunk(ds, filename, dims=('time',)):
+    """Write one netCDF file per chunk along `dims`, all files in parallel.
+
+    `filename` is formatted with the chunk index along each of `dims` as keyword arguments.
+    Dimensions other than `time` are dropped from the files (e.g. one file per realization).
+    """
+    datasets = [ds]
+    indexes = [{}]
+    for dim in dims:
+        new_ds, new_idx = [], []
+        for sub, idx in zip(datasets, indexes):
+            start = 0
+            for i, size in enumerate(sub.chunks[dim]):
+                part = sub.isel({dim: slice(start, start + size)})
+                if dim != 'time':
+                    part = part.squeeze(dim, drop=True)
+                new_ds.append(part)
+                new_idx.append(dict(idx, **{dim: i}))
+                start += size
+        datasets, indexes = new_ds, new_idx
+    paths = [filename.format(**idx) for idx in indexes]
+    return xr.save_mfdataset(datasets, paths, compute=False)
+
+
+def files(filename, store):
+    """Files of the test data with either format."""
+    return sorted(glob.glob(re.sub(r'\{[^}]*\}', '*', filename))) + ([store] if os.path.isdir(store) else [])
+
+
+def clear(filename, store):
+    """Remove the test data of either format, its index and its cache manifest."""
+    for old in files(filename, store):
+        if os.path.isdir(old):
+            shutil.rmtree(old)
+        else:
+            os.remove(old)
+    for sidecar in [mfindex.index_path(filename), cache.manifest_path(filename)]:
+        if os.path.exists(sidecar):
+            os.remove(sidecar)
+
+
+def write(ds, fmt, filename, store, dims=('time',)):
+    """Write the lazy dataset with the requested format, computing all chunks in parallel.
+
+    Data previously generated with either format is removed first, so no stale file is left behind.
+    """
+    clear(filename, store)
+    if fmt == 'netcdf':
+        delayed = to_netcdf_per_chunk(ds, filename, dims)
+    elif fmt == 'zarr':
+        # zarr needs regular chunks, the data itself does not depend on this rechunk
+        ds = ds.chunk({dim: max(chks) for dim, chks in ds.chunks.items()})
+        delayed = ds.to_zarr(store, mode='w', compute=False)
+    else:
+        raise ValueError(f'Unknown format {fmt}, must be one of {formats}')
+    print(f'Writing {ds.nbytes / 2**20:.0f} MiB of test data as {fmt}')
+    dask.compute(delayed)
@@ -0,0 +1,111 @@
+# Out-of-core ensemble reductions over spatial tiles, without dask
+# An ensemble is stored as one group of netCDF files per realization, each group split along time
+# (see mfindex). A generator walks over tiles of the spatial dimensions: for each tile, all times
+# of all realizations are read straight from the files into a reused buffer, reduced in NumPy
+# and written to its region of a preallocated output before moving on to the next tile. Peak
+# memory is the output plus one tile, whatever the chunking of the files.
+import itertools
+import contextlib
+import numpy as np
+
+
+def tile_shape(shape, max_cells):
+    """Largest tile of at most `max_cells` cells, whole last dimensions first for contiguous reads."""
+    tile = [1] * len(shape)
+    cells = 1
+    for k in reversed(range(len(shape))):
+        tile[k] = max(min(shape[k], max_cells // cells), 1)
+        cells *= tile[k]
+        if tile[k] < shape[k]:
+            break
+    return tuple(tile)
+
+
+def regions(shape, tile):
+    """Generate the regions, as tuples of slices, of the tiles covering `shape`."""
+    for start in itertools.product(*[range(0, n, t) for n, t in zip(shape, tile)]):
+        yield tuple(slice(s, min(s + t, n)) for s, t, n in zip(start, tile, shape))
+
+
+def _decode(arr, attrs):
+    # As xarray decodes: fill values to NaN, then scale and offset
+    for key in ('_FillValue', 'missing_value'):
+        if key in attrs:
+            arr[arr == attrs[key]] = np.nan
+    if 'scale_factor' in attrs:
+        arr *= attrs['scale_factor']
+    if 'add_offset' in attrs:
+        arr += attrs['add_offset']
+
+
+def layout(index, name):
+    """Dimensions, full shape and data type of a variable of an ensemble index, realizations excluded."""
+    entry = index['groups'][0]
+    info = entry['scans'][0]['variables'][name]
+    dim = entry['concat_dim']
+    shape = tuple(len(entry['values']) if d == dim else n for d, n in zip(info['dims'], info['shape']))
+    raw = np.dtype(info['dtype'])
+    packed = raw.kind != 'f' or 'scale_factor' in info['attrs'] or 'add_offset' in info['attrs']
+    return info['dims'], shape, np.dtype('float64') if packed else raw
+
+
+def read_tiles(index, name, tile):
+    """Generate (region, block) for each spatial tile of variable `name` of an ensemble index.
+
+    Tiles span all times. `block` has the realizations along its last axis and is a view of a
+    buffer reused for every tile: it is only valid until the next one.
+    """
+    import netCDF4
+    dims, shape, dtype = layout(index, name)
+    dim = index['groups'][0]['concat_dim']
+    spatial = [k for k, d in enumerate(dims) if d != dim]
+    full = tuple(n if k not in spatial else tile[spatial.index(k)] for k, n in enumerate(shape))
+    buf = np.empty(full + (len(index['groups']),), dtype)
+    with contextlib.ExitStack() as stack:
+        # Each file is opened once for all tiles
+        groups = []
+        for entry in index['groups']:
+            files, offset = [], 0
+            for filename, scan in zip(entry['files'], entry['scans']):
+                v = stack.enter_context(netCDF4.Dataset(filename)).variables[name]
+                v.set_auto_maskandscale(False)
+                size = scan['variables'][name]['shape'][dims.index(dim)] if dim in dims else 0
+                files.append((v, offset, size))
+                offset += size
+                if dim not in dims:
+                    break
+            groups.append(files)
+        attrs = index['groups'][0]['scans'][0]['variables'][name]['attrs']
+
+        for tile_region in regions([shape[k] for k in spatial], tile):
+            region = [slice(None)] * len(shape)
+            for k, sl in zip(spatial, tile_region):
+                region[k] = sl
+            block = buf[tuple(slice(0, len(range(*sl.indices(n)))) for sl, n in zip(region, shape))]
+            for r, files in enumerate(groups):
+                for v, offset, size in files:
+                    target = [slice(None)] * len(shape)
+                    if dim in dims:
+                        target[dims.index(dim)] = slice(offset, offset + size)
+                    block[tuple(target) + (r,)] = v[tuple(region)]
+            _decode(block, attrs)
+            yield tuple(region), block
+
+
+def reduce(index, name, func, nout, max_bytes, overhead=3):
+    """Reduce variable `name` over the realizations of an ensemble index, tile by tile.
+
+    `func(block)` reduces the last axis of a block into `nout` values along a new last axis. Tiles
+    are as large as possible with `overhead` times the block in at most `max_bytes`, for the
+    copies made by the kernel. Returns the output, with the dimensions of the variable and
+    `nout` last, and the tile shape.
+    """
+    dims, shape, dtype = layout(index, name)
+    dim = index['groups'][0]['concat_dim']
+    spatial = [n for d, n in zip(dims, shape) if d != dim]
+    per_cell = int(np.prod([n for d, n in zip(dims, shape) if d == dim])) * len(index['groups']) * dtype.itemsize
+    tile = tile_shape(spatial, max(int(max_bytes // (per_cell * overhead)), 1))
+    out = np.empty(shape + (nout,), dtype)
+    for region, block in read_tiles(index, name, tile):
+        out[region] = func(block)
+    return out, tile
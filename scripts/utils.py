@@ -0,0 +1,236 @@
+# Shared helpers for the benchmark scripts
+# Argument parsing, dask client setup, mprof plotting and result records.
+import os
+import glob
+import json
+import socket
+import argparse
+import resource
+import platform
+import psutil
+import datetime as dt
+from collections.abc import Mapping
+
+
+def find_exps(namespace):
+    """Experiments are the module-level functions named `exp_<name>`."""
+    return {name.split('_', 1)[1]: func for name, func in namespace.items() if name.startswith('exp_')}
+
+
+def base_parser(description, default_sizes, sizes_help):
+    parser = argparse.ArgumentParser(description=description)
+    add_client_arguments(parser)
+    add_data_arguments(parser)
+    parser.add_argument('exp', type=str, help='which exp to run')
+    parser.add_argument('-i', '--files', default='*.dat', nargs='*', help='Dat files to plot')
+    parser.add_argument('-n', '--chunk-size', default=default_sizes, nargs='*', help=sizes_help)
+    return parser
+
+
+def add_client_arguments(parser):
+    parser.add_argument('-c', '--with-client', action='store_true', help='whether to use a dask client')
+    parser.add_argument('-N', '--nthreads', default=10, type=int, help='When using a dask client, number of threads per worker')
+    parser.add_argument('-m', '--max-mem', default='2GB', help='When using a dask client, memory limit of each worker')
+    parser.add_argument('-w', '--nworkers', default=1, type=int,
+                        help='When using a dask client, number of worker processes')
+    add_cluster_arguments(parser)
+
+
+def _fraction(value):
+    return False if value.lower() in ('false', 'off') else float(value)
+
+
+def add_cluster_arguments(parser):
+    parser.add_argument('--threads-only', action='store_true',
+                        help='Run the workers as threads of this process instead of separate processes')
+    # Fractions of the memory limit of each worker, see distributed.worker.memory in the dask configuration
+    parser.add_argument('--spill-target', type=_fraction,
+                        help='Spill data to disk above this fraction of the memory limit of a worker, '
+                             'counting only the data it manages (false to disable)')
+    parser.add_argument('--spill', type=_fraction,
+                        help='Spill data to disk above this fraction of the memory limit, by process memory')
+    parser.add_argument('--pause', type=_fraction, help='Pause a worker above this fraction of the memory limit')
+    parser.add_argument('--terminate', type=_fraction, help='Restart a worker above this fraction of the memory limit')
+    parser.add_argument('--local-dir', help='Directory where workers spill, the dask default temporary directory by default')
+
+
+def add_data_arguments(parser):
+    parser.add_argument('--format', default='netcdf', choices=['netcdf', 'zarr'],
+                        help='Test data as one netCDF file per chunk or as a single zarr store')
+    parser.add_argument('--seed', default=0, type=int, help='Seed of the generated test data')
+    parser.add_argument('--dtype', default='float64', choices=['float64', 'float32'],
+                        help='Floating point type of the generated test data, which the whole pipeline keeps')
+    parser.add_argument('--index', action='store_true',
+                        help='Open netCDF test data from a cached metadata index instead of opening every file')
+
+
+def make_client(args):
+    if not args.with_client:
+        return None
+    import dask
+    from distributed import Client
+    # Nannies pass the configuration on to the worker processes
+    dask.config.set(memory_config(args))
+    return Client(n_workers=args.nworkers, threads_per_worker=args.nthreads, memory_limit=args.max_mem,
+                  processes=not args.threads_only, local_directory=args.local_dir)
+
+
+def memory_config(args):
+    """Memory thresholds of the workers set on the command line, as dask configuration."""
+    keys = {'spill_target': 'target', 'spill': 'spill', 'pause': 'pause', 'terminate': 'terminate'}
+    return {f'distributed.worker.memory.{key}': getattr(args, opt) for opt, key in keys.items()
+            if getattr(args, opt) is not None}
+
+
+def client_settings(args):
+    return {'with_client': args.with_client, 'nworkers': args.nworkers, 'nthreads': args.nthreads,
+            'max_mem': args.max_mem, 'processes': not args.threads_only,
+            'memory': {key.rsplit('.', 1)[1]: value for key, value in memory_config(args).items()}}
+
+
+def parse_sizes(sizes):
+    if isinstance(sizes, list):
+        return list(map(int, sizes))
+    return [int(sizes)]
+
+
+def read_mprofile(filename):
+    times = []
+    mem = []
+    name = filename.split('.')[0]
+    with open(filename, 'r') as f:
+        for line in f:
+            if line.startswith('CMDLINE'):
+                name = line.strip().split()[-1]
+            elif line.startswith('MEM'):
+                _, m, t = line.strip().split()
+                times.append(dt.datetime.fromtimestamp(float(t)))
+                mem.append(float(m))
+    times = [(t - times[0]).total_seconds() for t in times]
+    return name, times, mem
+
+
+def plot_mprofiles(files, names, title):
+    import matplotlib.pyplot as plt
+    try:
+        plt.style.use('dark_background')
+    except OSError:
+        pass
+    if not isinstance(files, list):
+        if '*' in files:
+            files = glob.glob(files)
+        else:
+            files = [files]
+    colors = {exp: col for exp, col in zip(names,
+                                           plt.matplotlib.rcParams['axes.prop_cycle'].by_key()['color'])}
+    fig, ax = plt.subplots(figsize=(10, 5))
+    for file in files:
+        name, times, mem = read_mprofile(file)
+        ax.plot(times, mem, label=name, color=colors.get(name))
+    ax.legend()
+    ax.set_xlabel('Computation time [s]')
+    ax.set_ylabel('Memory usage [MiB]')
+    ax.set_title(title)
+    plt.show()
+
+
+def peak_rss():
+    """Peak resident memory of the current process in MiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def read_bytes():
+    """Bytes read by the current process with system calls, from the disk or the page cache."""
+    io = psutil.Process().io_counters()
+    return getattr(io, 'read_chars', io.read_bytes)
+
+
+def data_shape(data):
+    """Sizes, number of chunks per dimension and data types of a Dataset or DataArray.
+
+    >>> import numpy as np, xarray as xr
+    >>> ds = xr.Dataset({'a': (('realization', 'time'), np.zeros((4, 10)))}).chunk({'realization': 2, 'time': 5})
+    >>> data_shape(ds)['nchunks'] == data_shape(ds['a'])['nchunks'] == {'realization': 2, 'time': 2}
+    True
+    """
+    shape = {'sizes': {dim: int(size) for dim, size in data.sizes.items()}}
+    if data.chunks:
+        # Dataset chunks map dimensions to chunks (a Frozen mapping, not a dict), DataArray chunks follow its dimensions
+        chunks = dict(data.chunks) if isinstance(data.chunks, Mapping) else dict(zip(data.dims, data.chunks))
+        shape['nchunks'] = {dim: len(chks) for dim, chks in chunks.items()}
+    variables = data.data_vars.values() if hasattr(data, 'data_vars') else [data]
+    shape['dtype'] = ','.join(sorted({str(v.dtype) for v in variables}))
+    return shape
+
+
+def versions():
+    out = {}
+    for mod in ['xclim', 'xarray', 'dask', 'distributed', 'numpy']:
+        try:
+            out[mod] = __import__(mod).__version__
+        except ImportError:
+            out[mod] = None
+    return out
+
+
+def cpu_model():
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+
+def machine():
+    return {'hostname': socket.gethostname(), 'platform': platform.platform(),
+            'python': platform.python_version(), 'cpu_count': os.cpu_count(), 'cpu_model': cpu_model()}
+
+
+def load_results(filename):
+    if not os.path.exists(filename):
+        return {'version': 1, 'runs': []}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_results(filename, results):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(results, f, indent=1)
+    os.replace(tmp, filename)
+
+
+def append_results(filename, runs):
+    results = load_results(filename)
+    results['runs'].extend(runs)
+    save_results(filename, results)
+
+
+def main(module, args):
+    """Command line entry shared by the bench_* scripts: gendata, plot or one experiment."""
+    if args.exp == 'gendata':
+        c = make_client(args)
+        module.gendata(parse_sizes(args.chunk_size), seed=args.seed, fmt=args.format, dtype=args.dtype)
+        if c is not None:
+            c.close()
+
+    elif args.exp == 'plot':
+        plot_mprofiles(args.files, list(module.all_exps.keys()), module.plot_title)
+
+    else:
+        c = make_client(args)
+
+        data = module.open_data(args)
+        print(f'Running {module.family} with exp: {args.exp}')
+        out = module.run_exp(args.exp, data, args)
+
+        print('Writing to file')
+        r = out.to_netcdf(module.output_name(args.exp, args), compute=False)
+        r.compute()
+        out.close()
+
+        if c is not None:
+            c.close()
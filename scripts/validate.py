@@ -0,0 +1,113 @@
+# Validation of experiment outputs against a reference implementation
+# Each family names its reference experiment (`reference`, e.g. xclim's own function) and may
+# convert outputs to a common layout (`canonical`). After a run, the written output is compared
+# with the output of the reference on the same data and options, which is computed once and kept
+# next to the test data, keyed by the data manifest.
+import os
+import shutil
+import hashlib
+import json
+import numpy as np
+import xarray as xr
+import writers
+default_rtol = 1e-5
+default_atol = 1e-8
+
+
+def open_output(path):
+    return xr.open_zarr(path) if path.endswith('.zarr') else xr.open_dataset(path)
+
+
+def canonical(module, ds):
+    """Variables of an output in the common layout of its family, by name."""
+    if hasattr(module, 'canonical'):
+        return module.canonical(ds)
+    if len(ds.data_vars) == 1:
+        return {'out': next(iter(ds.data_vars.values()))}
+    return dict(ds.data_vars)
+
+
+def reference_path(module, args, manifest):
+    """Output of the reference on the test data described by `manifest`, None without a manifest."""
+    if manifest is None:
+        return None
+    options = {opt: getattr(args, opt) for opt in getattr(module, 'options', [])}
+    text = json.dumps({'data': manifest['key'], 'reference': module.reference, 'options': options}, sort_keys=True)
+    return f'testref_{module.family}_{hashlib.sha1(text.encode()).hexdigest()[:12]}.nc'
+
+
+def reference(module, args, manifest, exp=None, outname=None):
+    """Path of the output of the reference experiment, computed when missing.
+
+    When the run is the reference itself, its output is copied instead.
+    """
+    path = reference_path(module, args, manifest) or f'testref_{module.family}.nc'
+    if manifest is not None and os.path.exists(path):
+        return path
+    if exp == module.reference and not outname.endswith('.zarr'):
+        shutil.copy2(outname, path)
+        return path
+    print(f'Computing the reference {module.family}.{module.reference}')
+    out = module.run_exp(module.reference, module.open_data(args), args)
+    writers.write(out, path, 'netcdf')
+    return path
+
+
+def compare(out, ref, rtol=default_rtol, atol=default_atol):
+    """Compare the canonical variables of an output and a reference: values and NaN masks."""
+    rows = {}
+    for name, r in ref.items():
+        row = {'passed': False}
+        rows[name] = row
+        if name not in out:
+            row['error'] = f'missing variable {name}, got {list(out)}'
+            continue
+        o = out[name]
+        if set(o.dims) != set(r.dims):
+            row['error'] = f'dimensions {o.dims} instead of {r.dims}'
+            continue
+        o = o.transpose(*r.dims)
+        if o.shape != r.shape:
+            row['error'] = f'shape {o.shape} instead of {r.shape}'
+            continue
+        a, b = o.values.astype(np.float64), r.values.astype(np.float64)
+        both = np.isfinite(a) & np.isfinite(b)
+        diff = np.abs(a - b)[both]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rel = diff / np.abs(b[both])
+        row.update(max_abs_diff=float(diff.max()) if diff.size else 0.,
+                   max_rel_diff=float(np.nanmax(rel[np.isfinite(rel)])) if np.isfinite(rel).any() else 0.,
+                   nan_mismatch=int((np.isnan(a) != np.isnan(b)).sum()))
+        row['passed'] = bool(row['nan_mismatch'] == 0 and np.allclose(a[both], b[both], rtol=rtol, atol=atol))
+    return rows
+
+
+def validate(module, exp, outname, args, manifest):
+    """Validation record of the output of a run: the reference, tolerances and the result per variable.
+
+    Experiments of the family's `approximate` list are checked by its `check_approximate` instead.
+    """
+    if exp in getattr(module, 'approximate', []):
+        record = {'reference': 'rank error'}
+    else:
+        record = {'reference': f'{module.family}.{module.reference}', 'rtol': args.rtol, 'atol': args.atol}
+    try:
+        if exp in getattr(module, 'approximate', []):
+            with open_output(outname) as out:
+                record['variables'] = module.check_approximate(exp, out, module.open_data(args), args)
+        else:
+            path = reference(module, args, manifest, exp, outname)
+            with open_output(outname) as out, xr.open_dataset(path) as ref:
+                out = canonical(module, out)
+                if not out:
+                    raise ValueError('the output has no variable to compare with the reference')
+                record['variables'] = compare(out, canonical(module, ref), args.rtol, args.atol)
+        record['passed'] = all(row['passed'] for row in record['variables'].values())
+    except Exception as err:
+        # A failing reference does not fail the run, but the run is not validated
+        record.update(passed=None, error=f'{type(err).__name__}: {err}')
+    status = {True: 'passed', False: 'FAILED', None: 'not validated'}[record['passed']]
+    print(f'Validation against {record["reference"]}: {status}'
+          + ''.join(f'\n  {name}: {row}' for name, row in record.get('variables', {}).items() if not row['passed'])
+          + (f' ({record["error"]})' if 'error' in record else ''))
+    return record
@@ -0,0 +1,129 @@
+# Output backends
+# Encodings of the experiment outputs for netCDF4 (zlib levels, default or chunk-aligned chunking)
+# and zarr (compressors), so that the write stage can be timed on its own and across backends.
+import os
+import shutil
+import xarray as xr
+backends = {
+    'netcdf': {'format': 'netcdf'},
+    'netcdf-aligned': {'format': 'netcdf', 'chunks': 'aligned'},
+    'netcdf-zlib1': {'format': 'netcdf', 'zlib': 1},
+    'netcdf-zlib4': {'format': 'netcdf', 'zlib': 4},
+    'netcdf-zlib9': {'format': 'netcdf', 'zlib': 9},
+    'netcdf-zlib1-aligned': {'format': 'netcdf', 'zlib': 1, 'chunks': 'aligned'},
+    'netcdf-zlib4-aligned': {'format': 'netcdf', 'zlib': 4, 'chunks': 'aligned'},
+    # zarr chunks always follow the dask chunks, zarr cannot write dask chunks spanning several of its own
+    'zarr': {'format': 'zarr', 'compressor': 'lz4'},
+    'zarr-none': {'format': 'zarr', 'compressor': None},
+    'zarr-zstd': {'format': 'zarr', 'compressor': 'zstd'},
+    'zarr-zlib': {'format': 'zarr', 'compressor': 'zlib'},
+}
+
+
+def as_dataset(obj):
+    """Experiments return datasets or data arrays, named as DataArray.to_netcdf would."""
+    if isinstance(obj, xr.DataArray):
+        return obj.to_dataset(name=obj.name if obj.name is not None else '__xarray_dataarray_variable__')
+    return obj
+
+
+def chunk_sizes(ds):
+    """Size of the first dask chunk along each dimension of the data variables, taken before computing."""
+    ds = as_dataset(ds)
+    return {name: tuple(c[0] for c in var.chunks) for name, var in ds.data_vars.items()
+            if var.chunks is not None and var.ndim > 0}
+
+
+def _zarr_v3():
+    import zarr
+    return int(zarr.__version__.split('.')[0]) >= 3
+
+
+def _compressor(name):
+    """Compressor encoding for zarr, numcodecs for zarr 2 and zarr's own codecs for zarr 3."""
+    if _zarr_v3():
+        from zarr import codecs
+        if name is None:
+            return {'compressors': None}
+        if name == 'zlib':
+            return {'compressors': [codecs.GzipCodec(level=4)]}
+        return {'compressors': [codecs.BloscCodec(cname=name, clevel=5, shuffle='shuffle')]}
+    import numcodecs
+    if name is None:
+        return {'compressor': None}
+    if name == 'zlib':
+        return {'compressor': numcodecs.Zlib(level=4)}
+    return {'compressor': numcodecs.Blosc(cname=name, clevel=5, shuffle=numcodecs.Blosc.SHUFFLE)}
+
+
+def encoding(ds, backend, chunks=None):
+    """Per variable encoding of the data variables for a backend of `backends`."""
+    settings = backends[backend]
+    chunks = chunks or {}
+    enc = {}
+    for name, var in ds.data_vars.items():
+        if var.ndim == 0:
+            continue
+        e = {}
+        if settings['format'] == 'netcdf':
+            if 'zlib' in settings:
+                e.update(zlib=True, complevel=settings['zlib'])
+            if settings.get('chunks') == 'aligned' and name in chunks:
+                e['chunksizes'] = chunks[name]
+        else:
+            e.update(_compressor(settings['compressor']))
+            if name in chunks:
+                e['chunks'] = chunks[name]
+        enc[name] = e
+    return enc
+
+
+def output_path(outname, backend):
+    if backends[backend]['format'] == 'zarr':
+        return os.path.splitext(outname)[0] + '.zarr'
+    return outname
+
+
+def write(ds, path, backend, chunks=None, compute=True):
+    """Write the dataset with a backend. With `compute=False`, return the delayed write instead.
+
+    When writing immediately, the output is flushed to disk before returning so that the time
+    includes the actual I/O and not only the copy to the page cache.
+    """
+    remove(path)
+    ds = as_dataset(ds)
+    enc = encoding(ds, backend, chunks)
+    if backends[backend]['format'] == 'netcdf':
+        r = ds.to_netcdf(path, engine='netcdf4', encoding=enc, compute=compute)
+    else:
+        r = ds.to_zarr(path, mode='w', encoding=enc, compute=compute)
+    if compute:
+        sync(path)
+    return None if compute else r
+
+
+def sync(path):
+    """Flush a file, or all the files of a directory, to disk. Other files, such as the outputs of
+    concurrent runs, are left alone, unlike os.sync."""
+    paths = [path] if os.path.isfile(path) else [os.path.join(root, f) for root, _, files in os.walk(path)
+                                                 for f in files]
+    for p in paths:
+        fd = os.open(p, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def disk_size(path):
+    """Size [bytes] of a file or of all files under a directory."""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)